@@ -24,6 +24,12 @@ __author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
 
 import os.path
 import re
+import hashlib
+import tempfile
+import threading
+from time import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from gensim import corpora, models
 import logging
 
@@ -152,7 +158,36 @@ pure counter conters operator operators object objects character characters pate
 ascii rule rules identification identify identified identifies
 '''
 
-STOP_LIST = set(STOP_WORDS.split()+STOP_WORDS2.split())
+STOP_LIST = frozenset(STOP_WORDS.split()+STOP_WORDS2.split())
+
+MAX_FILE_SIZE = 4 * 1024 * 1024  # larger files are skipped
+
+BINARY_CHECK_SIZE = 8192
+
+# a line that float() accepts as a whole
+NUM_LINE_PAT = re.compile(r'^[^\S\n]*[-+]?(?:(?:\d+\.?\d*|\.\d+)(?:e[-+]?\d+)?|nan|inf|infinity)'
+                          r'[^\S\n]*(?:\n|\Z)', flags=re.M)
+
+# trailing hyphens joining a line with the next non-blank one
+HYPHEN_PAT = re.compile(r'-+[^\S\n]*\n\s*(?=\S)')
+
+# whitespace-delimited alphanumeric token of two or more characters not
+# starting with a digit
+WORD_PAT = re.compile(r'(?<!\S)[^\W\d_][^\W_]+(?!\S)')
+
+TOKENIZER_VERSION = 1  # to be incremented when iter_words changes
+
+
+def get_tokenizer_version():
+    '''Returns a digest of the tokenizer settings, by which cached word
+    counts are invalidated.
+    '''
+    h = hashlib.sha1()
+    for x in [str(TOKENIZER_VERSION), str(MAX_FILE_SIZE), NUM_LINE_PAT.pattern,
+              HYPHEN_PAT.pattern, WORD_PAT.pattern] + sorted(STOP_LIST):
+        h.update(x.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
 
 
 def isfloat(s):
@@ -181,7 +216,8 @@ def filt(x):
     return b
 
 
-def extract_words(path):
+def extract_words_by_line(path):
+    '''Line by line reference implementation of extract_words.'''
     f = open(path, 'r')
 
     lines = []
@@ -206,13 +242,55 @@ def extract_words(path):
     words = []
 
     for line in lines:
-        ln = filter(filt, line.split())
-        if ln:
-            words += ln
+        words += filter(filt, line.split())
 
     return words
 
 
+def iter_words(path):
+    with open(path, 'r', errors='replace') as f:
+        text = f.read().lower()
+
+    text = NUM_LINE_PAT.sub('', text)
+    text = HYPHEN_PAT.sub('', text)
+
+    return (w for w in WORD_PAT.findall(text) if w not in STOP_LIST)
+
+
+def extract_words(path):
+    return list(iter_words(path))
+
+
+def count_words(path):
+    return Counter(iter_words(path))
+
+
+def bench_extract_words(paths, repeat=3):
+    '''Compares extract_words with extract_words_by_line on paths.'''
+    def run(f):
+        ts = []
+        for _ in range(repeat):
+            st = time()
+            res = [f(p) for p in paths]
+            ts.append(time() - st)
+        return (min(ts), res)
+
+    (t0, res0) = run(extract_words_by_line)
+    (t1, res1) = run(extract_words)
+
+    nwords = sum(len(r) for r in res0)
+    ndiffs = sum(1 for (a, b) in zip(res0, res1) if a != b)
+
+    return {
+        'files':       len(paths),
+        'words':       nwords,
+        'by_line':     t0,
+        'buffer':      t1,
+        'speedup':     t0 / t1 if t1 > 0 else float('inf'),
+        'differences': ndiffs,
+    }
+
+
 def lda(corpus, dictionary, ntopics=10):
     lda = models.ldamodel.LdaModel(corpus, id2word=dictionary,
                                    num_topics=ntopics, alpha='auto', eval_every=5)
@@ -234,40 +312,260 @@ def rp(corpus, dictionary, ntopics=10):
     return rp
 
 
-def get_texts(dpath, pat):
+def is_binary(path):
+    with open(path, 'rb') as f:
+        return b'\0' in f.read(BINARY_CHECK_SIZE)
+
+
+FILE_LIST_CACHE = OrderedDict()  # directory -> [(relative dir, file name)]
+
+FILE_LIST_CACHE_SIZE = 16
+
+FILE_LIST_LOCK = threading.Lock()
+
+
+def _list_files(dpath):
+    '''Walks dpath following symbolic links to directories. A directory
+    already visited (e.g. through a link to one of its ancestors) is not
+    walked again, which breaks link cycles.
+    '''
+    li = []
+    visited = set([os.path.realpath(dpath)])
+    for (d, dns, ns) in os.walk(dpath, followlinks=True):
+        rd = os.path.relpath(d, dpath)
+        li.extend((rd, n) for n in ns)
+        kept = []
+        for dn in dns:
+            rp = os.path.realpath(os.path.join(d, dn))
+            if rp not in visited:
+                visited.add(rp)
+                kept.append(dn)
+        dns[:] = kept
+    return li
+
+
+def list_files(dpath):
+    '''Returns (relative dir, file name) of the files under dpath. The
+    directory is walked once and the listing is shared by the tokenizer
+    (for every language) and the README collector.
+    '''
+    key = os.path.abspath(dpath)
+    with FILE_LIST_LOCK:
+        li = FILE_LIST_CACHE.pop(key, None)
+    if li is None:
+        li = _list_files(dpath)
+    with FILE_LIST_LOCK:
+        FILE_LIST_CACHE[key] = li
+        while len(FILE_LIST_CACHE) > FILE_LIST_CACHE_SIZE:
+            FILE_LIST_CACHE.popitem(last=False)
+    return li
+
+
+def clear_file_lists():
+    with FILE_LIST_LOCK:
+        FILE_LIST_CACHE.clear()
+
+
+def scan_dirs(dpaths, nthreads=1):
+    '''Returns the listings (see list_files) of dpaths, walking directories
+    in nthreads threads.
+    '''
+    if nthreads > 1 and len(dpaths) > 1:
+        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+            return list(executor.map(list_files, dpaths))
+    return [list_files(d) for d in dpaths]
+
+
+def iter_files(dpath, files=None):
+    '''Yields (path, file name) of the files under dpath. files is a
+    listing of dpath returned by list_files.
+    '''
+    if files is None:
+        files = list_files(dpath)
+    for (rd, n) in files:
+        d = dpath if rd == os.curdir else os.path.join(dpath, rd)
+        yield (os.path.join(d, n), n)
+
+
+def iter_doc_paths(dpath, pat, max_size=MAX_FILE_SIZE, files=None):
+    '''Yields paths of the documents under dpath whose file names match
+    pat, skipping oversized and binary files.
+    '''
     pat = re.compile(pat, flags=re.I)
 
-    texts = []
+    for (path, n) in iter_files(dpath, files=files):
+        m = pat.match(n)
+        if m:
+            try:
+                if max_size and os.path.getsize(path) > max_size:
+                    logger.debug(f'too large: {path}')
+                    continue
+                if is_binary(path):
+                    logger.debug(f'binary: {path}')
+                    continue
+            except OSError as e:
+                logger.warning(str(e))
+                continue
+            logger.debug('%s' % path)
+            yield path
+
+
+def _extract_words(path):
+    try:
+        return extract_words(path)
+    except Exception as e:
+        logger.warning(f'{path}: {e}')
+        return None
+
+
+def _count_words(path):
+    try:
+        return (path, count_words(path))
+    except Exception as e:
+        logger.warning(f'{path}: {e}')
+        return None
+
+
+def iter_extracted(f, paths, nprocs=1, chunksize=16):
+    '''Applies f to paths, in a process pool of nprocs workers if nprocs > 1,
+    and yields the results that are not None in the order of paths.
+    '''
+    if nprocs > 1:
+        with ProcessPoolExecutor(max_workers=nprocs) as executor:
+            for r in executor.map(f, paths, chunksize=chunksize):
+                if r is not None:
+                    yield r
+    else:
+        for path in paths:
+            r = f(path)
+            if r is not None:
+                yield r
+
+
+def iter_texts(dpath, pat, nprocs=1, max_size=MAX_FILE_SIZE):
+    paths = list(iter_doc_paths(dpath, pat, max_size=max_size))
 
+    logger.info('%d documents found' % len(paths))
+
+    return iter_extracted(_extract_words, paths, nprocs=nprocs)
+
+
+def get_texts(dpath, pat, nprocs=1, max_size=MAX_FILE_SIZE):
     logger.info('collecting documents...')
 
-    for (d, dns, ns) in os.walk(dpath, followlinks=True):
-        for n in ns:
-            m = pat.match(n)
-            if m:
-                path = os.path.join(d, n)
-                logger.debug('%s' % path)
-                try:
-                    words = extract_words(path)
-                    texts.append(words)
-                except Exception as e:
-                    logger.warning(str(e))
+    paths = list(iter_doc_paths(dpath, pat, max_size=max_size))
+
+    texts = list(iter_extracted(_extract_words, paths, nprocs=nprocs))
 
     logger.info('%d documents found' % len(texts))
 
     return texts
 
 
-def analyze(mkmodel, dpath, pat, ntopics=10):
-    texts = get_texts(dpath, pat)
+def get_word_counts_multi(dpaths, pat, nprocs=1, max_size=MAX_FILE_SIZE,
+                          cache=None):
+    '''Returns the word counts of the documents under each of dpaths. The
+    documents of all the directories are tokenized in a single pool, and
+    only the counts are sent back from workers. Files found in cache (a
+    TokenCache) are not tokenized again.
+    '''
+    logger.info('collecting documents...')
 
-    logger.info('analyzing...')
+    listings = scan_dirs(dpaths, nthreads=nprocs)
+
+    idx_tbl = {}  # path -> indexes of dpaths
+    for (i, (dpath, files)) in enumerate(zip(dpaths, listings)):
+        for path in iter_doc_paths(dpath, pat, max_size=max_size, files=files):
+            idx_tbl.setdefault(path, []).append(i)
+
+    paths = list(idx_tbl.keys())
+
+    counts_list = [Counter() for _ in dpaths]
+    ndocs = 0
+
+    def add(path, c):
+        for i in idx_tbl[path]:
+            counts_list[i].update(c)
+
+    if cache is not None:
+        missed = []
+        for path in paths:
+            c = cache.get(path)
+            if c is None:
+                missed.append(path)
+            else:
+                add(path, c)
+                ndocs += 1
+        cache.commit()
+        paths = missed
+
+    for (path, c) in iter_extracted(_count_words, paths, nprocs=nprocs):
+        add(path, c)
+        ndocs += 1
+        if cache is not None:
+            cache.put(path, c)
+
+    if cache is not None:
+        cache.commit()
+
+    logger.info('%d documents found' % ndocs)
+
+    return counts_list
+
+
+def get_word_counts(dpath, pat, nprocs=1, max_size=MAX_FILE_SIZE, cache=None):
+    '''Returns the word counts of all the documents under dpath.'''
+    return get_word_counts_multi([dpath], pat, nprocs=nprocs,
+                                 max_size=max_size, cache=cache)[0]
+
+
+def counts_to_bow(dictionary, counts):
+    '''Equivalent to dictionary.doc2bow() of a text with the word counts.'''
+    tbl = dictionary.token2id
+    return sorted((tbl[w], c) for (w, c) in counts.items() if w in tbl)
 
-    dictionary = corpora.Dictionary(texts)
-    # dictionary.save('a.dict')
 
-    corpus = [dictionary.doc2bow(text) for text in texts]
-    # corpora.MmCorpus.serialize('a.mm', corpus)
+def build_corpus(texts, corpus_path, dictionary=None):
+    '''Builds the dictionary and serializes the BoW corpus into corpus_path
+    (Matrix Market format) in a single pass over texts. Returns the
+    dictionary and the corpus streamed from disk.
+    '''
+    if dictionary is None:
+        dictionary = corpora.Dictionary()
+
+    def iter_bows():
+        for text in texts:
+            yield dictionary.doc2bow(text, allow_update=True)
+
+    corpora.MmCorpus.serialize(corpus_path, iter_bows())
+
+    return (dictionary, corpora.MmCorpus(corpus_path))
+
+
+def analyze(mkmodel, dpath, pat, ntopics=10, corpus_path=None, nprocs=1):
+    '''Trains a topic model on the documents under dpath. The corpus is
+    streamed from corpus_path rather than held in memory. Without
+    corpus_path, it is serialized into a temporary directory, which is
+    removed afterwards, and None is returned as the corpus.
+    '''
+    if corpus_path is None:
+        with tempfile.TemporaryDirectory() as d:
+            res = analyze(mkmodel, dpath, pat, ntopics=ntopics,
+                          corpus_path=os.path.join(d, 'corpus.mm'),
+                          nprocs=nprocs)
+        res['corpus'] = None
+        return res
+
+    logger.info('collecting documents...')
+
+    texts = iter_texts(dpath, pat, nprocs=nprocs)
+
+    (dictionary, corpus) = build_corpus(texts, corpus_path)
+
+    logger.info(f'{corpus.num_docs} documents, {len(dictionary)} words'
+                f' serialized into "{corpus_path}"')
+
+    logger.info('analyzing...')
 
     m = mkmodel(corpus, dictionary, ntopics=ntopics)
 
@@ -276,6 +574,7 @@ def analyze(mkmodel, dpath, pat, ntopics=10):
 
 if __name__ == '__main__':
     from argparse import ArgumentParser
+    from cca.ccautil.common import setup_logger
 
     parser = ArgumentParser(description='analyze topics of documents')
 
@@ -291,14 +590,39 @@ if __name__ == '__main__':
     parser.add_argument('-t', '--topics', dest='topics', metavar='N', type=int,
                         default=10, help='number of topics')
 
+    parser.add_argument('-c', '--corpus', dest='corpus', metavar='PATH',
+                        type=str, default=None,
+                        help='serialize corpus into PATH (.mm)')
+
+    parser.add_argument('-o', '--output', dest='output', metavar='PREFIX',
+                        type=str, default=None,
+                        help='save dictionary and model as PREFIX.{dict,model}')
+
+    parser.add_argument('-j', '--jobs', dest='nprocs', metavar='N', type=int,
+                        default=1, help='number of tokenizer processes')
+
+    parser.add_argument('--bench', dest='bench', action='store_true',
+                        help='benchmark word extraction on the documents')
+
     parser.add_argument('dpath', metavar='PATH', type=str, help='directory')
 
     args = parser.parse_args()
 
+    log_level = logging.INFO
+    if args.debug:
+        log_level = logging.DEBUG
+    setup_logger(logger, log_level)
+
     pat = r'.*readme.*'
     if args.pat:
         pat = args.pat
 
+    if args.bench:
+        import json
+        paths = list(iter_doc_paths(args.dpath, pat))
+        print(json.dumps(bench_extract_words(paths), indent=2))
+        exit(0)
+
     model = lsi
 
     if args.model == 'lda':
@@ -308,11 +632,17 @@ if __name__ == '__main__':
     elif args.model == 'rp':
         model = rp
 
-    res = analyze(model, args.dpath, pat, ntopics=args.topics)
+    res = analyze(model, args.dpath, pat, ntopics=args.topics,
+                  corpus_path=args.corpus, nprocs=args.nprocs)
 
     m = res['model']
+
+    if args.output:
+        res['dict'].save(args.output+'.dict')
+        m.save(args.output+'.model')
+
     try:
-        for t in m.show_topics(args.ntopics):
+        for t in m.show_topics(args.topics):
             print(t)
     except Exception as e:
         print(str(e))
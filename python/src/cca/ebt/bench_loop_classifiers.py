@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+
+'''
+  A benchmark harness for loop classifiers
+
+  Copyright 2013-2018 RIKEN
+  Copyright 2018-2020 Chiba Institute of Technology
+
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+'''
+
+__author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
+
+import os
+import json
+from time import time
+import numpy as np
+from sklearn.base import clone
+from sklearn.svm import SVC
+from sklearn.neighbors import KNeighborsClassifier
+from sklearn.model_selection import ShuffleSplit
+from sklearn.metrics import (accuracy_score, precision_score, recall_score,
+                             f1_score)
+import joblib
+import logging
+
+from .make_loop_classifier import (import_training_set, make_pipeline,
+                                   make_approx_pipeline, JUDGMENTS,
+                                   FEATURES_TBL)
+
+logger = logging.getLogger()
+
+
+def make_svc():
+    return make_pipeline(SVC(C=32., kernel='rbf', gamma=8.))
+
+
+def make_knn():
+    return make_pipeline(KNeighborsClassifier(6, weights='distance',
+                                              metric='hamming'))
+
+
+def make_nystroem():
+    return make_approx_pipeline(approx='nystroem')
+
+
+def make_rff():
+    return make_approx_pipeline(approx='rff')
+
+
+CANDIDATE_TBL = {
+    'svc':      make_svc,
+    'knn':      make_knn,
+    'nystroem': make_nystroem,
+    'rff':      make_rff,
+}
+
+SCORES = ['accuracy', 'precision', 'recall', 'f1', 'fit_time', 'predict_time']
+
+POS_LABEL = 'Kernel'
+
+###
+
+
+def eval_split(clf, X, y, train, test):
+    '''Fits a fresh clone of clf on the train indices and scores it on the
+    test indices.
+    '''
+    clf = clone(clf)
+
+    st = time()
+    clf.fit(X[train], y[train])
+    fit_time = time() - st
+
+    st = time()
+    y_pred = clf.predict(X[test])
+    predict_time = time() - st
+
+    y_test = y[test]
+
+    return {
+        'accuracy':     accuracy_score(y_test, y_pred),
+        'precision':    precision_score(y_test, y_pred, pos_label=POS_LABEL,
+                                        zero_division=0),
+        'recall':       recall_score(y_test, y_pred, pos_label=POS_LABEL,
+                                     zero_division=0),
+        'f1':           f1_score(y_test, y_pred, pos_label=POS_LABEL,
+                                 zero_division=0),
+        'fit_time':     fit_time,
+        'predict_time': predict_time,
+    }
+
+
+def summarize(results):
+    summary = {}
+    for k in SCORES:
+        a = np.array([r[k] for r in results])
+        summary[k] = {'mean': float(a.mean()), 'std': float(a.std())}
+    return summary
+
+
+def benchmark(path, feature_sets=list(FEATURES_TBL.keys()),
+              candidates=['svc'], judgment=JUDGMENTS[0],
+              n_splits=100, test_size=10, n_jobs=-1, seed=0):
+    '''Evaluates every (feature set, candidate) pair on the same n_splits
+    random splits, running splits in parallel. Returns a dict that can be
+    dumped as JSON.
+    '''
+    ji = JUDGMENTS.index(judgment)
+
+    report = {
+        'dataset':   os.path.abspath(path),
+        'judgment':  judgment,
+        'n_splits':  n_splits,
+        'test_size': test_size,
+        'seed':      seed,
+        'results':   {},
+    }
+
+    for fs in feature_sets:
+        (selected, derived) = FEATURES_TBL[fs]
+
+        data = import_training_set(path, selected=selected,
+                                   derived=derived)[ji]
+
+        logger.info('%s: shape=%s |y|=%d' % (fs, data.X.shape, len(data.y)))
+
+        if len(np.unique(data.y)) < 2 or len(data.y) <= test_size:
+            logger.warning(f'{fs}: not enough samples, skipped')
+            continue
+
+        splitter = ShuffleSplit(n_splits=n_splits, test_size=test_size,
+                                random_state=seed)
+        splits = list(splitter.split(data.X))
+
+        for cand in candidates:
+            name = f'{fs}/{cand}'
+            clf = CANDIDATE_TBL[cand]()
+
+            st = time()
+            try:
+                results = joblib.Parallel(n_jobs=n_jobs)(
+                    joblib.delayed(eval_split)(clf, data.X, data.y, train, test)
+                    for (train, test) in splits)
+            except Exception as e:
+                logger.warning(f'{name}: {e}')
+                report['results'][name] = {'error': str(e)}
+                continue
+            t = time() - st
+
+            summary = summarize(results)
+            summary['n_samples'] = len(data.y)
+            summary['n_features'] = data.X.shape[1]
+            summary['elapsed'] = t
+
+            logger.info('%s: accuracy=%f f1=%f (%.2fs)'
+                        % (name, summary['accuracy']['mean'],
+                           summary['f1']['mean'], t))
+
+            report['results'][name] = summary
+
+    return report
+
+
+def main():
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+    from cca.ccautil.common import setup_logger
+
+    parser = ArgumentParser(description='benchmark loop classifiers',
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-d', '--debug', dest='debug', action='store_true',
+                        help='enable debug printing')
+
+    parser.add_argument('-f', '--feature-set', dest='feature_sets',
+                        metavar='NAME', action='append',
+                        choices=list(FEATURES_TBL.keys()),
+                        help='feature set (repeatable, default: all)')
+
+    parser.add_argument('-c', '--candidate', dest='candidates',
+                        metavar='NAME', action='append',
+                        choices=list(CANDIDATE_TBL.keys()),
+                        help='model candidate (repeatable, default: svc)')
+
+    parser.add_argument('-k', '--judgment', dest='judgment', metavar='COL',
+                        type=str, default=JUDGMENTS[0], choices=JUDGMENTS,
+                        help='judgment column')
+
+    parser.add_argument('-n', '--n-splits', dest='n_splits', metavar='N',
+                        type=int, default=100, help='number of random splits')
+
+    parser.add_argument('-t', '--test-size', dest='test_size', metavar='N',
+                        type=int, default=10,
+                        help='number of test samples per split')
+
+    parser.add_argument('-j', '--jobs', dest='n_jobs', metavar='N', type=int,
+                        default=-1, help='number of parallel jobs')
+
+    parser.add_argument('-s', '--seed', dest='seed', metavar='N', type=int,
+                        default=0, help='random seed')
+
+    parser.add_argument('-o', '--outfile', dest='outfile', metavar='PATH',
+                        type=str, default=None,
+                        help='dump JSON report into PATH')
+
+    parser.add_argument('-r', '--register', dest='register', metavar='NAME',
+                        type=str, default=None,
+                        help='record the report as benchmark of registered'
+                        ' model NAME')
+
+    parser.add_argument('--models-dir', dest='models_dir', metavar='DIR',
+                        type=str, default=None, help='model registry')
+
+    parser.add_argument('dpath', type=str, metavar='PATH',
+                        help='training dataset')
+
+    args = parser.parse_args()
+
+    log_level = logging.INFO
+    if args.debug:
+        log_level = logging.DEBUG
+    setup_logger(logger, log_level)
+
+    report = benchmark(args.dpath,
+                       feature_sets=args.feature_sets or list(FEATURES_TBL.keys()),
+                       candidates=args.candidates or ['svc'],
+                       judgment=args.judgment,
+                       n_splits=args.n_splits, test_size=args.test_size,
+                       n_jobs=args.n_jobs, seed=args.seed)
+
+    if args.register:
+        from .model_registry import get_registry, MODELS_DIR
+        registry = get_registry(args.models_dir or MODELS_DIR)
+        registry.get(args.register).set_bench(report)
+
+    s = json.dumps(report, indent=2)
+
+    if args.outfile:
+        with open(args.outfile, 'w') as f:
+            f.write(s)
+        logger.info(f'report dumped into "{args.outfile}"')
+    else:
+        print(s)
+
+
+if __name__ == '__main__':
+    main()
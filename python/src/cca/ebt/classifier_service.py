@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+
+
+'''
+  A local service for loop classification
+
+  Copyright 2013-2018 RIKEN
+  Copyright 2018-2020 Chiba Institute of Technology
+
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+'''
+
+__author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
+
+import os
+import json
+import socket
+import socketserver
+import tempfile
+import numpy as np
+import logging
+
+from .make_loop_classifier import has_scaler
+from .classify_loops import load_classifier, predict_rows, get_row_features
+from .model_registry import MODELS_DIR, get_model
+
+logger = logging.getLogger()
+
+
+def get_sock_dir():
+    d = os.getenv('XDG_RUNTIME_DIR')
+    if d:
+        return os.path.join(d, 'ebt')
+    return os.path.join(tempfile.gettempdir(), f'ebt-{os.getuid()}')
+
+
+SOCK_PATH = os.getenv('EBT_CLASSIFIER_SOCK',
+                      os.path.join(get_sock_dir(), 'classifier.sock'))
+
+# Protocol: one JSON object per line in each direction.
+#
+#   request:  {"clf": NAME, "model": MODEL, "rows": [{METRIC: VALUE}]}
+#   response: {"pred": [LABEL]} or {"error": MESSAGE}
+#
+#   request:  {"clf": NAME, "model": MODEL, "path": METRICS_FILE,
+#              "filt": {METRIC: [LOWER, UPPER]}}
+#   response: {"kernels": {PROJ: {VER: [NID]}},
+#              "roots": {PROJ: {VER: [ROOT_FILE]}}, "rows": N}
+#              or {"error": MESSAGE}
+#
+# NAME is either a model registered in the MODELS_DIR of the server or the
+# absolute path of a classifier preloaded by the server. Other paths are
+# refused, since loading a pickle runs arbitrary code. MODEL selects the
+# features of a preloaded classifier; registered models use their own
+# schema. Bare estimators (without a scaler, like the shipped minami model)
+# only classify metrics files, which are scaled with their own statistics
+# as select_targets does.
+
+
+def make_sock_dir(d):
+    '''Creates d accessible only to the user, or checks that the existing d
+    is not owned by another user.
+    '''
+    try:
+        os.makedirs(d, mode=0o700)
+    except FileExistsError:
+        st = os.stat(d)
+        if st.st_uid not in (os.getuid(), 0):
+            raise RuntimeError(f'"{d}" is owned by another user')
+
+
+def load_preloaded(names, models_dir=MODELS_DIR):
+    '''Returns a table of absolute path -> classifier for the classifier
+    files among names. Other names are taken as registered models and only
+    loaded.
+    '''
+    clf_tbl = {}
+    for name in names:
+        if os.path.isfile(name):
+            path = os.path.abspath(name)
+            clf = load_classifier(path)
+            if not has_scaler(clf):
+                logger.warning(f'no scaler bundled with "{path}": only metrics'
+                               ' files can be classified')
+            clf_tbl[path] = clf
+        else:
+            model = get_model(name, root=models_dir)
+            model.estimator
+            if model.needs_file_scaling():
+                logger.warning(f'no scaler for "{name}": only metrics files'
+                               ' can be classified')
+    return clf_tbl
+
+
+def to_json_tbls(ptbl, rtbl):
+    roots = dict((proj, dict((ver, sorted(root_files))
+                             for (ver, root_files) in vtbl.items()))
+                 for (proj, vtbl) in rtbl.items())
+    return (ptbl, roots)
+
+
+def from_json_tbls(ptbl, roots):
+    rtbl = dict((proj, dict((ver, set(root_files))
+                            for (ver, root_files) in vtbl.items()))
+                for (proj, vtbl) in roots.items())
+    return (ptbl, rtbl)
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                req = json.loads(line)
+                model = req.get('model', 'minami')
+                if 'path' in req:
+                    filt = dict((k, tuple(v))
+                                for (k, v) in req.get('filt', {}).items())
+                    (ptbl, rtbl, nrows) = self.server.find_kernels(
+                        req['clf'], req['path'], model=model, filt=filt)
+                    (ptbl, roots) = to_json_tbls(ptbl, rtbl)
+                    res = {'kernels': ptbl, 'roots': roots, 'rows': nrows}
+                else:
+                    y_pred = self.server.predict(req['clf'],
+                                                 req.get('rows', []),
+                                                 model=model)
+                    res = {'pred': [str(y) for y in y_pred]}
+
+            except Exception as e:
+                logger.warning(str(e))
+                res = {'error': str(e)}
+
+            self.wfile.write(json.dumps(res).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, sock_path, clf_tbl={}, models_dir=MODELS_DIR):
+        self.clf_tbl = clf_tbl
+        self.models_dir = models_dir
+        super().__init__(sock_path, Handler)
+
+    def get_model(self, name):
+        try:
+            return get_model(name, root=self.models_dir)
+        except KeyError:
+            raise ValueError(f'unknown classifier: "{name}"')
+
+    def predict(self, name, rows, model='minami'):
+        clf = self.clf_tbl.get(name, None)
+        if clf is not None:
+            if not has_scaler(clf):
+                raise ValueError(f'no scaler for "{name}":'
+                                 ' classify a metrics file instead')
+            return predict_rows(clf, rows, model=model)
+
+        m = self.get_model(name)
+
+        if m.needs_file_scaling():
+            raise ValueError(f'no scaler for "{name}":'
+                             ' classify a metrics file instead')
+
+        (X, mask) = get_row_features(rows, selected=m.selected,
+                                     derived=m.derived)
+
+        y_pred = np.full(len(rows), '', dtype=object)
+
+        if mask.any():
+            y_pred[mask] = m.predict(X[mask])
+
+        return y_pred
+
+    def find_kernels(self, name, path, model='minami', filt={}):
+        '''Classifies the loops in the metrics file path (see
+        select_targets.find_kernels).
+        '''
+        from .select_targets import find_kernels
+
+        if name in self.clf_tbl:
+            clf = name
+        else:
+            clf = self.get_model(name)
+
+        return find_kernels(path, clf, model=model, filt=filt)
+
+
+def serve(sock_path=SOCK_PATH, preload=[], models_dir=MODELS_DIR):
+    clf_tbl = load_preloaded(preload, models_dir=models_dir)
+
+    make_sock_dir(os.path.dirname(os.path.abspath(sock_path)))
+
+    if os.path.exists(sock_path):
+        os.remove(sock_path)
+
+    umask = os.umask(0o177)
+    try:
+        server = Server(sock_path, clf_tbl, models_dir=models_dir)
+    finally:
+        os.umask(umask)
+
+    os.chmod(sock_path, 0o600)
+
+    with server:
+        logger.info(f'serving on "{sock_path}"...')
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(sock_path)
+
+
+class Client(object):
+    def __init__(self, sock_path=SOCK_PATH, timeout=None):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        self._sock.connect(sock_path)
+        self._rfile = self._sock.makefile('rb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _request(self, req):
+        name = req['clf']
+        if os.path.isfile(name):
+            req['clf'] = os.path.abspath(name)
+        self._sock.sendall(json.dumps(req).encode('utf-8') + b'\n')
+        line = self._rfile.readline()
+        if not line:
+            raise RuntimeError('no response')
+        res = json.loads(line)
+        if 'error' in res:
+            raise RuntimeError(res['error'])
+        return res
+
+    def predict(self, name, rows, model='minami'):
+        res = self._request({'clf': name, 'model': model, 'rows': rows})
+        return res['pred']
+
+    def find_kernels(self, name, path, model='minami', filt={}):
+        '''Returns (ptbl, rtbl, nrows) as select_targets.find_kernels does.
+        filt entries must be (lower, upper) pairs.
+        '''
+        req = {'clf': name, 'model': model, 'path': os.path.abspath(path),
+               'filt': dict((k, list(v)) for (k, v) in filt.items())}
+        res = self._request(req)
+        (ptbl, rtbl) = from_json_tbls(res['kernels'], res['roots'])
+        return (ptbl, rtbl, res['rows'])
+
+    def close(self):
+        self._rfile.close()
+        self._sock.close()
+
+
+def is_running(sock_path=SOCK_PATH):
+    b = False
+    try:
+        with Client(sock_path, timeout=1.0):
+            b = True
+    except Exception:
+        pass
+    return b
+
+
+def main():
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+    from cca.ccautil.common import setup_logger
+
+    parser = ArgumentParser(description='serve loop classifiers',
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-d', '--debug', dest='debug', action='store_true',
+                        help='enable debug printing')
+
+    parser.add_argument('-s', '--sock', dest='sock', metavar='PATH',
+                        type=str, default=SOCK_PATH, help='socket path')
+
+    parser.add_argument('-m', '--models-dir', dest='models_dir',
+                        metavar='DIR', type=str, default=MODELS_DIR,
+                        help='model registry')
+
+    parser.add_argument('clfs', nargs='*', default=[], metavar='CLF',
+                        type=str, help='classifier files or registered models'
+                        ' to be preloaded')
+
+    args = parser.parse_args()
+
+    log_level = logging.INFO
+    if args.debug:
+        log_level = logging.DEBUG
+    setup_logger(logger, log_level)
+
+    serve(args.sock, preload=args.clfs, models_dir=args.models_dir)
+
+
+if __name__ == '__main__':
+    main()
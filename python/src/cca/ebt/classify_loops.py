@@ -22,122 +22,341 @@
 
 __author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
 
+import os
 import csv
+from itertools import islice
 import numpy as np
-from sklearn import preprocessing as pp
 import joblib
 import logging
 
-from .make_loop_classifier import META, METRICS, fromstring, get_derived, Data
+from .make_loop_classifier import META, METRICS, Data, has_scaler
 from .make_loop_classifier import SELECTED_MINAMI, DERIVED_MINAMI
-from .make_loop_classifier import SELECTED_TERAI, DERIVED_TERAI
-from .make_loop_classifier import SELECTED_MIX, DERIVED_MIX
+from .make_loop_classifier import FEATURES_TBL
+from . import metrics_store
+from .metrics_store import DERIVED, calc_derived
 
 logger = logging.getLogger()
 
+CHUNK_SIZE = 65536
+
+CLF_CACHE = {}  # path -> (mtime * classifier)
+
+
+def load_classifier(clf_path, mmap_mode='r'):
+    '''Loads a dumped classifier once per process. Arrays of the classifier
+    are memory-mapped when mmap_mode is given, so that they are shared with
+    other processes loading the same file.
+    '''
+    path = os.path.abspath(clf_path)
+    mtime = os.path.getmtime(path)
+    try:
+        (mt, clf) = CLF_CACHE[path]
+        if mt == mtime:
+            return clf
+    except KeyError:
+        pass
+
+    logger.info(f'loading classifier from "{path}"...')
+    clf = joblib.load(path, mmap_mode=mmap_mode)
+    CLF_CACHE[path] = (mtime, clf)
+    return clf
+
+
+def to_float_array(col):
+    try:
+        a = np.array(col, dtype=np.float64)
+    except ValueError:
+        def conv(x):
+            try:
+                return float(x)
+            except ValueError:
+                return np.nan
+        a = np.fromiter((conv(x) for x in col), dtype=np.float64,
+                        count=len(col))
+    return a
+
+
+def iter_csv_chunks(path, chunk_size=CHUNK_SIZE, extra=[]):
+    '''Yields dicts of column name -> ndarray. METRICS (and DERIVED if
+    present) are parsed as float64, and META and extra columns (if present)
+    as str.
+    '''
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        head = next(reader)
+        idx_tbl = dict((k, i) for (i, k) in enumerate(head))
+
+        while True:
+            rows = list(islice(reader, chunk_size))
+            if not rows:
+                break
+
+            cols = list(zip(*rows))
+
+            chunk = {}
+            for k in METRICS + DERIVED:
+                try:
+                    chunk[k] = to_float_array(cols[idx_tbl[k]])
+                except KeyError:
+                    pass
+            for k in META:
+                try:
+                    chunk[k] = np.array(cols[idx_tbl[k]], dtype=str)
+                except KeyError:
+                    chunk[k] = np.full(len(rows), '', dtype=str)
+            for k in extra:
+                try:
+                    chunk[k] = np.array(cols[idx_tbl[k]], dtype=str)
+                except KeyError:
+                    pass
+
+            yield chunk
+
+
+def iter_metrics_chunks(path, chunk_size=CHUNK_SIZE, extra=[]):
+    (_, ext) = os.path.splitext(path)
+    if ext.lower() in metrics_store.WRITER_TBL and ext.lower() != '.csv':
+        for chunk in metrics_store.iter_chunks(path):
+            n = len(next(iter(chunk.values())))
+            for k in META:
+                if k not in chunk:
+                    chunk[k] = np.full(n, '', dtype=str)
+            yield chunk
+    else:
+        for chunk in iter_csv_chunks(path, chunk_size=chunk_size, extra=extra):
+            yield chunk
+
+
+def get_derived_column(k, chunk):
+    try:
+        return np.asarray(chunk[k], dtype=np.float64)
+    except KeyError:
+        return calc_derived(k, chunk)
+
+
+def get_filter_mask(col, f):
+    '''f is either (lower, upper) with exclusive bounds (None for
+    unbounded) or a predicate on a single value.
+    '''
+    if isinstance(f, tuple):
+        (lower, upper) = f
+        mask = np.ones(len(col), dtype=bool)
+        if lower is not None:
+            mask &= col > lower
+        if upper is not None:
+            mask &= col < upper
+    else:
+        mask = np.fromiter((bool(f(x)) for x in col), dtype=bool,
+                           count=len(col))
+    return mask
+
+
+def get_features(chunk, selected=SELECTED_MINAMI, derived=DERIVED_MINAMI,
+                 filt={}):
+    '''Returns the feature matrix of a chunk and the mask of rows that pass
+    filt and have finite features.
+    '''
+    cols = [chunk[k] for k in selected]
+    for k in derived:
+        v = get_derived_column(k, chunk)
+        chunk[k] = v
+        cols.append(v)
+
+    n = len(chunk[META[0]])
+
+    X = np.column_stack(cols) if cols else np.empty((n, 0))
+
+    mask = np.all(np.isfinite(X), axis=1)
+
+    for (k, f) in filt.items():
+        try:
+            col = chunk[k]
+        except KeyError:
+            continue
+        mask &= get_filter_mask(col, f)
+
+    return (X, mask)
+
+
+def iter_features(path, selected=SELECTED_MINAMI, derived=DERIVED_MINAMI,
+                  filt={}, chunk_size=CHUNK_SIZE):
+    '''Yields (X, meta) for each chunk, where meta is a dict of META
+    column -> ndarray of filtered rows.
+    '''
+    count = 0
+    for chunk in iter_metrics_chunks(path, chunk_size=chunk_size):
+        (X, mask) = get_features(chunk, selected=selected, derived=derived,
+                                 filt=filt)
+        meta = dict((k, chunk[k][mask]) for k in META)
+        count += int(mask.sum())
+        yield (X[mask], meta)
+
+    logger.info('%d rows' % count)
+
+
+def get_scaling_params(path, selected=SELECTED_MINAMI, derived=DERIVED_MINAMI,
+                       filt={}, chunk_size=CHUNK_SIZE):
+    '''Computes mean and standard deviation of the features over the whole
+    file in one streaming pass, equivalently to sklearn.preprocessing.scale.
+    '''
+    n = 0
+    s = None
+    ss = None
+    for (X, _) in iter_features(path, selected=selected, derived=derived,
+                                filt=filt, chunk_size=chunk_size):
+        if s is None:
+            s = np.zeros(X.shape[1])
+            ss = np.zeros(X.shape[1])
+        n += X.shape[0]
+        s += X.sum(axis=0)
+        ss += (X * X).sum(axis=0)
+
+    if n == 0:
+        return None
+
+    mean = s / n
+    var = np.maximum(ss / n - mean * mean, 0.)
+    std = np.sqrt(var)
+    std[std == 0.] = 1.
+
+    return (mean, std)
+
 
 def import_test_set(path,
                     selected=SELECTED_MINAMI,
                     derived=DERIVED_MINAMI,
-                    filt={}):
-    _X = []
+                    filt={},
+                    chunk_size=CHUNK_SIZE):
+    Xs = []
     meta = []
     try:
-        with open(path, newline='') as f:
-            reader = csv.DictReader(f)
+        for (X, m) in iter_features(path, selected=selected, derived=derived,
+                                    filt=filt, chunk_size=chunk_size):
+            Xs.append(X)
+            meta += [dict(zip(META, vs)) for vs in zip(*[m[k] for k in META])]
 
-            count = 0
+    except Exception as e:
+        logger.warning(str(e))
 
-            for row in reader:
+    if Xs:
+        X = np.concatenate(Xs)
+    else:
+        X = np.array([])
 
-                d = dict((k, fromstring(row[k])) for k in METRICS)
+    data = Data(X, None, meta)
 
-                skip = False
+    return data
 
-                for k0, f in filt.items():
-                    v0 = d[k0]
-                    b0 = f(v0)
-                    sub = row['sub']
-                    logger.debug(f'k0={k0} d[k0]={v0} f(d[k0])={b0} sub={sub}')
-                    if not b0:
-                        skip = True
 
-                x = [d[k] for k in selected]
+def get_model_features(model):
+    try:
+        return FEATURES_TBL[model]
+    except KeyError:
+        logger.warning(f'"{model}" is not supported. using default model')
+        return (SELECTED_MINAMI, DERIVED_MINAMI)
 
-                for k in derived:
-                    v = get_derived(k, d)
 
-                    try:
-                        f = filt[k]
-                        if not f(v):
-                            skip = True
-                    except Exception:
-                        pass
+def iter_classified(path, clf_path, model='minami', filt={},
+                    chunk_size=CHUNK_SIZE):
+    '''Classifies loops chunk by chunk. Yields (y_pred, meta) for each chunk,
+    where meta is a dict of META column -> ndarray.
+    '''
+    clf = load_classifier(clf_path)
 
-                    x.append(v)
+    (selected, derived) = get_model_features(model)
 
-                logger.debug('skip=%s' % skip)
-                if skip:
-                    continue
+    if has_scaler(clf):
+        scale = None
 
-                m = dict((k, row[k]) for k in META)
+    else:  # bare estimator: scale with the statistics of the whole file
+        logger.warning(f'no scaler bundled with "{clf_path}"')
+        params = get_scaling_params(path, selected=selected, derived=derived,
+                                    filt=filt, chunk_size=chunk_size)
+        if params is None:
+            return
 
-                _X.append(x)
-                meta.append(m)
+        (mean, std) = params
 
-                count += 1
+        def scale(X):
+            return (X - mean) / std
 
-            logger.info('%d rows' % count)
+    for (X, meta) in iter_features(path, selected=selected, derived=derived,
+                                   filt=filt, chunk_size=chunk_size):
+        if len(X) > 0:
+            if scale:
+                X = scale(X)
+            y_pred = clf.predict(X)
+            yield (y_pred, meta)
 
-    except Exception as e:
-        logger.warning(str(e))
 
-    X = np.array(_X)
+def get_row_features(rows, selected=SELECTED_MINAMI, derived=DERIVED_MINAMI):
+    '''Returns the feature matrix of loops given as a list of metrics tables
+    (name -> value) and the mask of rows with finite features.
+    '''
+    chunk = dict((k, to_float_array([r.get(k, '') for r in rows]))
+                 for k in METRICS)
+    chunk[META[0]] = np.full(len(rows), '', dtype=str)
 
-    data = Data(X, None, meta)
+    return get_features(chunk, selected=selected, derived=derived)
 
-    return data
 
+def predict_rows(clf, rows, model='minami'):
+    '''Classifies loops given as a list of metrics tables (name -> value).
+    Requires a classifier bundled with its scaler, since a handful of rows
+    gives no usable statistics for scaling. Loops that cannot be classified
+    are labeled ''.
+    '''
+    if not has_scaler(clf):
+        raise ValueError('classifier without scaler')
 
-def classify(path, clf_path, model='minami', filt={}, verbose=True):
+    (selected, derived) = get_model_features(model)
 
-    clf = joblib.load(clf_path)
+    (X, mask) = get_row_features(rows, selected=selected, derived=derived)
 
-    selected = SELECTED_MINAMI
-    derived = DERIVED_MINAMI
+    y_pred = np.full(len(rows), '', dtype=object)
 
-    if model == 'minami':
-        selected = SELECTED_MINAMI
-        derived = DERIVED_MINAMI
+    X = X[mask]
 
-    elif model == 'terai':
-        selected = SELECTED_TERAI
-        derived = DERIVED_TERAI
+    if len(X) > 0:
+        y_pred[mask] = clf.predict(X)
 
-    elif model == 'mix':
-        selected = SELECTED_MIX
-        derived = DERIVED_MIX
-    else:
-        logger.warning(f'"{model}" is not supported. using default model')
+    return y_pred
 
-    data = import_test_set(path, selected=selected, derived=derived, filt=filt)
 
-    data_pred = None
+def predict_loop(clf, mtbl, model='minami'):
+    '''Classifies a single loop given its metrics (name -> value).
+    Requires a classifier bundled with its scaler.
+    '''
+    return predict_rows(clf, [mtbl], model=model)[0]
+
 
-    if len(data.X) > 0:
+def classify(path, clf_path, model='minami', filt={}, verbose=True,
+             chunk_size=CHUNK_SIZE):
+
+    ys = []
+    meta = []
 
-        X = pp.scale(data.X)
+    try:
+        for (y_pred, m) in iter_classified(path, clf_path, model=model,
+                                           filt=filt, chunk_size=chunk_size):
+            ms = [dict(zip(META, vs)) for vs in zip(*[m[k] for k in META])]
+            ys.append(y_pred)
+            meta += ms
+
+            if verbose:
+                for i in range(len(y_pred)):
+                    m_ = ms[i]
+                    m_['pred'] = y_pred[i]
+                    print('[{proj}][{ver}][{path}:{lnum}][{sub}] --> {pred}'.format(**m_))
+                    logger.info('[{proj}][{ver}][{path}:{lnum}][{sub}] --> {pred}'.format(**m_))
 
-        y_pred = clf.predict(X)
+    except Exception as e:
+        logger.warning(str(e))
 
-        data_pred = Data(X, y_pred, data.meta)
+    data_pred = None
 
-        if verbose:
-            for i in range(len(y_pred)):
-                m = data.meta[i]
-                m['pred'] = y_pred[i]
-                print('[{proj}][{ver}][{path}:{lnum}][{sub}] --> {pred}'.format(**m))
-                logger.info('[{proj}][{ver}][{path}:{lnum}][{sub}] --> {pred}'.format(**m))
+    if ys:
+        data_pred = Data(None, np.concatenate(ys), meta)
 
     return data_pred
 
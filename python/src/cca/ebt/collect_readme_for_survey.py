@@ -31,6 +31,7 @@ import logging
 from .outline_for_survey_base import gen_conf, gen_conf_a, GIT_REPO_BASE
 from .outline_for_survey_base import ensure_dir
 from .sourcecode_metrics_for_survey_base import get_proj_list
+from .analyze_topic import iter_files
 
 from cca.ccautil import project
 from cca.ccautil.siteconf import PROJECTS_DIR
@@ -60,19 +61,26 @@ class Collector(object):
             self._conf = conf
 
     def from_dir(self):
+        '''Shares the listing of the project directory with the topic
+        search (see analyze_topic.list_files). Files reached through links
+        pointing outside of the project directory are dropped.
+        '''
         projs_path = os.path.abspath(PROJECTS_DIR)
         projs_loc = os.path.dirname(projs_path)
         proj_dir = os.path.join(projs_path, self._proj_id)
+        real_proj_dir = os.path.realpath(proj_dir)
         li = []
-        for (dpath, dns, fns) in os.walk(proj_dir):
-            for fn in fns:
-                m = README_PAT.match(fn)
-                if m:
-                    p = os.path.join(dpath, fn)
-                    rpath = re.sub(r'^%s' % proj_dir, '', p).lstrip(os.sep)
-                    path = re.sub(r'^%s' % projs_loc, '', p).lstrip(os.sep)
-                    url = 'getsrc?%s' % urlencode({'path': path})
-                    li.append({'url': url, 'path': rpath})
+        for (p, fn) in iter_files(proj_dir):
+            m = README_PAT.match(fn)
+            if m:
+                real_p = os.path.realpath(p)
+                if os.path.commonpath([real_proj_dir, real_p]) != real_proj_dir:
+                    logger.warning(f'outside of project: "{p}"')
+                    continue
+                rpath = os.path.relpath(p, proj_dir)
+                path = os.path.relpath(p, projs_loc)
+                url = 'getsrc?%s' % urlencode({'path': path})
+                li.append({'url': url, 'path': rpath})
 
         return li
 
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+'''
+  Weights of intrinsic function calls in FP operations
+
+  Copyright 2013-2018 RIKEN
+  Copyright 2018-2020 Chiba Institute of Technology
+
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+'''
+
+__author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
+
+import os
+import json
+import numpy as np
+import logging
+
+logger = logging.getLogger()
+
+FOP_TBL = {  # number of FP operations (for SPARC64 VIIIfx)
+    'nint':  2,
+    'jnint': 2,
+    'cos':   29,
+    'dcos':  31,
+    'exp':   19,
+    'dexp':  23,
+    'log':   19,
+    'alog':  19,
+    'dlog':  23,
+    'mod':   8,
+    'amod':  8,
+    'dmod':  8,
+    'sign':  2,
+    'dsign': 2,
+    'sin':   29,
+    'dsin':  31,
+    'sqrt':  11,
+    'dsqrt': 21,
+    'tan':   58,
+    'dtan':  64,
+}
+
+FOP_TBL_DBL_EXTRA = {
+    'cos':  2,
+    'exp':  4,
+    'log':  4,
+    'sin':  2,
+    'sqrt': 10,
+    'tan':  6,
+}
+
+FOP_TBL_VA = {  # name -> (a, b) for a*nargs+b
+    'max':   (1, -1),
+    'amax1': (1, -1),
+    'dmax1': (1, -1),
+    'min':   (1, -1),
+    'amin1': (1, -1),
+    'dmin1': (1, -1),
+}
+
+DEFAULT_NFOP = 1
+
+###
+
+
+def to_number(v):
+    '''Returns v as an int if it is integral, otherwise as a float.'''
+    v = float(v)
+    if v.is_integer():
+        return int(v)
+    return v
+
+
+class FopWeightTable(object):
+    '''Maps (intrinsic name, number of arguments, precision) to the number
+    of FP operations. Names are interned to ids; id 0 stands for unknown
+    names, which weigh DEFAULT_NFOP. Weights may be fractional.
+    '''
+    def __init__(self, fop_tbl, fop_tbl_dbl_extra=None, fop_tbl_va=None,
+                 default=DEFAULT_NFOP):
+
+        if fop_tbl_dbl_extra is None:
+            fop_tbl_dbl_extra = {}
+        if fop_tbl_va is None:
+            fop_tbl_va = {}
+
+        names = sorted(set(fop_tbl) | set(fop_tbl_dbl_extra) | set(fop_tbl_va))
+
+        self._id_tbl = dict((n, i + 1) for (i, n) in enumerate(names))
+
+        sz = len(names) + 1
+
+        self._single = np.full(sz, default, dtype=np.float64)
+        self._double = np.full(sz, default, dtype=np.float64)
+        self._is_va = np.zeros(sz, dtype=bool)
+        self._va_a = np.zeros(sz, dtype=np.float64)
+        self._va_b = np.zeros(sz, dtype=np.float64)
+
+        for (n, i) in self._id_tbl.items():
+            s = fop_tbl.get(n, default)
+            self._single[i] = s
+            self._double[i] = s + fop_tbl_dbl_extra.get(n, 0)
+            try:
+                (a, b) = fop_tbl_va[n]
+                self._is_va[i] = True
+                self._va_a[i] = a
+                self._va_b[i] = b
+            except KeyError:
+                pass
+
+    def get_id(self, name):
+        return self._id_tbl.get(name, 0)
+
+    def weights(self, ids, nargs, double):
+        ids = np.asarray(ids, dtype=np.int64)
+        nargs = np.asarray(nargs, dtype=np.int64)
+        double = np.asarray(double, dtype=bool)
+        w = np.where(double, self._double[ids], self._single[ids])
+        va = self._va_a[ids] * nargs + self._va_b[ids]
+        return np.where(self._is_va[ids], va, w)
+
+    def get_nfops(self, name, nargs, double=False):
+        i = self.get_id(name)
+        if self._is_va[i]:
+            return to_number(self._va_a[i] * nargs + self._va_b[i])
+        if double:
+            return to_number(self._double[i])
+        return to_number(self._single[i])
+
+    def calc_nfops(self, refs):
+        '''Sums up the weights of function references given as an iterable
+        of (key, name, nargs, is_dbl). Returns a dict: key -> nfop.
+        '''
+        keys = []
+        ids = []
+        nargs = []
+        double = []
+        for (k, n, na, dbl) in refs:
+            keys.append(k)
+            ids.append(self.get_id(n))
+            nargs.append(int(na))
+            double.append(dbl)
+
+        if not keys:
+            return {}
+
+        w = self.weights(ids, nargs, double)
+
+        (ukeys, inv) = np.unique(np.asarray(keys), return_inverse=True)
+        sums = np.bincount(inv, weights=w, minlength=len(ukeys))
+
+        return dict((k.item(), to_number(v)) for (k, v) in zip(ukeys, sums))
+
+
+def from_json(path):
+    '''Loads a table from a JSON object with "fop", "fop_dbl_extra" and
+    "fop_va" (name -> [a, b]) entries.
+    '''
+    with open(path) as f:
+        d = json.load(f)
+
+    fop_va = dict((n, tuple(ab)) for (n, ab) in d.get('fop_va', {}).items())
+
+    return FopWeightTable(d.get('fop', {}),
+                          fop_tbl_dbl_extra=d.get('fop_dbl_extra', {}),
+                          fop_tbl_va=fop_va,
+                          default=d.get('default', DEFAULT_NFOP))
+
+
+SPARC64_VIIIFX = FopWeightTable(FOP_TBL, fop_tbl_dbl_extra=FOP_TBL_DBL_EXTRA,
+                                fop_tbl_va=FOP_TBL_VA)
+
+DEFAULT_ARCH = 'sparc64viiifx'
+
+ARCH_TBL = {
+    DEFAULT_ARCH: SPARC64_VIIIFX,
+}
+
+
+def register_arch(name, tbl):
+    ARCH_TBL[name] = tbl
+
+
+def get_arch(name=DEFAULT_ARCH):
+    '''Returns the table registered as name, or loads it from a JSON file.
+    '''
+    try:
+        tbl = ARCH_TBL[name]
+    except KeyError:
+        if os.path.exists(name):
+            tbl = from_json(name)
+            register_arch(name, tbl)
+        else:
+            raise ValueError(f'unknown architecture: "{name}"')
+    return tbl
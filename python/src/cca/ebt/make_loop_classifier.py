@@ -24,12 +24,15 @@ __author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
 
 import os
 import csv
+import json
+from time import time
 import numpy as np
 # import scipy as sp
 from sklearn.neighbors import KNeighborsClassifier
 # from sklearn.neighbors import RadiusNeighborsClassifier
 from sklearn.svm import SVC
-# from sklearn.svm import LinearSVC
+from sklearn.svm import LinearSVC
+from sklearn.kernel_approximation import Nystroem, RBFSampler
 # from sklearn.svm import NuSVC
 # from sklearn.naive_bayes import GaussianNB, MultinomialNB, BernoulliNB
 # from sklearn.ensemble import RandomForestClassifier
@@ -42,9 +45,13 @@ from sklearn.svm import SVC
 from sklearn.metrics import (accuracy_score, precision_score, recall_score,
                              f1_score)
 from sklearn import preprocessing as pp
+from sklearn.pipeline import Pipeline
+from sklearn.model_selection import train_test_split
 import joblib
 import logging
 
+from .metrics_store import calc_derived
+
 logger = logging.getLogger()
 
 META = [
@@ -63,8 +70,6 @@ JUDGMENTS = ['judgment_M',
              # 'judgment_X',
              ]
 
-N_JUDGMENTS = len(JUDGMENTS)
-
 METRICS = [
     'max_array_rank',
     'max_loop_level',
@@ -108,21 +113,6 @@ DERIVED = [
 ]
 
 
-def rate(x, y):
-    return float(x) / float(y)
-
-
-DERIVED_F_TBL = {
-    'br_rate':         rate,
-    'ind_aref_rate0':  rate,
-    'array_rank_rate': rate,
-}
-DERIVED_A_TBL = {
-    'br_rate':         ('branches', 'stmts'),
-    'ind_aref_rate0':  ('indirect_array_refs0', 'array_refs0'),
-    'array_rank_rate': ('max_array_rank', 7.),
-}
-
 ###
 
 # SELECTED_MINAMI = [  # CA=.832,P=.837056,R=.971948,F1=.894753
@@ -170,19 +160,13 @@ SELECTED_MIX = [
 ]
 DERIVED_MIX = []
 
-###
-
+FEATURES_TBL = {  # model -> (selected, derived)
+    'minami': (SELECTED_MINAMI, DERIVED_MINAMI),
+    'terai':  (SELECTED_TERAI, DERIVED_TERAI),
+    'mix':    (SELECTED_MIX, DERIVED_MIX),
+}
 
-def fromstring(s):
-    x = s
-    try:
-        x = int(s)
-    except Exception:
-        try:
-            x = float(s)
-        except Exception:
-            pass
-    return x
+###
 
 
 class Data(object):
@@ -192,51 +176,69 @@ class Data(object):
         self.meta = meta
 
 
-def get_derived(k, d):
-    f = DERIVED_F_TBL[k]
-    args = (d.get(a, a) for a in DERIVED_A_TBL[k])
-    return f(*args)
+def make_pipeline(clf):
+    '''Bundles clf with a scaler fitted on the training set, so that
+    predictions do not depend on the batch they are made in.
+    '''
+    return Pipeline([('scaler', pp.StandardScaler()), ('clf', clf)])
+
+
+def has_scaler(clf):
+    return isinstance(clf, Pipeline) and 'scaler' in clf.named_steps
+
+
+def get_feature_matrix(cols, selected, derived):
+    '''Stacks the selected and derived feature columns of a dict of column
+    name -> array. Derived features already in cols (as stored in metrics
+    snapshots) are used as they are.
+    '''
+    fcols = [np.asarray(cols[k], dtype=np.float64) for k in selected]
+    for k in derived:
+        if k in cols:
+            fcols.append(np.asarray(cols[k], dtype=np.float64))
+        else:
+            fcols.append(calc_derived(k, cols))
+    n = len(cols[META[0]]) if META[0] in cols else len(fcols[0])
+    return np.column_stack(fcols) if fcols else np.empty((n, 0))
 
 
 def import_training_set(path, selected=SELECTED, derived=DERIVED):
-    _Xs = [[] for _ in JUDGMENTS]
-    _ys = [[] for _ in JUDGMENTS]
-    metas = [[] for _ in JUDGMENTS]
+    cols = {}
     try:
         with open(path, newline='') as f:
             reader = csv.DictReader(f)
 
-            count = 0
+            names = [k for k in METRICS + derived + META + JUDGMENTS
+                     if k in reader.fieldnames]
+            for k in names:
+                cols[k] = []
 
             for row in reader:
-                count += 1
-                cs = [row[j] for j in JUDGMENTS]
-                d = dict((k, fromstring(row[k])) for k in METRICS)
-                x = [d[k] for k in selected]
-
-                for k in derived:
-                    x.append(get_derived(k, d))
-
-                meta = dict((k, row[k]) for k in META)
+                for k in names:
+                    cols[k].append(row[k])
 
-                for i in range(N_JUDGMENTS):
-                    c = cs[i]
-                    if c != 'Ignored':
-                        _Xs[i].append(x)
-                        _ys[i].append(c)
-                        metas[i].append(meta)
+            logger.info('%d rows' % len(cols[names[0]]))
 
-            logger.info('%d rows' % count)
+    except Exception as e:
+        logger.warning(str(e))
 
+    try:
+        for k in METRICS + derived:
+            if k in cols:
+                cols[k] = np.array(cols[k], dtype=np.float64)
+        X = get_feature_matrix(cols, selected, derived)
+        metas = [dict((k, cols[k][i]) for k in META) for i in range(len(X))]
     except Exception as e:
         logger.warning(str(e))
+        X = np.empty((0, len(selected) + len(derived)))
+        metas = []
 
     data = []
-    for i in range(N_JUDGMENTS):
-        X = np.array(_Xs[i])
-        y = np.array(_ys[i])
-        meta = metas[i]
-        data.append(Data(X, y, meta))
+    for j in JUDGMENTS:
+        y = np.array(cols.get(j, ['Ignored'] * len(X)), dtype=str)
+        mask = y != 'Ignored'
+        meta = [m for (m, b) in zip(metas, mask) if b]
+        data.append(Data(X[mask], y[mask], meta))
 
     return data
 
@@ -246,34 +248,122 @@ def makeMinamiClassifier(path):
                                   derived=DERIVED_MINAMI)
     data = dataset[0]
     logger.info('shape=%s |y|=%d' % (data.X.shape, len(data.y)))
-    clf = SVC(C=32., kernel='rbf', gamma=8.)
-    X = pp.scale(data.X)
-    clf.fit(X, data.y)
+    clf = make_pipeline(SVC(C=32., kernel='rbf', gamma=8.))
+    clf.fit(data.X, data.y)
     return clf
 
 
 def makeTeraiClassifier(path):
     dataset = import_training_set(path, selected=SELECTED_TERAI,
                                   derived=DERIVED_TERAI)
-    data = dataset[1]
+    data = dataset[0]
     logger.info('shape=%s |y|=%d' % (data.X.shape, len(data.y)))
-    clf = KNeighborsClassifier(6, weights='distance', metric='hamming')
-    X = pp.scale(data.X)
-    clf.fit(X, data.y)
+    clf = make_pipeline(KNeighborsClassifier(6, weights='distance', metric='hamming'))
+    clf.fit(data.X, data.y)
     return clf
 
 
 def makeMixClassifier(path):
     dataset = import_training_set(path, selected=SELECTED_MIX,
                                   derived=DERIVED_MIX)
-    data = dataset[2]
+    data = dataset[0]
     logger.info('shape=%s |y|=%d' % (data.X.shape, len(data.y)))
-    clf = SVC(C=32., kernel='rbf', gamma=8.)
-    X = pp.scale(data.X)
-    clf.fit(X, data.y)
+    clf = make_pipeline(SVC(C=32., kernel='rbf', gamma=8.))
+    clf.fit(data.X, data.y)
     return clf
 
 
+APPROX_TBL = {
+    'nystroem': Nystroem,
+    'rff':      RBFSampler,
+}
+
+N_COMPONENTS = 300
+
+
+def make_approx_pipeline(C=32., gamma=8., approx='nystroem',
+                         n_components=N_COMPONENTS, random_state=0):
+    '''Approximates SVC(kernel='rbf') by an explicit feature map (Nystroem
+    or random Fourier features) followed by a linear SVM, whose prediction
+    cost does not grow with the number of support vectors.
+    '''
+    fmap = APPROX_TBL[approx](gamma=gamma, n_components=n_components,
+                              random_state=random_state)
+    return Pipeline([('scaler', pp.StandardScaler()),
+                     ('fmap', fmap),
+                     ('clf', LinearSVC(C=C, max_iter=10000))])
+
+
+def makeFastMinamiClassifier(path, approx='nystroem',
+                             n_components=N_COMPONENTS):
+    dataset = import_training_set(path, selected=SELECTED_MINAMI,
+                                  derived=DERIVED_MINAMI)
+    data = dataset[0]
+    logger.info('shape=%s |y|=%d' % (data.X.shape, len(data.y)))
+    n_components = min(n_components, len(data.y))
+    clf = make_approx_pipeline(C=32., gamma=8., approx=approx,
+                               n_components=n_components)
+    clf.fit(data.X, data.y)
+    return clf
+
+
+def measure(clf, X, y):
+    st = time()
+    y_pred = clf.predict(X)
+    t = time() - st
+    return {
+        'accuracy':   accuracy_score(y, y_pred),
+        'precision':  precision_score(y, y_pred, pos_label='Kernel'),
+        'recall':     recall_score(y, y_pred, pos_label='Kernel'),
+        'f1':         f1_score(y, y_pred, pos_label='Kernel'),
+        'predict_time': t,
+        'rows_per_sec': len(y) / t if t > 0 else float('inf'),
+    }, y_pred
+
+
+def compare_approx(path, approx='nystroem', n_components=N_COMPONENTS,
+                   test_size=0.2, nrepeat=1, random_state=0):
+    '''Fits the exact RBF SVC and its approximation on the same training
+    split and reports accuracy and throughput of both on the test split.
+    Test rows are repeated nrepeat times for throughput measurement.
+    '''
+    dataset = import_training_set(path, selected=SELECTED_MINAMI,
+                                  derived=DERIVED_MINAMI)
+    data = dataset[0]
+
+    (X_train, X_test, y_train, y_test) = \
+        train_test_split(data.X, data.y, test_size=test_size,
+                         random_state=random_state, stratify=data.y)
+
+    X_test = np.tile(X_test, (nrepeat, 1))
+    y_test = np.tile(y_test, nrepeat)
+
+    n_components = min(n_components, len(y_train))
+
+    report = {'train_size': len(y_train), 'test_size': len(y_test)}
+
+    exact = make_pipeline(SVC(C=32., kernel='rbf', gamma=8.))
+    fast = make_approx_pipeline(approx=approx, n_components=n_components,
+                                random_state=random_state)
+
+    for (name, clf) in (('exact', exact), (approx, fast)):
+        st = time()
+        clf.fit(X_train, y_train)
+        t = time() - st
+        (r, y_pred) = measure(clf, X_test, y_test)
+        r['fit_time'] = t
+        report[name] = r
+        if name == 'exact':
+            y_exact = y_pred
+        else:
+            r['agreement'] = float(np.mean(y_pred == y_exact))
+
+    report['n_support_vectors'] = int(exact.named_steps['clf'].n_support_.sum())
+    report['n_components'] = n_components
+
+    return report
+
+
 def dump_classifier(clf, path):
     logger.info('dumping classifier into "%s"' % path)
     joblib.dump(clf, path)
@@ -296,14 +386,47 @@ def main():
                         type=str, default='a.pkl',
                         help='dump result into PATH')
 
+    parser.add_argument('-a', '--approx', dest='approx', metavar='METHOD',
+                        type=str, default=None, choices=list(APPROX_TBL.keys()),
+                        help='approximate the RBF kernel of the minami model')
+
+    parser.add_argument('-n', '--n-components', dest='n_components',
+                        metavar='N', type=int, default=N_COMPONENTS,
+                        help='number of components of the kernel approximation')
+
+    parser.add_argument('--compare', dest='compare', action='store_true',
+                        help='compare approximation with the exact SVC')
+
+    parser.add_argument('-r', '--register', dest='register', metavar='NAME',
+                        type=str, default=None,
+                        help='register the classifier as NAME in the model'
+                        ' registry instead of dumping it into PATH')
+
+    parser.add_argument('--models-dir', dest='models_dir', metavar='DIR',
+                        type=str, default=None, help='model registry')
+
     parser.add_argument('dpath', metavar='PATH', type=str,
                         help='training dataset')
 
     args = parser.parse_args()
 
+    if args.approx and args.model != 'minami':
+        parser.error('approximation is only supported for minami model')
+
+    if args.compare:
+        report = compare_approx(os.path.abspath(args.dpath),
+                                approx=args.approx or 'nystroem',
+                                n_components=args.n_components)
+        print(json.dumps(report, indent=2))
+        return
+
     mkclf = makeMinamiClassifier
+    kwargs = {}
 
-    if args.model == 'minami':
+    if args.approx:
+        mkclf = makeFastMinamiClassifier
+        kwargs = {'approx': args.approx, 'n_components': args.n_components}
+    elif args.model == 'minami':
         mkclf = makeMinamiClassifier
     elif args.model == 'terai':
         mkclf = makeTeraiClassifier
@@ -312,9 +435,15 @@ def main():
     else:
         logger.warning('"%s" is not supported. using default model' % args.model)
 
-    clf = mkclf(os.path.abspath(args.dpath))
+    clf = mkclf(os.path.abspath(args.dpath), **kwargs)
 
-    dump_classifier(clf, os.path.abspath(args.outfile))
+    if args.register:
+        from .model_registry import get_registry, MODELS_DIR
+        (selected, derived) = FEATURES_TBL.get(args.model, FEATURES_TBL['minami'])
+        registry = get_registry(args.models_dir or MODELS_DIR)
+        registry.save(args.register, clf, selected, derived)
+    else:
+        dump_classifier(clf, os.path.abspath(args.outfile))
 
 
 # judgment_X:
@@ -332,126 +461,8 @@ def main():
 # Mean recall   : 0.973127
 # Mean F1       : 0.901993
 
-def test():
-    dataset = import_training_set('survey-outline/training_set_k4.csv',
-                                  selected=SELECTED_MINAMI,
-                                  derived=DERIVED_MINAMI)
-
-    # Classifiers
-
-    # clf = SVC()
-    # params = {
-    #     'C': sp.stats.expon(scale=100),
-    #     'gamma': sp.stats.expon(scale=.1),
-    #     'kernel': ['rbf'],
-    #     'class_weight': ['balanced', None],
-    # }
-
-    # clf = RandomForestClassifier(n_estimators=20)
-    # params = {
-    #     'max_depth': [3, None],
-    #     'max_features'     : sp.stats.randint(1, 11),
-    #     'min_samples_split': sp.stats.randint(1, 11),
-    #     'min_samples_leaf' : sp.stats.randint(1, 11),
-    #     'bootstrap': [True, False],
-    #     'criterion': ['gini', 'entropy'],
-    # }
-
-    # clf = model_selection.RandomizedSearchCV(clf, params, n_iter=20)
-
-    # clf = KNeighborsClassifier(9, weights='distance', metric='hamming')
-    clf = SVC(C=32., kernel='rbf', gamma=8.)
-    # clf = SVC(C=2., kernel='rbf', gamma=8.)
-    # clf = AdaBoostClassifier(n_estimators=15)
-    # clf = SVC(C=512., kernel='rbf', gamma=0.125)
-    # clf = KNeighborsClassifier(6, weights='distance', metric='hamming')
-
-    T = 10
-
-    np.random.seed(0)
-
-    data = dataset[0]  # Minami
-    # data = dataset[1] # Terai
-    # data = dataset[2] # Merged
-
-    logger.info('shape=%s |y|=%d' % (data.X.shape, len(data.y)))
-
-    X = data.X
-
-    # Preprocessing
-
-    X = pp.scale(X)
-
-    # scaler = pp.MinMaxScaler()
-    # X = scaler.fit_transform(X)
-
-    # Feature Selection
-
-    # X = SelectKBest(f_classif, k=2).fit_transform(X, data.y)
-
-    # c = ExtraTreesClassifier()
-    # c = c.fit(X, data.y)
-    # model = SelectFromModel(c, prefit=True)
-    # X = model.transform(X)
-
-    # lsvc = LinearSVC(C=0.01, penalty="l1", dual=False).fit(X, data.y)
-    # model = SelectFromModel(lsvc, prefit=True)
-    # X = model.transform(X)
-
-    logger.info('shape=%s' % (X.shape,))
-
-    # Evaluation
-
-    N = 100
-
-    accs = 0.
-    precs = 0.
-    recs = 0.
-    f1s = 0.
-
-    for n in range(N):
-
-        indices = np.random.permutation(len(X))
-
-        X_train = X[indices[:-T]]
-        y_train = data.y[indices[:-T]]
-
-        X_test = X[indices[-T:]]
-        y_test = data.y[indices[-T:]]
-
-        clf.fit(X_train, y_train)
-
-        # print(clf.best_estimator_)
-
-        y_pred = clf.predict(X_test)
-
-        print('Predicted: %s' % y_pred)
-        print('Actual   : %s' % y_test)
-
-        acc = accuracy_score(y_test, y_pred)
-        prec = precision_score(y_test, y_pred, pos_label='Kernel')
-        rec = recall_score(y_test, y_pred, pos_label='Kernel')
-        f1 = f1_score(y_test, y_pred, pos_label='Kernel')
-
-        accs += acc
-        precs += prec
-        recs += rec
-        f1s += f1
-
-        print('[%d]' % n)
-        print('  Accuracy : %f' % acc)
-        print('  Precision: %f' % prec)
-        print('  Recall   : %f' % rec)
-        print('  F1       : %f' % f1)
-
-    print
-    b = float(N)
-    print('Mean accuracy : %f' % (accs/b))
-    print('Mean precision: %f' % (precs/b))
-    print('Mean recall   : %f' % (recs/b))
-    print('Mean F1       : %f' % (f1s/b))
+# see bench_loop_classifiers for evaluation
 
 
 if __name__ == '__main__':
-    # test()
     main()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+'''
+  Columnar storage of source code metrics
+
+  Copyright 2013-2018 RIKEN
+  Copyright 2018-2020 Chiba Institute of Technology
+
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+'''
+
+__author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
+
+import os
+import csv
+import glob
+import numpy as np
+import logging
+
+logger = logging.getLogger()
+
+CHUNK_SIZE = 65536
+
+NPZ_CHUNK_FMT = '{}.{:05d}.npz'
+NPZ_CHUNK_PAT = '.[0-9][0-9][0-9][0-9][0-9].npz'
+
+DERIVED_A_TBL = {  # name -> (numerator, denominator)
+    'br_rate':         ('branches', 'stmts'),
+    'ind_aref_rate0':  ('indirect_array_refs0', 'array_refs0'),
+    'array_rank_rate': ('max_array_rank', 7.),
+}
+
+DERIVED = list(DERIVED_A_TBL.keys())
+
+###
+
+
+def rate(x, y):
+    '''Element-wise x / y, which is 0 where y is 0.'''
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    (x, y) = np.broadcast_arrays(x, y)
+    return np.divide(x, y, out=np.zeros(x.shape), where=y != 0)
+
+
+def calc_derived(k, cols):
+    '''Computes derived feature k from a dict of column name -> array.
+    Constant arguments are given as numbers in DERIVED_A_TBL.
+    '''
+    args = [a if isinstance(a, float) else cols[a] for a in DERIVED_A_TBL[k]]
+    return rate(*args)
+
+
+def get_derived_items(items):
+    '''Returns the derived features computable from items.'''
+    return [k for k in DERIVED if k not in items and
+            all(isinstance(a, float) or a in items for a in DERIVED_A_TBL[k])]
+
+
+def ensure_parent_dir(path):
+    d = os.path.dirname(path)
+    if d and not os.path.exists(d):
+        os.makedirs(d)
+
+
+def get_npz_chunk_paths(path):
+    (base, _) = os.path.splitext(path)
+    return sorted(glob.glob(glob.escape(base) + NPZ_CHUNK_PAT))
+
+
+class WriterBase(object):
+    '''Buffers feature tables column by column and flushes them in chunks.
+    Columns are META_KEYS followed by the metrics found in the first table.
+    Metrics are stored as float64, since a metric that is integral in the
+    first table (e.g. fp_ops with fractional FOP weights) may not be in later
+    ones, and the schema of a store is fixed by its first chunk.
+    '''
+    def __init__(self, outfile, META_KEYS, chunk_size=CHUNK_SIZE):
+        self._outfile = outfile
+        self._meta_keys = list(META_KEYS)
+        self._chunk_size = chunk_size
+        self._items = None
+        self._derived = None
+        self._cols = None
+        self._nbuffered = 0
+        self.count = 0
+        self.nchunks = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get_columns(self):
+        return self._meta_keys + self._items + self._derived
+
+    def _setup(self, ftbl):
+        self._items = [k for k in ftbl.keys() if k != 'meta']
+        self._derived = get_derived_items(self._items)
+        self._reset()
+
+    def _reset(self):
+        self._cols = dict((k, []) for k in self.get_columns())
+        self._nbuffered = 0
+
+    def write(self, ftbl_list):
+        for ftbl in ftbl_list:
+            if self._items is None:
+                self._setup(ftbl)
+
+            m = ftbl['meta']
+            for k in self._meta_keys:
+                v = m.get(k, None)
+                self._cols[k].append('' if v is None else v)
+            for k in self._items:
+                self._cols[k].append(ftbl[k])
+
+            self._nbuffered += 1
+            self.count += 1
+
+            if self._nbuffered >= self._chunk_size:
+                self.flush()
+
+    def get_arrays(self):
+        arrays = {}
+        for k in self._meta_keys:
+            arrays[k] = np.array(self._cols[k], dtype=str)
+        for k in self._items + self._derived:
+            arrays[k] = np.array(self._cols[k], dtype=np.float64)
+        return arrays
+
+    def fill_derived(self):
+        for k in self._derived:
+            self._cols[k] = calc_derived(k, self._cols).tolist()
+
+    def flush(self):
+        if self._nbuffered > 0:
+            self.fill_derived()
+            self.write_chunk()
+            self.nchunks += 1
+            self._reset()
+
+    def write_chunk(self):
+        pass
+
+    def close(self):
+        if self._items is not None:
+            self.flush()
+        logger.info(f'{self.count} rows ({self.nchunks} chunks) written'
+                    f' into "{self._outfile}"')
+
+
+class CSVWriter(WriterBase):
+    def __init__(self, outfile, META_KEYS, chunk_size=CHUNK_SIZE):
+        super().__init__(outfile, META_KEYS, chunk_size=chunk_size)
+        self._f = None
+        self._writer = None
+
+    def write_chunk(self):
+        cols = self.get_columns()
+        if self._writer is None:
+            ensure_parent_dir(self._outfile)
+            self._f = open(self._outfile, 'w', newline='')
+            self._writer = csv.writer(self._f)
+            self._writer.writerow(cols)
+        self._writer.writerows(zip(*[self._cols[k] for k in cols]))
+        self._f.flush()
+
+    def write(self, ftbl_list):
+        super().write(ftbl_list)
+        self.flush()
+
+    def close(self):
+        super().close()
+        if self._f:
+            self._f.close()
+            self._f = None
+
+
+class NpzWriter(WriterBase):
+    '''Writes each chunk into "<base>.NNNNN.npz" for outfile "<base>.npz".'''
+    def __init__(self, outfile, META_KEYS, chunk_size=CHUNK_SIZE):
+        super().__init__(outfile, META_KEYS, chunk_size=chunk_size)
+        (self._base, _) = os.path.splitext(outfile)
+        ensure_parent_dir(outfile)
+        for p in get_npz_chunk_paths(outfile):
+            os.remove(p)
+
+    def write_chunk(self):
+        path = NPZ_CHUNK_FMT.format(self._base, self.nchunks)
+        np.savez(path, **self.get_arrays())
+
+
+class ParquetWriter(WriterBase):
+    '''Writes each chunk as a row group of a Parquet file (requires pyarrow).
+    '''
+    def __init__(self, outfile, META_KEYS, chunk_size=CHUNK_SIZE):
+        super().__init__(outfile, META_KEYS, chunk_size=chunk_size)
+        self._writer = None
+
+    def write_chunk(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        arrays = self.get_arrays()
+        cols = self.get_columns()
+        table = pa.table([arrays[k] for k in cols], names=cols)
+        if self._writer is None:
+            ensure_parent_dir(self._outfile)
+            self._writer = pq.ParquetWriter(self._outfile, table.schema)
+        self._writer.write_table(table)
+
+    def close(self):
+        super().close()
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+
+WRITER_TBL = {
+    '.csv':     CSVWriter,
+    '.npz':     NpzWriter,
+    '.parquet': ParquetWriter,
+}
+
+
+def open_writer(outfile, META_KEYS, chunk_size=CHUNK_SIZE):
+    (_, ext) = os.path.splitext(outfile)
+    try:
+        writer_class = WRITER_TBL[ext.lower()]
+    except KeyError:
+        raise ValueError(f'unsupported format: "{outfile}"')
+    return writer_class(outfile, META_KEYS, chunk_size=chunk_size)
+
+
+def iter_npz_chunks(path):
+    for p in get_npz_chunk_paths(path):
+        with np.load(p) as npz:
+            yield dict((k, npz[k]) for k in npz.files)
+
+
+def iter_parquet_chunks(path):
+    import pyarrow.parquet as pq
+    f = pq.ParquetFile(path)
+    for i in range(f.num_row_groups):
+        t = f.read_row_group(i)
+        yield dict((k, t.column(k).to_numpy()) for k in t.column_names)
+
+
+def iter_chunks(path):
+    '''Yields dicts of column name -> ndarray, one for each stored chunk.'''
+    (_, ext) = os.path.splitext(path)
+    ext = ext.lower()
+    if ext == '.npz':
+        return iter_npz_chunks(path)
+    elif ext == '.parquet':
+        return iter_parquet_chunks(path)
+    raise ValueError(f'unsupported format: "{path}"')
+
+
+def load(path):
+    cols = {}
+    for chunk in iter_chunks(path):
+        for (k, a) in chunk.items():
+            cols.setdefault(k, []).append(a)
+    return dict((k, np.concatenate(li)) for (k, li) in cols.items())
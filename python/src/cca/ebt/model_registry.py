@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+
+
+'''
+  A registry of loop classifiers
+
+  Copyright 2013-2018 RIKEN
+  Copyright 2018-2020 Chiba Institute of Technology
+
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+'''
+
+__author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
+
+import os
+import json
+from time import time
+import numpy as np
+import joblib
+import logging
+
+from .conf import CCA_HOME
+from .make_loop_classifier import JUDGMENTS, has_scaler
+from .classify_loops import (load_classifier, iter_metrics_chunks,
+                             get_features, get_scaling_params,
+                             get_model_features, CHUNK_SIZE)
+
+logger = logging.getLogger()
+
+MODELS_DIR = os.path.join(CCA_HOME, 'models')
+
+# Layout of <MODELS_DIR>/<name>/:
+#
+#   m.pkl        estimator (preferably a Pipeline with a fitted scaler)
+#   scaler.pkl   fitted scaler for a bare estimator (optional)
+#   schema.json  {"selected": [METRIC], "derived": [DERIVED]}
+#   bench.json   benchmark numbers (optional)
+
+ESTIMATOR_FILE = 'm.pkl'
+SCALER_FILE = 'scaler.pkl'
+SCHEMA_FILE = 'schema.json'
+BENCH_FILE = 'bench.json'
+
+POS_LABEL = 'Kernel'
+
+###
+
+
+def load_json(path, default=None):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+
+def write_json(path, obj):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp, path)
+
+
+class Model(object):
+    '''A registered classifier. Files are read on first access.'''
+    def __init__(self, name, model_dir):
+        self.name = name
+        self.dir = model_dir
+        self._schema = None
+        self._scaler = None
+        self._scaler_loaded = False
+
+    def get_path(self, fname=ESTIMATOR_FILE):
+        return os.path.join(self.dir, fname)
+
+    @property
+    def schema(self):
+        if self._schema is None:
+            schema = load_json(self.get_path(SCHEMA_FILE))
+            if schema is None:
+                (selected, derived) = get_model_features(self.name)
+                schema = {'selected': selected, 'derived': derived}
+            self._schema = schema
+        return self._schema
+
+    @property
+    def selected(self):
+        return self.schema['selected']
+
+    @property
+    def derived(self):
+        return self.schema.get('derived', [])
+
+    @property
+    def estimator(self):
+        return load_classifier(self.get_path())
+
+    @property
+    def scaler(self):
+        clf = self.estimator
+        if has_scaler(clf):
+            return clf.named_steps['scaler']
+        if not self._scaler_loaded:
+            p = self.get_path(SCALER_FILE)
+            if os.path.exists(p):
+                self._scaler = joblib.load(p)
+            self._scaler_loaded = True
+        return self._scaler
+
+    @property
+    def bench(self):
+        return load_json(self.get_path(BENCH_FILE), default={})
+
+    def set_bench(self, bench):
+        write_json(self.get_path(BENCH_FILE), bench)
+
+    def needs_file_scaling(self):
+        '''Bare estimators without a scaler expect features standardized
+        with the statistics of the whole input.
+        '''
+        return self.scaler is None
+
+    def predict(self, X):
+        clf = self.estimator
+        if not has_scaler(clf):
+            scaler = self.scaler
+            if scaler is not None:
+                X = scaler.transform(X)
+        return clf.predict(X)
+
+
+class Registry(object):
+    def __init__(self, root=MODELS_DIR):
+        self.root = root
+        self._model_tbl = {}
+
+    def names(self):
+        try:
+            return sorted(n for n in os.listdir(self.root)
+                          if os.path.exists(os.path.join(self.root, n,
+                                                         ESTIMATOR_FILE)))
+        except FileNotFoundError:
+            return []
+
+    def get(self, name):
+        try:
+            model = self._model_tbl[name]
+        except KeyError:
+            d = os.path.join(self.root, name)
+            if not os.path.exists(os.path.join(d, ESTIMATOR_FILE)):
+                raise KeyError(f'model not found: "{name}"')
+            model = Model(name, d)
+            self._model_tbl[name] = model
+        return model
+
+    def save(self, name, clf, selected, derived=[], scaler=None, bench=None):
+        d = os.path.join(self.root, name)
+        if not os.path.exists(d):
+            os.makedirs(d)
+
+        logger.info(f'registering "{name}" in "{self.root}"')
+
+        write_json(os.path.join(d, SCHEMA_FILE),
+                   {'selected': list(selected), 'derived': list(derived)})
+
+        if scaler is not None:
+            p = os.path.join(d, SCALER_FILE)
+            joblib.dump(scaler, p + '.tmp')
+            os.replace(p + '.tmp', p)
+
+        p = os.path.join(d, ESTIMATOR_FILE)
+        joblib.dump(clf, p + '.tmp')
+        os.replace(p + '.tmp', p)
+
+        if bench is not None:
+            write_json(os.path.join(d, BENCH_FILE), bench)
+
+        self._model_tbl.pop(name, None)
+
+        return self.get(name)
+
+
+REGISTRY_TBL = {}  # root -> registry
+
+
+def get_registry(root=MODELS_DIR):
+    root = os.path.abspath(root)
+    try:
+        registry = REGISTRY_TBL[root]
+    except KeyError:
+        registry = Registry(root)
+        REGISTRY_TBL[root] = registry
+    return registry
+
+
+def get_model(name, root=MODELS_DIR):
+    return get_registry(root).get(name)
+
+
+def iter_classified_multi(path, models, filt={}, chunk_size=CHUNK_SIZE,
+                          extra=[]):
+    '''Classifies loops with several models in one pass over the metrics.
+    Yields (preds, chunk) for each chunk, where preds maps model name to
+    predicted labels ('' for rows a model cannot classify) of the rows of
+    chunk that pass filt.
+    '''
+    scale_tbl = {}
+    for model in models:
+        if model.needs_file_scaling():
+            logger.warning(f'no scaler for "{model.name}"')
+            params = get_scaling_params(path, selected=model.selected,
+                                        derived=model.derived, filt=filt,
+                                        chunk_size=chunk_size)
+            if params is not None:
+                scale_tbl[model.name] = params
+
+    for chunk in iter_metrics_chunks(path, chunk_size=chunk_size, extra=extra):
+        (_, fmask) = get_features(chunk, selected=[], derived=[], filt=filt)
+        chunk = dict((k, v[fmask]) for (k, v) in chunk.items())
+        n = int(fmask.sum())
+        if n == 0:
+            continue
+
+        preds = {}
+        for model in models:
+            (X, mask) = get_features(chunk, selected=model.selected,
+                                     derived=model.derived)
+            y = np.full(n, '', dtype=object)
+            if mask.any():
+                X = X[mask]
+                if model.name in scale_tbl:
+                    (mean, std) = scale_tbl[model.name]
+                    X = (X - mean) / std
+                y[mask] = model.predict(X)
+            preds[model.name] = y
+
+        yield (preds, chunk)
+
+
+def compare_models(path, names, root=MODELS_DIR, filt={},
+                   judgment=JUDGMENTS[0], chunk_size=CHUNK_SIZE):
+    '''Runs the models side by side on a metrics file. Reports kernel counts,
+    prediction times and agreement between models, and also accuracy and
+    F1 when the file has the judgment column.
+    '''
+    registry = get_registry(root)
+    models = [registry.get(n) for n in names]
+
+    stats = dict((n, {'kernels': 0, 'tp': 0, 'fp': 0, 'fn': 0, 'correct': 0,
+                      'labeled': 0, 'time': 0.0}) for n in names)
+    agree = dict(((a, b), 0) for a in names for b in names if a < b)
+    nrows = 0
+
+    st = time()
+    for (preds, chunk) in iter_classified_multi(path, models, filt=filt,
+                                                chunk_size=chunk_size,
+                                                extra=[judgment]):
+        nrows += len(chunk['proj'])
+
+        y_true = chunk.get(judgment, None)
+        if y_true is not None:
+            labeled = (y_true != 'Ignored') & (y_true != '')
+
+        for (n, y) in preds.items():
+            s = stats[n]
+            is_kernel = y == POS_LABEL
+            s['kernels'] += int(is_kernel.sum())
+            if y_true is not None:
+                pos = y_true == POS_LABEL
+                s['labeled'] += int(labeled.sum())
+                s['correct'] += int((labeled & (y == y_true)).sum())
+                s['tp'] += int((labeled & is_kernel & pos).sum())
+                s['fp'] += int((labeled & is_kernel & ~pos).sum())
+                s['fn'] += int((labeled & ~is_kernel & pos).sum())
+
+        for (a, b) in agree.keys():
+            agree[(a, b)] += int((preds[a] == preds[b]).sum())
+
+    t = time() - st
+
+    report = {'rows': nrows, 'time': t, 'models': {}, 'agreement': {}}
+
+    for (n, s) in stats.items():
+        r = {'kernels': s['kernels'], 'schema': registry.get(n).schema,
+             'bench': registry.get(n).bench}
+        if s['labeled']:
+            p = s['tp'] / max(s['tp'] + s['fp'], 1)
+            rc = s['tp'] / max(s['tp'] + s['fn'], 1)
+            r['accuracy'] = s['correct'] / s['labeled']
+            r['precision'] = p
+            r['recall'] = rc
+            r['f1'] = 2 * p * rc / (p + rc) if p + rc > 0 else 0.0
+        report['models'][n] = r
+
+    for ((a, b), c) in agree.items():
+        report['agreement'][f'{a}/{b}'] = c / nrows if nrows else 0.0
+
+    return report
+
+
+def main():
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+    from cca.ccautil.common import setup_logger
+
+    parser = ArgumentParser(description='compare registered loop classifiers',
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-d', '--debug', dest='debug', action='store_true',
+                        help='enable debug printing')
+
+    parser.add_argument('--models-dir', dest='models_dir', metavar='DIR',
+                        type=str, default=MODELS_DIR, help='model registry')
+
+    parser.add_argument('-m', '--model', dest='models', metavar='NAME',
+                        action='append',
+                        help='registered model (repeatable, default: all)')
+
+    parser.add_argument('-k', '--judgment', dest='judgment', metavar='COL',
+                        type=str, default=JUDGMENTS[0],
+                        help='judgment column')
+
+    parser.add_argument('metrics', type=str, metavar='METRICS_PATH',
+                        nargs='?', default=None,
+                        help='metrics file (lists models if omitted)')
+
+    args = parser.parse_args()
+
+    log_level = logging.INFO
+    if args.debug:
+        log_level = logging.DEBUG
+    setup_logger(logger, log_level)
+
+    registry = get_registry(args.models_dir)
+
+    names = args.models or registry.names()
+
+    if args.metrics is None:
+        for n in names:
+            print(f'{n}: {json.dumps(registry.get(n).schema)}')
+        return
+
+    report = compare_models(args.metrics, names, root=args.models_dir,
+                            judgment=args.judgment)
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -30,7 +30,9 @@ from .outline_for_survey_cpp import Outline as OutlineForSurveyCpp
 from .outline_for_survey_fortran import Outline as OutlineForSurveyFortran
 from .outline_for_survey_base import gen_conf_a, METRICS_DIR
 from .select_targets import predict_kernels, TARGET_DIR_NAME
+from .model_registry import get_model
 from .collect_readme_for_survey import collect_readme
+from .analyze_topic import clear_file_lists
 from cca.ccautil.common import setup_logger
 
 logger = logging.getLogger()
@@ -96,19 +98,24 @@ class Analyzer(AnalyzerBase):
 
         log('predicting kernels...')
         filt = {
-            'bf0': lambda x: bf0l < x < bf0u,
-            'bf1': lambda x: bf1l < x < bf1u,
-            'bf2': lambda x: bf2l < x < bf2u,
+            'bf0': (bf0l, bf0u),
+            'bf1': (bf1l, bf1u),
+            'bf2': (bf2l, bf2u),
         }
         metrics_file = os.path.join(dest_root, METRICS_DIR, proj_id,
                                     ol.gen_metrics_file_name(ver, lang))
         target_dir = os.path.join(dest_root, TARGET_DIR_NAME)
-        clf = cca_path(os.path.join('models', MODEL, 'm.pkl'))
-        predict_kernels(metrics_file, clf, model=MODEL, filt=filt,
-                        target_dir=target_dir)
+        try:
+            clf = get_model(MODEL)  # features are taken from its schema
+            predict_kernels(metrics_file, clf, filt=filt,
+                            target_dir=target_dir)
+        except KeyError as e:
+            logger.error(str(e))
 
         collect_readme(proj_id, dest_root, conf=conf)
 
+        clear_file_lists()  # listings shared by gen_topic and collect_readme
+
 
 def main():
     parser = create_argparser('Analyze C/C++/Fortran programs for outlining')
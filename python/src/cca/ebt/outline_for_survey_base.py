@@ -34,6 +34,7 @@ import logging
 
 from .sourcecode_metrics_for_survey_base import get_lver
 from . import sourcecode_metrics_for_survey_base as metrics
+from .metrics_store import get_derived_items, calc_derived
 from .search_topic_for_survey import search
 
 from cca.ccautil.cca_config import PROJECTS_DIR, Config, VKIND_VARIANT, VKIND_GITREV
@@ -118,6 +119,49 @@ class IdGenerator(object):
         return i
 
 
+class MetricsWriter(object):
+    '''Writes metrics rows (header order, root_file last) into a CSV file,
+    followed by the derived features computable from the header.
+    '''
+    def __init__(self, path, header):
+        self._path = path
+        self._header = header
+        self._derived = get_derived_items(header)
+        self._idx_tbl = dict((k, i) for (i, k) in enumerate(header))
+        self._f = None
+        self._writer = None
+        self.count = 0
+
+    def open(self):
+        try:
+            self._f = open(self._path, 'w', newline='')
+            self._writer = csv.writer(self._f)
+            self._writer.writerow(self._header + self._derived)
+        except Exception as e:
+            logger.warning(str(e))
+            self.close()
+
+    def write(self, row, root_file):
+        if self._writer:
+            try:
+                row.append(root_file)
+                if self._derived:
+                    cols = dict((k, row[i]) for (k, i) in self._idx_tbl.items())
+                    row.extend(float(calc_derived(k, cols))
+                               for k in self._derived)
+                self._writer.writerow(row)
+                self.count += 1
+            except Exception as e:
+                logger.warning(str(e))
+                self.close()
+
+    def close(self):
+        if self._f:
+            self._f.close()
+            self._f = None
+        self._writer = None
+
+
 class IndexGenerator(object):
     def __init__(self, init=0):
         self._count = init
@@ -1021,7 +1065,8 @@ class OutlineBase(object):
             d[k] = v
         return d
 
-    def gen_topic(self, lang, outdir='.', docsrc=None, index=None, model='lsi', ntopics=32):
+    def gen_topic(self, lang, outdir='.', docsrc=None, index=None, model='lsi', ntopics=32,
+                  nprocs=1):
 
         topic_dir = os.path.join(outdir, TOPIC_DIR)
 
@@ -1033,7 +1078,8 @@ class OutlineBase(object):
             dpath = os.path.join(docsrc, proj)
             logger.info(f'reading from "{dpath}"')
             opath = os.path.join(topic_dir, self.gen_topic_file_name())
-            search(index, model, dpath, ntopics=ntopics, lang=lang, outfile=opath)
+            search(index, model, dpath, ntopics=ntopics, lang=lang, outfile=opath,
+                   nprocs=nprocs)
 
     def mkrow(self, lver, loc, nd, lnum, mtbl, nid):
         return []
@@ -1165,334 +1211,315 @@ class OutlineBase(object):
 
             relevant_node_tbl = {}  # loc -> lnum -> nid list
             nodes = set()
-            csv_rows = []
 
-            def reg_nid(loc, lnum, nid):
-                try:
-                    ltbl = relevant_node_tbl[loc]
-                except KeyError:
-                    ltbl = {}
-                    relevant_node_tbl[loc] = ltbl
-                try:
-                    nids = ltbl[lnum]
-                except KeyError:
-                    nids = []
-                    ltbl[lnum] = nids
-                if nid not in nids:
-                    nids.append(nid)
-
-            def is_marked(node):
-                b = node in self._marked_nodes
-                return b
+            metrics_writer = None
 
-            def elaborate(node, d):
-                fid = node.get_fid()
-                loc = node.loc
-                d['fid'] = fid_idx_tbl[fid]
-                d['loc'] = path_idx_tbl[loc]
+            if metrics_dir and ensure_dir(metrics_dir):
+                metrics_file_name = self.gen_metrics_file_name(lver, lang)
+                metrics_path = os.path.join(metrics_dir, metrics_file_name)
 
-                start_line = node.get_start_line()
-                if node.is_block():
-                    d['code'] = '<span class="cat">%s</span>' % node.get_block_cat()
-                else:
-                    try:
-                        code = line_text_tbl[loc][start_line]
-                        d['code'] = code
+                logger.info(f'dumping metrics into "{metrics_path}"...')
 
-                    except KeyError:
-                        pass
+                metrics_writer = MetricsWriter(metrics_path,
+                                               self.METRICS_ROW_HEADER)
+                metrics_writer.open()
 
-                mkey = (lver, loc, str(start_line))
-
-                self.set_extra2(d, mkey)
-
-                aref_ranges = self.get_aref_ranges(mkey)
-                if aref_ranges:
-                    for aref_range in aref_ranges:
-                        df = aref_range.get('def', None)
-                        if df:
-                            ln = df.get('line', None)
-                            p = df.get('path', None)
-                            if ln and p:
-                                try:
-                                    df['code'] = line_text_tbl[p][ln]
-                                except KeyError:
-                                    pass
-                            if 'fid' in df:
-                                del df['fid']
-
-                    d['aref_ranges'] = json.dumps(aref_ranges)
-
-                try:
-                    mtbl = self.get_metrics_tbl(mkey)
+            try:
+                # nids generated while converting the roots of a file belong to
+                # that file, so the root file of a row is known when it is made
+                conv_state = {'root_file': None}
 
-                    bf0 = round(mtbl[metrics.BF[0]], 2)
-                    bf1 = round(mtbl[metrics.BF[1]], 2)
-                    bf2 = round(mtbl[metrics.BF[2]], 2)
+                def reg_nid(loc, lnum, nid):
+                    try:
+                        ltbl = relevant_node_tbl[loc]
+                    except KeyError:
+                        ltbl = {}
+                        relevant_node_tbl[loc] = ltbl
+                    try:
+                        nids = ltbl[lnum]
+                    except KeyError:
+                        nids = []
+                        ltbl[lnum] = nids
+                    if nid not in nids:
+                        nids.append(nid)
+
+                def is_marked(node):
+                    b = node in self._marked_nodes
+                    return b
+
+                def elaborate(node, d):
+                    fid = node.get_fid()
+                    loc = node.loc
+                    d['fid'] = fid_idx_tbl[fid]
+                    d['loc'] = path_idx_tbl[loc]
+
+                    start_line = node.get_start_line()
+                    if node.is_block():
+                        d['code'] = '<span class="cat">%s</span>' % node.get_block_cat()
+                    else:
+                        try:
+                            code = line_text_tbl[loc][start_line]
+                            d['code'] = code
 
-                    if bf0 > 0 or bf1 > 0 or bf2 > 0:
-                        logger.debug('%s: %s -> %3.2f|%3.2f|%3.2f' % (node.cat,
-                                                                      mkey,
-                                                                      bf0,
-                                                                      bf1,
-                                                                      bf2))
+                        except KeyError:
+                            pass
 
-                        md = self.get_measurement(mtbl, [
-                            metrics.N_BRANCHES,
-                            metrics.N_STMTS,
-                            metrics.N_FP_OPS,
-                        ] + metrics.N_IND_A_REFS +
-                            metrics.N_A_REFS +
-                            metrics.N_DBL_A_REFS
-                        )
+                    mkey = (lver, loc, str(start_line))
 
-                        d['bf0'] = bf0
-                        d['bf1'] = bf1
-                        d['bf2'] = bf2
+                    self.set_extra2(d, mkey)
 
-                        d['other_metrics'] = md
-                        d['relevant'] = True
+                    aref_ranges = self.get_aref_ranges(mkey)
+                    if aref_ranges:
+                        for aref_range in aref_ranges:
+                            df = aref_range.get('def', None)
+                            if df:
+                                ln = df.get('line', None)
+                                p = df.get('path', None)
+                                if ln and p:
+                                    try:
+                                        df['code'] = line_text_tbl[p][ln]
+                                    except KeyError:
+                                        pass
+                                if 'fid' in df:
+                                    del df['fid']
 
-                        nid = d['id']
-                        reg_nid(d['loc'], d['sl'], nid)
+                        d['aref_ranges'] = json.dumps(aref_ranges)
 
-                        if node not in nodes:
-                            row = self.mkrow(lver, loc, node, start_line, mtbl,
-                                             nid)
-                            csv_rows.append(row)
+                    try:
+                        mtbl = self.get_metrics_tbl(mkey)
+
+                        bf0 = round(mtbl[metrics.BF[0]], 2)
+                        bf1 = round(mtbl[metrics.BF[1]], 2)
+                        bf2 = round(mtbl[metrics.BF[2]], 2)
+
+                        if bf0 > 0 or bf1 > 0 or bf2 > 0:
+                            logger.debug('%s: %s -> %3.2f|%3.2f|%3.2f' % (node.cat,
+                                                                          mkey,
+                                                                          bf0,
+                                                                          bf1,
+                                                                          bf2))
+
+                            md = self.get_measurement(mtbl, [
+                                metrics.N_BRANCHES,
+                                metrics.N_STMTS,
+                                metrics.N_FP_OPS,
+                            ] + metrics.N_IND_A_REFS +
+                                metrics.N_A_REFS +
+                                metrics.N_DBL_A_REFS
+                            )
 
-                        nodes.add(node)
+                            d['bf0'] = bf0
+                            d['bf1'] = bf1
+                            d['bf2'] = bf2
 
-                except KeyError:
-                    # print('!!! not found: {}'.format(mkey))
-                    pass
+                            d['other_metrics'] = md
+                            d['relevant'] = True
 
-            idgen = IdGenerator()
+                            nid = d['id']
+                            reg_nid(d['loc'], d['sl'], nid)
 
-            nid_tbl = {}
-            parent_tbl = {}
+                            if node not in nodes and metrics_writer:
+                                row = self.mkrow(lver, loc, node, start_line, mtbl,
+                                                 nid)
+                                metrics_writer.write(row, conv_state['root_file'])
 
-            root_collapsed_caller_tbl = {}
-            root_expanded_callee_tbl = {}
+                            nodes.add(node)
 
-            d_tbl = {}
+                    except KeyError:
+                        # print('!!! not found: {}'.format(mkey))
+                        pass
 
-            logger.info(f'converting trees into JSON for "{lver}"...')
+                idgen = IdGenerator()
 
-            for loc in loc_tbl.keys():
-                logger.debug(f'loc={loc}')
-                ds = []
+                root_collapsed_caller_tbl = {}
+                root_expanded_callee_tbl = {}
 
-                fid = None
+                d_tbl = {}
 
-                for root in loc_tbl[loc]:
-                    logger.debug(f'root={root}')
-                    if not fid:
-                        fid = root.get_fid()
+                logger.info(f'converting trees into JSON for "{lver}"...')
 
-                    collapsed_caller_tbl = {}
-                    root_collapsed_caller_tbl[root] = collapsed_caller_tbl
+                for loc in loc_tbl.keys():
+                    logger.debug(f'loc={loc}')
+                    ds = []
 
-                    expanded_callee_tbl = {}
-                    root_expanded_callee_tbl[root] = expanded_callee_tbl
+                    fid = None
 
-                    ancls = [root] if self.add_root else []
+                    conv_state['root_file'] = loc
 
-                    d = root.to_dict(ancls, {},
-                                     elaborate=elaborate,
-                                     idgen=idgen,
-                                     collapsed_caller_tbl=collapsed_caller_tbl,
-                                     expanded_callee_tbl=expanded_callee_tbl,
-                                     parent_tbl=parent_tbl,
-                                     is_marked=is_marked,
-                                     omitted=omitted)
-                    ds.append(d)
+                    for root in loc_tbl[loc]:
+                        logger.debug(f'root={root}')
+                        if not fid:
+                            fid = root.get_fid()
 
-                    d_tbl[d['id']] = root
+                        collapsed_caller_tbl = {}
+                        root_collapsed_caller_tbl[root] = collapsed_caller_tbl
 
-                nid = idgen.gen()
+                        expanded_callee_tbl = {}
+                        root_expanded_callee_tbl[root] = expanded_callee_tbl
 
-                for d in ds:
-                    parent_tbl[d['id']] = nid
+                        ancls = [root] if self.add_root else []
 
-                loc_d = {
-                    'id':       nid,
-                    'text':     loc,
-                    'loc':      path_idx_tbl[loc],
-                    'children': ds,
-                    'fid':      fid_idx_tbl[fid],
-                    'cat':      'file',
-                    'type':     'file',
-                }
+                        d = root.to_dict(ancls, {},
+                                         elaborate=elaborate,
+                                         idgen=idgen,
+                                         collapsed_caller_tbl=collapsed_caller_tbl,
+                                         expanded_callee_tbl=expanded_callee_tbl,
+                                         is_marked=is_marked,
+                                         omitted=omitted)
+                        ds.append(d)
 
-                nid_tbl[nid] = loc
+                        d_tbl[d['id']] = root
 
-                json_ds.append(loc_d)
+                    nid = idgen.gen()
 
-            def copy_dict(d, hook=(lambda x: None), info={}):
-                children = [copy_dict(c, hook=hook, info=info)
-                            for c in d['children']]
-                try:
-                    info['count'] += 1
-                except KeyError:
-                    pass
-                copied = dict.copy(d)
-                hook(copied)
-                copied['children'] = children
-                return copied
+                    loc_d = {
+                        'id':       nid,
+                        'text':     loc,
+                        'loc':      path_idx_tbl[loc],
+                        'children': ds,
+                        'fid':      fid_idx_tbl[fid],
+                        'cat':      'file',
+                        'type':     'file',
+                    }
 
-            root_callees_tbl = {}
+                    json_ds.append(loc_d)
 
-            logger.debug('* root_collapsed_caller_tbl:')
-            for (r, collapsed_caller_tbl) in root_collapsed_caller_tbl.items():
-                logger.debug(f'root={r}:')
+                def copy_dict(d, hook=(lambda x: None), info={}):
+                    children = [copy_dict(c, hook=hook, info=info)
+                                for c in d['children']]
+                    try:
+                        info['count'] += 1
+                    except KeyError:
+                        pass
+                    copied = dict.copy(d)
+                    hook(copied)
+                    copied['children'] = children
+                    return copied
 
-                while collapsed_caller_tbl:
-                    new_collapsed_caller_tbl = {}
+                root_callees_tbl = {}
 
-                    callees_tbl = {}
-                    root_callees_tbl[r] = callees_tbl
+                logger.debug('* root_collapsed_caller_tbl:')
+                for (r, collapsed_caller_tbl) in root_collapsed_caller_tbl.items():
+                    logger.debug(f'root={r}:')
 
-                    for (callee, d_lv_list) in collapsed_caller_tbl.items():
+                    while collapsed_caller_tbl:
+                        new_collapsed_caller_tbl = {}
 
-                        logger.debug(f' callee="{callee}"')
+                        callees_tbl = {}
+                        root_callees_tbl[r] = callees_tbl
 
-                        expanded_callee_tbl = \
-                            root_expanded_callee_tbl.get(r, {})
+                        for (callee, d_lv_list) in collapsed_caller_tbl.items():
 
-                        callee_dl = expanded_callee_tbl.get(callee, [])
-                        if callee_dl:
-                            callees_tbl[callee] = [d['id'] for d in callee_dl]
-                            logger.debug('callees_tbl: {} -> [{}]'
-                                         .format(callee,
-                                                 ','.join(callees_tbl[callee]))
-                                         )
-                            logger.debug(' -> skip')
-                            continue
+                            logger.debug(f' callee="{callee}"')
 
-                        callee_dl = []
-                        collapsed_caller_tbl_ = {}
+                            expanded_callee_tbl = \
+                                root_expanded_callee_tbl.get(r, {})
 
-                        for (r_, tbl) in root_expanded_callee_tbl.items():
-                            callee_dl = tbl.get(callee, [])
+                            callee_dl = expanded_callee_tbl.get(callee, [])
                             if callee_dl:
-                                logger.debug('{} callee dicts found in {}'
-                                             .format(len(callee_dl), r_))
-                                collapsed_caller_tbl_ \
-                                    = root_collapsed_caller_tbl.get(r_, {})
-                                break
-
-                        if callee_dl:
-                            nid_callee_lv_tbl = {}
-
-                            for callee_d in callee_dl:
-                                def chk(lv_, d):
-                                    callee_ = d.get('callee', None)
-                                    if callee_ and d.get('children', []) == []:
-                                        d_lv_list_ = collapsed_caller_tbl_\
-                                            .get(callee_, [])
-                                        for (d_, _) in d_lv_list_:
-                                            nid_ = d_['id']
-                                            try:
-                                                nid_callee_lv_tbl[nid_]\
-                                                    .append((callee_, lv_))
-                                            except KeyError:
-                                                nid_callee_lv_tbl[nid_] \
-                                                    = [(callee_, lv_)]
-                                self.iter_d(chk, callee_d)
-
-                            max_lv = 0
-                            selected = None
-                            for (d, lv) in d_lv_list:
-                                if lv > max_lv:
-                                    max_lv = lv
-                                    selected = d
-                                logger.debug('    nid={} lv={}'.format(d['id'],
-                                                                       lv))
-
-                            selected_id = selected['id']
-                            logger.debug('    -> selected %s' % selected_id)
-
-                            copied_dl = []
-
-                            try:
-                                base = '{}{}'.format(selected_id, NID_SEP)
-                                idl = selected_id.split(NID_SEP)
-
-                                def conv_id(i):
-                                    return base+i
-
-                                def hook(x):
-                                    xid = x['id']
-                                    if xid in idl:
-                                        return
-                                    for (c, lv) in nid_callee_lv_tbl.get(xid, []):
-                                        lv_ = max_lv + lv + 1
-                                        try:
-                                            li = new_collapsed_caller_tbl[c]
-                                            if not any([x_['id'] == xid
-                                                        and lv_ == lv__
-                                                        for (x_, lv__) in li]):
-                                                li.append((x, lv_))
-                                        except KeyError:
-                                            new_collapsed_caller_tbl[c] = [(x, lv_)]
-                                    x['id'] = conv_id(xid)
-
-                                for callee_d in callee_dl:
-                                    info = {'count': 0}
-                                    copied = copy_dict(callee_d, hook=hook, info=info)
-                                    copied_dl.append(copied)
-                                    logger.debug('%d nodes copied' % info['count'])
-
-                                selected['children'] = copied_dl
-                                callees_tbl[callee] = [d['id'] for d in copied_dl]
+                                callees_tbl[callee] = [d['id'] for d in callee_dl]
                                 logger.debug('callees_tbl: {} -> [{}]'
                                              .format(callee,
-                                                     ','.join(callees_tbl[callee])))
-                            except Exception as e:
-                                logger.warning(str(e))
-
-                    if new_collapsed_caller_tbl:
-                        collapsed_caller_tbl = new_collapsed_caller_tbl
-                        logger.debug('new_collapsed_caller_tbl:')
-                    else:
-                        collapsed_caller_tbl = {}
-                    for (callee, d_lv_list) in new_collapsed_caller_tbl.items():
-                        logger.debug('callee=%s' % callee)
-                        for (d, lv) in d_lv_list:
-                            logger.debug('%s (lv=%d)' % (d['id'], lv))
-
-            if metrics_dir:
-                if ensure_dir(metrics_dir):
+                                                     ','.join(callees_tbl[callee]))
+                                             )
+                                logger.debug(' -> skip')
+                                continue
 
-                    metrics_file_name = self.gen_metrics_file_name(lver, lang)
-                    metrics_path = os.path.join(metrics_dir, metrics_file_name)
+                            callee_dl = []
+                            collapsed_caller_tbl_ = {}
 
-                    logger.info(f'dumping metrics into "{metrics_path}"...')
-                    logger.info('{} rows found'.format(len(csv_rows)))
+                            for (r_, tbl) in root_expanded_callee_tbl.items():
+                                callee_dl = tbl.get(callee, [])
+                                if callee_dl:
+                                    logger.debug('{} callee dicts found in {}'
+                                                 .format(len(callee_dl), r_))
+                                    collapsed_caller_tbl_ \
+                                        = root_collapsed_caller_tbl.get(r_, {})
+                                    break
 
-                    try:
-                        with open(metrics_path, 'w') as metricsf:
-                            csv_writer = csv.writer(metricsf)
-                            csv_writer.writerow(self.METRICS_ROW_HEADER)
-                            nid_i = self.METRICS_ROW_HEADER.index('nid')
-                            for row in csv_rows:
-                                root_nid = row[nid_i]
-                                while True:
-                                    try:
-                                        root_nid = parent_tbl[root_nid]
-                                    except KeyError:
-                                        break
-
-                                if root_nid not in nid_tbl:
-                                    print(row)
-
-                                row.append(nid_tbl[root_nid])
+                            if callee_dl:
+                                nid_callee_lv_tbl = {}
 
-                                csv_writer.writerow(row)
+                                for callee_d in callee_dl:
+                                    def chk(lv_, d):
+                                        callee_ = d.get('callee', None)
+                                        if callee_ and d.get('children', []) == []:
+                                            d_lv_list_ = collapsed_caller_tbl_\
+                                                .get(callee_, [])
+                                            for (d_, _) in d_lv_list_:
+                                                nid_ = d_['id']
+                                                try:
+                                                    nid_callee_lv_tbl[nid_]\
+                                                        .append((callee_, lv_))
+                                                except KeyError:
+                                                    nid_callee_lv_tbl[nid_] \
+                                                        = [(callee_, lv_)]
+                                    self.iter_d(chk, callee_d)
+
+                                max_lv = 0
+                                selected = None
+                                for (d, lv) in d_lv_list:
+                                    if lv > max_lv:
+                                        max_lv = lv
+                                        selected = d
+                                    logger.debug('    nid={} lv={}'.format(d['id'],
+                                                                           lv))
+
+                                selected_id = selected['id']
+                                logger.debug('    -> selected %s' % selected_id)
+
+                                copied_dl = []
 
-                    except Exception as e:
-                        logger.warning(str(e))
+                                try:
+                                    base = '{}{}'.format(selected_id, NID_SEP)
+                                    idl = selected_id.split(NID_SEP)
+
+                                    def conv_id(i):
+                                        return base+i
+
+                                    def hook(x):
+                                        xid = x['id']
+                                        if xid in idl:
+                                            return
+                                        for (c, lv) in nid_callee_lv_tbl.get(xid, []):
+                                            lv_ = max_lv + lv + 1
+                                            try:
+                                                li = new_collapsed_caller_tbl[c]
+                                                if not any([x_['id'] == xid
+                                                            and lv_ == lv__
+                                                            for (x_, lv__) in li]):
+                                                    li.append((x, lv_))
+                                            except KeyError:
+                                                new_collapsed_caller_tbl[c] = [(x, lv_)]
+                                        x['id'] = conv_id(xid)
+
+                                    for callee_d in callee_dl:
+                                        info = {'count': 0}
+                                        copied = copy_dict(callee_d, hook=hook, info=info)
+                                        copied_dl.append(copied)
+                                        logger.debug('%d nodes copied' % info['count'])
+
+                                    selected['children'] = copied_dl
+                                    callees_tbl[callee] = [d['id'] for d in copied_dl]
+                                    logger.debug('callees_tbl: {} -> [{}]'
+                                                 .format(callee,
+                                                         ','.join(callees_tbl[callee])))
+                                except Exception as e:
+                                    logger.warning(str(e))
+
+                        if new_collapsed_caller_tbl:
+                            collapsed_caller_tbl = new_collapsed_caller_tbl
+                            logger.debug('new_collapsed_caller_tbl:')
+                        else:
+                            collapsed_caller_tbl = {}
+                        for (callee, d_lv_list) in new_collapsed_caller_tbl.items():
+                            logger.debug('callee=%s' % callee)
+                            for (d, lv) in d_lv_list:
+                                logger.debug('%s (lv=%d)' % (d['id'], lv))
+            finally:
+                if metrics_writer:
+                    metrics_writer.close()
+                    logger.info('{} rows found'.format(metrics_writer.count))
 
             # clean up relevant_node_tbl
             p_to_be_del = []
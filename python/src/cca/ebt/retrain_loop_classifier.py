@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+
+
+'''
+  A script for retraining loop classifiers from survey judgments
+
+  Copyright 2013-2018 RIKEN
+  Copyright 2018-2020 Chiba Institute of Technology
+
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+'''
+
+__author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
+
+import os
+import json
+import numpy as np
+from sklearn.svm import SVC
+from sklearn.neighbors import KNeighborsClassifier
+import joblib
+import logging
+
+from .make_loop_classifier import (import_training_set, make_pipeline,
+                                   JUDGMENTS)
+from .classify_loops import (iter_metrics_chunks, get_features,
+                             get_model_features, CHUNK_SIZE)
+
+logger = logging.getLogger()
+
+MONGO_PORT = 27017
+
+LABEL_TBL = {
+    'M1':        'Kernel',
+    'M2':        'Kernel',
+    'M3':        'Kernel',
+    'M4':        'Kernel',
+    'M5':        'Kernel',
+    'M6':        'Kernel',
+    'NonKernel': 'NonKernel',
+}
+
+KEY_SEP = ':'
+
+###
+
+
+def get_label(judgment):
+    '''Returns the training label of a judgment, or None for judgments such
+    as "NotYet" that do not label the loop.
+    '''
+    return LABEL_TBL.get(judgment, None)
+
+
+def make_estimator(model='minami'):
+    if model == 'terai':
+        clf = KNeighborsClassifier(6, weights='distance', metric='hamming')
+    else:
+        clf = SVC(C=32., kernel='rbf', gamma=8.)
+    return make_pipeline(clf)
+
+
+class MongoJudgmentSource(object):
+    '''Judgments recorded in the loop_survey.log collection.'''
+    def __init__(self, host='localhost', port=MONGO_PORT):
+        from pymongo import MongoClient
+        self._col = MongoClient(host, port).loop_survey.log
+
+    def find(self, since=None):
+        from pymongo import ASCENDING
+        query = {
+            'proj': {'$exists': True},
+            'ver': {'$exists': True},
+            'nid': {'$exists': True},
+            'judgment': {'$exists': True},
+        }
+        if since:
+            query['time'] = {'$gt': since}
+        return self._col.find(query).sort('time', ASCENDING)
+
+
+class LocalJudgmentSource(object):
+    '''Judgments dumped as a JSON array (as returned by the log CGI for a
+    query) or as JSON lines. Stands in for MongoJudgmentSource.
+    '''
+    def __init__(self, path):
+        self._path = path
+
+    def _load(self):
+        with open(self._path) as f:
+            s = f.read().strip()
+        if s.startswith('['):
+            return json.loads(s)
+        return [json.loads(x) for x in s.splitlines() if x.strip()]
+
+    def find(self, since=None):
+        records = [r for r in self._load()
+                   if all(k in r for k in ('proj', 'ver', 'nid', 'judgment'))
+                   and (since is None or r.get('time', '') > since)]
+        records.sort(key=lambda r: r.get('time', ''))
+        return records
+
+
+def get_latest_judgments(records):
+    '''Returns (jtbl, last_time), where jtbl maps (proj, ver, nid) to the
+    latest of the records (assumed to be sorted by time).
+    '''
+    jtbl = {}
+    last_time = None
+    for r in records:
+        jtbl[(r['proj'], r['ver'], str(r['nid']))] = r
+        last_time = r.get('time', last_time)
+    return (jtbl, last_time)
+
+
+def join_metrics(metrics_path, jtbl, model='minami', chunk_size=CHUNK_SIZE,
+                 pending=None):
+    '''Looks up the metrics of judged loops by (proj, ver, nid) in one pass
+    over the metrics snapshot, which must be a metrics CSV of the outline
+    (with nid). Returns (X, y, keys). The judgments of loops not found are
+    put into pending (key -> judgment) if given.
+    '''
+    (selected, derived) = get_model_features(model)
+
+    key_tbl = {}  # (proj, ver, nid) -> label
+    for (k, r) in jtbl.items():
+        label = get_label(r['judgment'])
+        if label:
+            key_tbl[k] = label
+
+    Xs = []
+    ys = []
+    keys = []
+
+    if key_tbl:
+        for chunk in iter_metrics_chunks(metrics_path, chunk_size=chunk_size):
+            if not np.any(chunk['nid'] != ''):
+                raise ValueError(f'no nid found in "{metrics_path}"')
+            (X, mask) = get_features(chunk, selected=selected, derived=derived)
+            ks = zip(chunk['proj'], chunk['ver'], chunk['nid'])
+            for (i, k) in enumerate(ks):
+                try:
+                    label = key_tbl.pop(k)
+                except KeyError:
+                    continue
+                if mask[i]:
+                    Xs.append(X[i])
+                    ys.append(label)
+                    keys.append(KEY_SEP.join(k))
+            if not key_tbl:
+                break
+
+    if key_tbl:
+        logger.warning(f'{len(key_tbl)} judged loops not found in metrics')
+        if pending is not None:
+            for k in key_tbl:
+                pending[k] = jtbl[k]['judgment']
+
+    nfeatures = len(selected) + len(derived)
+    X = np.array(Xs).reshape(len(Xs), nfeatures)
+    return (X, np.array(ys, dtype=str), np.array(keys, dtype=str))
+
+
+class TrainingSet(object):
+    '''Judged loops accumulated so far, with the time of the last judgment
+    taken into account. Judgments of loops not found in the metrics yet are
+    kept pending ((proj, ver, nid) -> judgment) and retried on the next run.
+    '''
+    def __init__(self, X, y, keys, last_time=None, pending=None):
+        self.X = X
+        self.y = y
+        self.keys = keys
+        self.last_time = last_time
+        self.pending = pending or {}
+
+    @classmethod
+    def empty(cls, nfeatures):
+        return cls(np.empty((0, nfeatures)), np.empty(0, dtype=str),
+                   np.empty(0, dtype=str))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as npz:
+            last_time = str(npz['last_time']) or None
+            pending = {}
+            if 'pending_keys' in npz:
+                pending = dict(zip(map(tuple, npz['pending_keys'].tolist()),
+                                   npz['pending_judgments'].tolist()))
+            return cls(npz['X'], npz['y'], npz['keys'], last_time=last_time,
+                       pending=pending)
+
+    def save(self, path):
+        tmp = path + '.tmp.npz'
+        pending_keys = np.array(list(self.pending.keys()), dtype=str)
+        np.savez(tmp, X=self.X, y=self.y, keys=self.keys,
+                 last_time=np.array(self.last_time or ''),
+                 pending_keys=pending_keys.reshape(len(self.pending), 3),
+                 pending_judgments=np.array(list(self.pending.values()),
+                                            dtype=str))
+        os.replace(tmp, path)
+
+    def remove(self, keys):
+        if len(keys) > 0:
+            mask = ~np.isin(self.keys, list(keys))
+            self.X = self.X[mask]
+            self.y = self.y[mask]
+            self.keys = self.keys[mask]
+
+    def update(self, X, y, keys):
+        '''Adds rows, replacing those with the same keys.'''
+        self.remove(keys)
+        self.X = np.concatenate((self.X, X))
+        self.y = np.concatenate((self.y, y))
+        self.keys = np.concatenate((self.keys, keys))
+
+    def __len__(self):
+        return len(self.y)
+
+
+def get_state_path(clf_path):
+    return os.path.splitext(clf_path)[0] + '.train.npz'
+
+
+def init_training_set(csv_path, model='minami'):
+    (selected, derived) = get_model_features(model)
+    data = import_training_set(csv_path, selected=selected, derived=derived)[0]
+    keys = np.array([KEY_SEP.join((m['proj'], m['ver'], m['nid']))
+                     for m in data.meta], dtype=str)
+    X = data.X.reshape(len(keys), len(selected) + len(derived))
+    return TrainingSet(X, data.y.astype(str), keys)
+
+
+def dump_classifier(clf, path):
+    tmp = path + '.tmp'
+    joblib.dump(clf, tmp)
+    os.replace(tmp, path)
+
+
+def retrain(source, metrics_path, clf_path, state_path=None, model='minami',
+            init=None, full=False, chunk_size=CHUNK_SIZE):
+    '''Fetches judgments made since the last run from source, joins them with
+    the metrics snapshot and refits the classifier on the accumulated
+    training set. Returns the number of rows updated.
+    '''
+    if state_path is None:
+        state_path = get_state_path(clf_path)
+
+    (selected, derived) = get_model_features(model)
+
+    if not full and os.path.exists(state_path):
+        ts = TrainingSet.load(state_path)
+    elif init:
+        ts = init_training_set(init, model=model)
+    else:
+        ts = TrainingSet.empty(len(selected) + len(derived))
+
+    logger.info(f'{len(ts)} rows in training set (last: {ts.last_time})')
+
+    (jtbl, last_time) = get_latest_judgments(source.find(since=ts.last_time))
+
+    if not jtbl and not ts.pending:
+        logger.info('no new judgments')
+        return 0
+
+    logger.info(f'{len(jtbl)} loops judged since {ts.last_time}')
+
+    retracted = [KEY_SEP.join(k) for (k, r) in jtbl.items()
+                 if get_label(r['judgment']) is None]
+
+    nnew = len(jtbl)
+
+    for (k, j) in ts.pending.items():  # superseded by newer judgments
+        jtbl.setdefault(k, {'judgment': j})
+
+    pending = {}
+    (X, y, keys) = join_metrics(metrics_path, jtbl, model=model,
+                                chunk_size=chunk_size, pending=pending)
+
+    if nnew == 0 and len(y) == 0:
+        logger.info(f'{len(pending)} pending judgments still not found')
+        return 0
+
+    ts.remove(retracted)
+    ts.update(X, y, keys)
+    ts.last_time = last_time or ts.last_time
+    ts.pending = pending
+
+    if len(np.unique(ts.y)) < 2:
+        logger.warning('training set has less than two classes, not refitted')
+    else:
+        clf = make_estimator(model)
+        clf.fit(ts.X, ts.y)
+        dump_classifier(clf, clf_path)
+        logger.info(f'classifier refitted on {len(ts)} rows and dumped into'
+                    f' "{clf_path}"')
+
+    ts.save(state_path)
+
+    return len(y) + len(retracted)
+
+
+def main():
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+    from cca.ccautil.common import setup_logger
+
+    parser = ArgumentParser(description='retrain loop classifier from survey'
+                            ' judgments',
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-d', '--debug', dest='debug', action='store_true',
+                        help='enable debug printing')
+
+    parser.add_argument('-m', '--model', dest='model', metavar='MODEL',
+                        type=str, default='minami',
+                        help='model (minami|terai|mix)')
+
+    parser.add_argument('--mongo', dest='mongo', metavar='HOST',
+                        type=str, default='localhost',
+                        help='MongoDB host')
+
+    parser.add_argument('--port', dest='port', metavar='PORT', type=int,
+                        default=MONGO_PORT, help='MongoDB port')
+
+    parser.add_argument('-l', '--log', dest='log', metavar='PATH', type=str,
+                        default=None,
+                        help='read judgments from dumped log records'
+                        ' instead of MongoDB')
+
+    parser.add_argument('-s', '--state', dest='state', metavar='PATH',
+                        type=str, default=None,
+                        help='training set state (default: CLF_PATH with'
+                        ' .train.npz)')
+
+    parser.add_argument('-i', '--init', dest='init', metavar='PATH',
+                        type=str, default=None,
+                        help='training dataset (CSV with %s) to start with'
+                        % ', '.join(JUDGMENTS))
+
+    parser.add_argument('--full', dest='full', action='store_true',
+                        help='ignore state and fetch all judgments')
+
+    parser.add_argument('metrics', type=str, metavar='METRICS_PATH',
+                        help='metrics CSV of the outline (with nid)')
+
+    parser.add_argument('clf', type=str, metavar='CLF_PATH',
+                        help='classifier to be updated')
+
+    args = parser.parse_args()
+
+    log_level = logging.INFO
+    if args.debug:
+        log_level = logging.DEBUG
+    setup_logger(logger, log_level)
+
+    if args.log:
+        source = LocalJudgmentSource(args.log)
+    else:
+        source = MongoJudgmentSource(args.mongo, args.port)
+
+    retrain(source, args.metrics, os.path.abspath(args.clf),
+            state_path=args.state, model=args.model, init=args.init,
+            full=args.full)
+
+
+if __name__ == '__main__':
+    main()
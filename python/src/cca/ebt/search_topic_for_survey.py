@@ -23,13 +23,15 @@
 __author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
 
 import os.path
-from itertools import chain
 import _pickle as cPickle
 import json
-from gensim import models, corpora, similarities
+from time import time
+import numpy as np
+from gensim import models, corpora, similarities, matutils
 import logging
 
-from .analyze_topic import get_texts
+from .analyze_topic import get_word_counts, get_word_counts_multi, counts_to_bow
+from .token_cache import TokenCache, TOKEN_CACHE_PATH
 
 logger = logging.getLogger()
 
@@ -48,6 +50,84 @@ MODEL_LOADER_TBL = {
 }
 
 
+def top_k(sims, k=None):
+    '''Returns the (index, similarity) pairs of the k largest similarities in
+    descending order, ties broken by index. Rows of a 2-D array are treated
+    as separate queries.
+    '''
+    sims = np.asarray(sims)
+    if sims.ndim == 2:
+        return [top_k(row, k) for row in sims]
+
+    n = len(sims)
+    if k is None or k >= n:
+        idxs = np.arange(n)
+    elif k <= 0:
+        return []
+    else:
+        idxs = np.argpartition(-sims, k - 1)[:k]
+        kth = sims[idxs].min()
+        idxs = np.flatnonzero(sims >= kth)  # keep ties at the boundary
+
+    order = np.lexsort((idxs, -sims[idxs]))[:k]
+    return [(int(i), sims[i]) for i in idxs[order]]
+
+
+# An index file with SHARDED_INDEX_EXT is a similarities.Similarity whose
+# shards (<index file>.<N>) are memory-mapped one at a time when queried.
+# Any other index file is a similarities.MatrixSimilarity.
+
+SHARDED_INDEX_EXT = '.sindex'
+
+SHARD_SIZE = 32768  # vectors per shard
+
+
+def is_sharded(index_path):
+    return index_path.endswith(SHARDED_INDEX_EXT)
+
+
+def load_index(index_path):
+    if is_sharded(index_path):
+        index = similarities.Similarity.load(index_path)
+        index.output_prefix = index_path
+        index.check_moved()
+    else:
+        index = similarities.MatrixSimilarity.load(index_path, mmap='r')
+    return index
+
+
+def build_index(index_path, vecs, num_features, shardsize=SHARD_SIZE):
+    '''Builds an index of vecs of the type of index_path and saves it.'''
+    if is_sharded(index_path):
+        index = similarities.Similarity(index_path, vecs, num_features,
+                                        shardsize=shardsize)
+        index.save(index_path)
+    else:
+        index = similarities.MatrixSimilarity(vecs, num_features=num_features)
+        index.save(index_path, sep_limit=0)  # to be memory-mapped
+    return index
+
+
+def iter_index_vectors(index):
+    '''Yields the indexed vectors as dense arrays, a shard at a time.'''
+    if isinstance(index, similarities.Similarity):
+        for chunk in index.iter_chunks():
+            if hasattr(chunk, 'toarray'):
+                chunk = chunk.toarray()
+            for v in chunk:
+                yield v
+    else:
+        for v in index.index:
+            yield v
+
+
+def convert_index(index_path, out_path, shardsize=SHARD_SIZE):
+    '''Copies the vectors of an index into an index of another type.'''
+    src = load_index(index_path)
+    vecs = (matutils.full2sparse(v) for v in iter_index_vectors(src))
+    return build_index(out_path, vecs, src.num_features, shardsize=shardsize)
+
+
 def ensure_dir(d):
     b = True
     if not os.path.exists(d):
@@ -59,60 +139,195 @@ def ensure_dir(d):
     return b
 
 
-def search(index_path, mname, dpath, ntopics=32, nsims=10, lang='fortran',
-           outfile=None):
-    try:
-        ldmodel = MODEL_LOADER_TBL[mname]
-    except KeyError:
-        logger.error(f'model not found: "{mname}"')
-
+def get_tfidf_path(index_path):
+    '''An updated index has its own TF-IDF model.'''
     (a, _) = os.path.splitext(index_path)
+    path = a+'.tfidf'
+    if not os.path.exists(path):
+        path = os.path.join(os.path.dirname(index_path), 'survey.tfidf')
+    return path
+
+
+class TopicIndex(object):
+    '''Assets for topic search: dictionary, model, similarity index, TF-IDF
+    model and class names. Only arrays stored in separate .npy files are
+    memory-mapped, i.e. those of assets saved with sep_limit=0 (as
+    update_topic_index does); the shipped assets pickle them inline and are
+    loaded into memory.
+    '''
+    def __init__(self, index_path, mname='lsi'):
+        (a, _) = os.path.splitext(index_path)
 
-    logger.info('loading dictionary...')
+        ldmodel = MODEL_LOADER_TBL[mname]
 
-    dictionary = corpora.Dictionary.load(a+'.dict')
+        logger.info('loading dictionary...')
+        self.dictionary = corpora.Dictionary.load(a+'.dict')
+
+        logger.info('loading model...')
+        self.model = ldmodel(a+'.model', mmap='r')
+
+        if isinstance(self.model, models.LsiModel):
+            if getattr(self.model, 'projection', None) is None:
+                raise FileNotFoundError(f'no projection loaded for "{a}.model"'
+                                        f' (missing "{a}.model.projection"?)')
+
+        logger.info('loading index...')
+        self.index = load_index(index_path)
+
+        self.tfidf = models.TfidfModel.load(get_tfidf_path(index_path),
+                                            mmap='r')
+
+        with open(a+'.classes', 'rb') as f:
+            self.classes = cPickle.load(f)
+
+    def get_sims(self, bow, k=None):
+        vec = self.model[bow]
+        return top_k(self.index[vec], k)
+
+    def transform(self, bows):
+        '''Returns the topic vectors of bows as rows of a dense matrix. An LSI
+        projection is applied to the sparse BoW matrix at once.
+        '''
+        model = self.model
+        if isinstance(model, models.LsiModel):
+            X = matutils.corpus2csc(bows, num_terms=model.num_terms,
+                                    dtype=model.projection.u.dtype)
+            return np.asarray(X.T @ model.projection.u[:, :model.num_topics])
+        else:
+            return matutils.corpus2dense(model[bows], num_terms=model.num_topics,
+                                         num_docs=len(bows)).T
+
+    def query(self, Q):
+        '''Returns the similarities of the rows of Q to the classes.'''
+        norms = np.linalg.norm(Q, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        Q = (Q / norms).astype(np.float32)
+        if isinstance(self.index, similarities.Similarity):
+            return np.atleast_2d(self.index[Q])
+        return Q @ self.index.index.T
+
+    def get_sims_batch(self, bows, k=None):
+        '''Queries the index with several documents in one matrix
+        multiplication. Returns a list of top k lists.
+        '''
+        if not bows:
+            return []
+        return top_k(self.query(self.transform(bows)), k)
+
+
+INDEX_CACHE = {}  # (index path, model name) -> TopicIndex
+
+
+def get_topic_index(index_path, mname='lsi'):
+    '''Loads topic search assets once per process.'''
+    key = (os.path.abspath(index_path), mname)
+    try:
+        ti = INDEX_CACHE[key]
+    except KeyError:
+        ti = TopicIndex(index_path, mname)
+        INDEX_CACHE[key] = ti
+    return ti
 
-    logger.info('loading model...')
-    model = ldmodel(a+'.model')
 
-    texts = get_texts(dpath, FNAME_PAT_TBL[lang])
+def dump_sims(outfile, sims, classes):
+    b = False
+    if ensure_dir(os.path.dirname(outfile)):
+        try:
+            with open(outfile, 'w') as f:
+                data = []
+                for sim in sims:
+                    data.append({'topic': classes[sim[0]],
+                                 'similarity': str(sim[1])})
+                json.dump(data, f)
+                b = True
+        except Exception as e:
+            logger.warning(str(e))
+    return b
 
-    text = list(chain.from_iterable(texts))
 
-    logger.info('loading index...')
+def search(index_path, mname, dpath, ntopics=32, nsims=10, lang='fortran',
+           outfile=None, nprocs=1, token_cache=TOKEN_CACHE_PATH):
+    try:
+        ti = get_topic_index(index_path, mname)
+    except KeyError:
+        logger.error(f'model not found: "{mname}"')
+        return
 
-    index = similarities.MatrixSimilarity.load(index_path)
+    pat = FNAME_PAT_TBL[lang]
 
-    bow = dictionary.doc2bow(text)
+    if token_cache:
+        with TokenCache(token_cache) as cache:
+            counts = get_word_counts(dpath, pat, nprocs=nprocs, cache=cache)
+    else:
+        counts = get_word_counts(dpath, pat, nprocs=nprocs)
 
-    tfidf_path = os.path.join(os.path.dirname(index_path), 'survey.tfidf')
+    dictionary = ti.dictionary
 
-    tfidf = models.TfidfModel.load(tfidf_path)
-    vec_tfidf = tfidf[bow]
+    bow = counts_to_bow(dictionary, counts)
+
+    vec_tfidf = ti.tfidf[bow]
 
     print('*** TF-IDF:')
     print(', '.join(['%s:%f' % (dictionary[i], v) for (i, v) in sorted(vec_tfidf, key=lambda x: -x[1])[0:32]]))
 
-    vec = model[bow]
-
-    sims = sorted(enumerate(index[vec]), key=lambda x: -x[1])
+    sims = ti.get_sims(bow, k=nsims)
 
-    classes = cPickle.load(open(a+'.classes', 'rb'))
+    classes = ti.classes
 
     if outfile:
-        if ensure_dir(os.path.dirname(outfile)):
-            with open(outfile, 'w') as f:
-                data = []
-                for sim in sims[0:nsims]:
-                    data.append({'topic': classes[sim[0]],
-                                 'similarity': str(sim[1])})
-                json.dump(data, f)
+        dump_sims(outfile, sims[0:nsims], classes)
 
     print('*** Similarities:')
     for sim in sims[0:nsims]:
         print('%s: %f' % (classes[sim[0]], sim[1]))
 
 
+def search_batch(index_path, mname, dpaths, outfiles, nsims=10, lang='fortran',
+                 nprocs=1, token_cache=TOKEN_CACHE_PATH):
+    '''Searches topics of the documents under each of dpaths and dumps them
+    into the corresponding outfiles in the format of search. Documents of
+    all the directories are tokenized in one pool and the index is queried
+    once for all of them. Returns the elapsed time of each stage.
+    '''
+    report = {'projects': len(dpaths), 'written': 0, 'time': {}}
+    times = report['time']
+
+    st = time()
+    ti = get_topic_index(index_path, mname)
+    times['load'] = time() - st
+
+    pat = FNAME_PAT_TBL[lang]
+
+    st = time()
+    if token_cache:
+        with TokenCache(token_cache) as cache:
+            counts_list = get_word_counts_multi(dpaths, pat, nprocs=nprocs,
+                                                cache=cache)
+    else:
+        counts_list = get_word_counts_multi(dpaths, pat, nprocs=nprocs)
+    times['tokenize'] = time() - st
+
+    st = time()
+    bows = [counts_to_bow(ti.dictionary, c) for c in counts_list]
+    Q = ti.transform(bows)
+    times['transform'] = time() - st
+
+    st = time()
+    sims_list = top_k(ti.query(Q), nsims) if bows else []
+    times['query'] = time() - st
+
+    st = time()
+    for (outfile, sims) in zip(outfiles, sims_list):
+        if dump_sims(outfile, sims, ti.classes):
+            report['written'] += 1
+    times['write'] = time() - st
+
+    for (k, t) in times.items():
+        logger.info(f'{k}: {t:.3f}s')
+
+    return report
+
+
 if __name__ == '__main__':
     from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 
@@ -135,6 +350,13 @@ if __name__ == '__main__':
     parser.add_argument('-o', '--outfile', dest='outfile', default=None,
                         metavar='FILE', type=str, help='dump JSON into FILE')
 
+    parser.add_argument('-j', '--jobs', dest='nprocs', metavar='N', type=int,
+                        default=1, help='number of tokenizer processes')
+
+    parser.add_argument('-c', '--token-cache', dest='token_cache',
+                        metavar='PATH', type=str, default=TOKEN_CACHE_PATH,
+                        help='cache word counts of documents in PATH')
+
     parser.add_argument('index_path', metavar='INDEX_FILE', type=str,
                         help='index file')
 
@@ -143,4 +365,5 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     search(args.index_path, args.model, args.dpath,
-           ntopics=args.ntopics, nsims=args.nsims, outfile=args.outfile)
+           ntopics=args.ntopics, nsims=args.nsims, outfile=args.outfile,
+           nprocs=args.nprocs, token_cache=args.token_cache)
@@ -24,12 +24,20 @@ __author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
 
 import os
 import csv
+import codecs
+import glob
+from itertools import islice
+from time import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import json
 import logging
 
 from .sourcecode_metrics_for_survey_base import BF
-from .classify_loops import classify
+from .classify_loops import (iter_classified, to_float_array,
+                             get_filter_mask, CHUNK_SIZE)
+from .model_registry import Model, iter_classified_multi
+from .classifier_service import Client, SOCK_PATH
 
 logger = logging.getLogger()
 
@@ -44,7 +52,15 @@ BASE = 'survey-outline'
 TARGET_DIR = os.path.join(BASE, TARGET_DIR_NAME)
 
 
-def dump(ptbl, rtbl, filename_suffix='', target_dir=TARGET_DIR):
+def write_json(path, obj):
+    '''Writes obj into path atomically.'''
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(json.dumps(obj))
+    os.replace(tmp, path)
+
+
+def dump(ptbl, rtbl, filename_suffix='', target_dir=TARGET_DIR, verbose=True):
     for (proj, vtbl) in ptbl.items():
         pdir = os.path.join(target_dir, proj)
 
@@ -55,16 +71,17 @@ def dump(ptbl, rtbl, filename_suffix='', target_dir=TARGET_DIR):
         else:
             os.makedirs(pdir)
 
-        print('* %s:' % pdir)
+        if verbose:
+            print('* %s:' % pdir)
 
         for (ver, nids) in vtbl.items():
             path = os.path.join(pdir, ver+filename_suffix+'.json')
 
-            print('  - %s: [%s]' % (path, ','.join(nids)))
+            if verbose:
+                print('  - %s: [%s]' % (path, ','.join(nids)))
 
             try:
-                with open(path, 'w') as f:
-                    f.write(json.dumps(nids))
+                write_json(path, nids)
 
             except Exception as e:
                 logger.warning(str(e))
@@ -74,8 +91,7 @@ def dump(ptbl, rtbl, filename_suffix='', target_dir=TARGET_DIR):
             if root_file_l:
                 rpath = os.path.join(pdir, 'roots-%s.json' % ver)
                 try:
-                    with open(rpath, 'w') as rf:
-                        rf.write(json.dumps(root_file_l))
+                    write_json(rpath, root_file_l)
 
                 except Exception as e:
                     logger.warning(str(e))
@@ -97,7 +113,7 @@ def add_root_file(rtbl, proj, ver, root_file):
     root_files.add(root_file)
 
 
-def add_nid(ptbl, proj, ver, nid):
+def get_nids(ptbl, proj, ver):
     try:
         vtbl = ptbl[proj]
     except KeyError:
@@ -110,166 +126,319 @@ def add_nid(ptbl, proj, ver, nid):
         nids = []
         vtbl[ver] = nids
 
-    nids.append(nid)
+    return nids
+
+
+def add_nid(ptbl, proj, ver, nid):
+    get_nids(ptbl, proj, ver).append(nid)
+
+
+def iter_predictions(fname, clf, model='minami', filt={}):
+    '''Yields (y_pred, meta) for each chunk. clf is either the path of a
+    dumped classifier, whose features are given by model, or a registered
+    Model, which brings its own schema.
+    '''
+    if isinstance(clf, Model):
+        for (preds, chunk) in iter_classified_multi(fname, [clf], filt=filt):
+            yield (preds[clf.name], chunk)
+    else:
+        yield from iter_classified(fname, clf, model=model, filt=filt)
+
+
+def find_kernels(fname, clf_path, model='minami', filt={}):
+    '''Classifies the loops in a metrics CSV of the outline, which has the
+    nid and root_file of each loop. clf_path may also be a registered
+    Model (see iter_predictions). Returns (ptbl, rtbl, nrows)
+    where ptbl maps proj -> ver -> kernel nid list and rtbl maps
+    proj -> ver -> root_file set. Every (proj, ver) classified gets an
+    entry in ptbl, so that versions without kernels are dumped as well.
+    '''
+    ptbl = {}  # proj -> ver -> nid list
+    rtbl = {}  # proj -> ver -> root_file set
+
+    nrows = 0
+
+    for (y, meta) in iter_predictions(fname, clf_path, model=model,
+                                      filt=filt):
+        nrows += len(y)
+
+        if len(y) > 0 and not np.any(meta['nid'] != ''):
+            raise ValueError(f'no nid found in "{fname}"'
+                             ' (not a metrics CSV of the outline?)')
+
+        for (proj, ver) in set(zip(meta['proj'], meta['ver'])):
+            get_nids(ptbl, proj, ver)
+
+        is_kernel = y == 'Kernel'
+
+        for (proj, ver, nid, root_file) in zip(meta['proj'][is_kernel],
+                                               meta['ver'][is_kernel],
+                                               meta['nid'][is_kernel],
+                                               meta['root_file'][is_kernel]):
+            add_root_file(rtbl, proj, ver, root_file)
+            add_nid(ptbl, proj, ver, nid)
+
+    return (ptbl, rtbl, nrows)
+
+
+def find_kernels_served(fname, clf_path, model='minami', filt={},
+                        sock_path=SOCK_PATH):
+    '''Same as find_kernels but asks the classifier service to classify
+    fname when it is running. Falls back to classifying in process if the
+    service is not running or fails. Registered models are looked up by
+    name in the registry of the service.
+    '''
+    if os.path.exists(sock_path) and all(isinstance(f, tuple)
+                                         for f in filt.values()):
+        if isinstance(clf_path, Model):
+            name = clf_path.name
+        else:
+            name = clf_path
+        try:
+            with Client(sock_path) as client:
+                return client.find_kernels(name, fname, model=model,
+                                           filt=filt)
+        except Exception as e:
+            logger.warning(f'classifier service: {e}')
+
+    return find_kernels(fname, clf_path, model=model, filt=filt)
+
+
+def count_kernels(ptbl):
+    return sum(len(nids) for vtbl in ptbl.values() for nids in vtbl.values())
 
 
 def predict_kernels(fname, clf_path, model='minami', filt={},
                     filename_suffix='', target_dir=TARGET_DIR):
     try:
-        ptbl = {}  # proj -> ver -> nid list
-        rtbl = {}  # proj -> ver -> root_file set
+        (ptbl, rtbl, _) = find_kernels_served(fname, clf_path, model=model,
+                                              filt=filt)
 
-        data = classify(fname, clf_path, model=model, filt=filt, verbose=False)
+        count = count_kernels(ptbl)
 
-        if data:
-            count = 0
+        logger.info('predicted %d kernels' % count)
 
-            for i in range(len(data.y)):
-                c = data.y[i]
-                if c == 'Kernel':
-                    m = data.meta[i]
-                    proj = m['proj']
-                    ver = m['ver']
-                    nid = m['nid']
-                    root_file = m['root_file']
+        dump(ptbl, rtbl, filename_suffix=filename_suffix,
+             target_dir=target_dir)
 
-                    add_root_file(rtbl, proj, ver, root_file)
-                    add_nid(ptbl, proj, ver, nid)
+    except Exception as e:
+        logger.error(str(e))
 
-                    count += 1
 
-            logger.info('predicted %d kernels' % count)
+def get_metrics_files(paths):
+    '''Expands directories into the metrics CSV files they contain. Metrics
+    stores (.npz, .parquet) are not collected since they carry no nids.
+    '''
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(glob.escape(path),
+                                                       '*.csv'))))
+        else:
+            files.append(path)
+    return files
 
-            dump(ptbl, rtbl, filename_suffix=filename_suffix,
-                 target_dir=target_dir)
 
-    except Exception as e:
-        logger.error(str(e))
+def _find_kernels(fname, clf_path, model, filt):
+    st = time()
+    (ptbl, rtbl, nrows) = find_kernels(fname, clf_path, model=model,
+                                       filt=filt)
+    return (fname, ptbl, rtbl, nrows, time() - st)
 
 
-def sample(fname, nsamples,
-           bf0_thresh_upper=None,
-           bf1_thresh_upper=None,
-           bf2_thresh_upper=None,
-           bf0_thresh_lower=None,
-           bf1_thresh_lower=None,
-           bf2_thresh_lower=None,
-           delim=',',
-           filename_suffix=''):
+def merge_tbls(ptbl, rtbl, ptbl1, rtbl1):
+    for (proj, vtbl) in ptbl1.items():
+        for (ver, nids) in vtbl.items():
+            ptbl.setdefault(proj, {}).setdefault(ver, []).extend(nids)
+    for (proj, vtbl) in rtbl1.items():
+        for (ver, root_files) in vtbl.items():
+            rtbl.setdefault(proj, {}).setdefault(ver, set()).update(root_files)
+
+
+def predict_kernels_batch(paths, clf_path, model='minami', filt={},
+                          filename_suffix='', target_dir=TARGET_DIR,
+                          nprocs=1):
+    '''Classifies metrics CSV files (or directories of them) concurrently
+    and writes the target lists once all of them are classified. Files
+    without nids are reported as failed. Returns a report of throughput and
+    kernel counts per project.
+    '''
+    files = get_metrics_files(paths)
+
+    logger.info(f'{len(files)} metrics files')
+
+    ptbl = {}
+    rtbl = {}
+    nrows = 0
+    failed = []
+
+    st = time()
+
+    def add(res):
+        nonlocal nrows
+        (fname, ptbl1, rtbl1, n, t) = res
+        merge_tbls(ptbl, rtbl, ptbl1, rtbl1)
+        nrows += n
+        logger.info(f'{fname}: {count_kernels(ptbl1)}/{n} kernels'
+                    f' ({t:.2f}s)')
+
+    if nprocs == 1:
+        for fname in files:
+            try:
+                add(_find_kernels(fname, clf_path, model, filt))
+            except Exception as e:
+                logger.error(f'{fname}: {e}')
+                failed.append(fname)
+    else:
+        with ProcessPoolExecutor(max_workers=nprocs) as executor:
+            futures = {}
+            for fname in files:
+                fut = executor.submit(_find_kernels, fname, clf_path, model,
+                                      filt)
+                futures[fut] = fname
+
+            for fut in as_completed(futures):
+                try:
+                    add(fut.result())
+                except Exception as e:
+                    logger.error(f'{futures[fut]}: {e}')
+                    failed.append(futures[fut])
 
-    delim = delim.decode('string_escape')
-    try:
-        rows = []
+    t_classify = time() - st
 
-        is_head = True
+    dump(ptbl, rtbl, filename_suffix=filename_suffix, target_dir=target_dir,
+         verbose=False)
 
-        head = None
+    t = time() - st
 
-        with open(fname, 'rb') as f:
-            reader = csv.reader(f, delimiter=delim)
-            for row in reader:
-                if is_head:
-                    head = row
-                else:
-                    rows.append(row)
-                is_head = False
+    kernels = dict((proj, count_kernels({proj: vtbl}))
+                   for (proj, vtbl) in sorted(ptbl.items()))
 
-        logger.info('%d rows found' % len(rows))
+    report = {
+        'files':        len(files),
+        'failed':       failed,
+        'rows':         nrows,
+        'kernels':      sum(kernels.values()),
+        'projects':     kernels,
+        'classify_time': t_classify,
+        'total_time':   t,
+        'rows_per_sec': nrows / t_classify if t_classify > 0 else 0.0,
+    }
 
-        #
+    logger.info('predicted %d kernels in %d rows (%.1f rows/s, %.2fs)'
+                % (report['kernels'], nrows, report['rows_per_sec'], t))
 
-        projs = set()
+    return report
 
-        proj_i = head.index('proj')
-        ver_i = head.index('ver')
-        path_i = head.index('path')
-        lnum_i = head.index('lnum')
-        digest_i = head.index('digest')
-        nid_i = head.index('nid')
 
-        root_file_i = head.index('root_file')
+def reservoir_update(reservoir, rows, nseen, nsamples, rng):
+    '''Feeds rows into a reservoir of size nsamples (Algorithm R), nseen
+    being the number of rows fed so far. Returns the new nseen.
+    '''
+    n = len(rows)
+    nfill = min(max(nsamples - nseen, 0), n)
+    reservoir.extend(rows[:nfill])
 
-        bf_i = [head.index(BF[lv]) for lv in range(3)]
+    if nfill < n:
+        ts = np.arange(nseen + nfill, nseen + n)
+        js = rng.integers(0, ts + 1)
+        for i in np.nonzero(js < nsamples)[0]:
+            reservoir[js[i]] = rows[nfill + i]
 
-        to_be_deleted = []
+    return nseen + n
 
-        bf_thresh_upper = [bf0_thresh_upper, bf1_thresh_upper, bf2_thresh_upper]
-        bf_thresh_lower = [bf0_thresh_lower, bf1_thresh_lower, bf2_thresh_lower]
 
-        for idx in range(len(rows)):
-            row = rows[idx]
-            projs.add(row[proj_i])
+SAMPLE_KEYS = ['proj', 'ver', 'path', 'lnum', 'digest', 'nid', 'root_file']
 
-            del_flag = False
 
-            for lv in range(3):
-                if bf_thresh_upper[lv] is not None:
-                    try:
-                        if float(row[bf_i[lv]]) >= bf_thresh_upper[lv]:
-                            del_flag = True
+def sample(fnames, nsamples,
+           bf0_thresh_upper=None,
+           bf1_thresh_upper=None,
+           bf2_thresh_upper=None,
+           bf0_thresh_lower=None,
+           bf1_thresh_lower=None,
+           bf2_thresh_lower=None,
+           delim=',',
+           filename_suffix='',
+           seed=None,
+           chunk_size=CHUNK_SIZE,
+           target_dir=TARGET_DIR):
+    '''Samples nsamples loops uniformly from those within the B/F
+    thresholds of the metrics CSV files (or directories of them) fnames in
+    a single pass, keeping only the samples in memory. All the loops are
+    taken when nsamples is not positive.
+    '''
+    if isinstance(fnames, str):
+        fnames = [fnames]
+
+    delim = codecs.decode(delim, 'unicode_escape')
+    try:
+        rng = np.random.default_rng(seed)
 
-                    except Exception as e:
-                        logger.warning(str(e))
+        samples = []
 
-                if bf_thresh_lower[lv] is not None:
-                    try:
-                        if float(row[bf_i[lv]]) <= bf_thresh_lower[lv]:
-                            del_flag = True
+        nrows = 0
+        nseen = 0
+        nbad = 0
 
-                    except Exception as e:
-                        logger.warning(str(e))
+        projs = set()
+        projs_selected = set()
 
-            if del_flag:
-                to_be_deleted.append(idx)
+        bf_thresh_upper = [bf0_thresh_upper, bf1_thresh_upper, bf2_thresh_upper]
+        bf_thresh_lower = [bf0_thresh_lower, bf1_thresh_lower, bf2_thresh_lower]
 
-        logger.info('%d projects found' % len(projs))
+        for fname in get_metrics_files(fnames):
+            with open(fname, newline='') as f:
+                reader = csv.reader(f, delimiter=delim)
+                head = next(reader)
 
-        to_be_deleted.reverse()
+                key_i = [head.index(k) for k in SAMPLE_KEYS]
+                bf_i = [head.index(BF[lv]) for lv in range(3)]
 
-        for i in to_be_deleted:
-            del rows[i]
+                while True:
+                    rows = list(islice(reader, chunk_size))
+                    if not rows:
+                        break
 
-        fmt = '%d rows deleted (bf_thresh: upper=%3.2f,%3.2f,%3.2f lower=%3.2f,%3.2f,%3.2f)'
-        logger.warning(fmt % (len(to_be_deleted),
-                              bf0_thresh_upper,
-                              bf1_thresh_upper,
-                              bf2_thresh_upper,
-                              bf0_thresh_lower,
-                              bf1_thresh_lower,
-                              bf2_thresh_lower,
-                              ))
+                    nrows += len(rows)
 
-        logger.info('%d rows' % len(rows))
+                    projs.update(row[key_i[0]] for row in rows)
 
-        projs = set()
-        for row in rows:
-            projs.add(row[proj_i])
+                    mask = np.ones(len(rows), dtype=bool)
 
-        logger.info('%d projects' % len(projs))
+                    for lv in range(3):
+                        col = to_float_array([row[bf_i[lv]] for row in rows])
+                        bad = np.isnan(col)
+                        nbad += int(bad.sum())
+                        bounds = (bf_thresh_lower[lv], bf_thresh_upper[lv])
+                        mask &= get_filter_mask(col, bounds) | bad
 
-        #
+                    selected = [tuple(rows[i][j] for j in key_i)
+                                for i in np.nonzero(mask)[0]]
+                    projs_selected.update(x[0] for x in selected)
 
-        samples = []
+                    if nsamples > 0:
+                        nseen = reservoir_update(samples, selected, nseen,
+                                                 nsamples, rng)
+                    else:
+                        samples.extend(selected)
+                        nseen += len(selected)
 
-        if 0 < nsamples < len(rows):
+        logger.info('%d rows found' % nrows)
+        logger.info('%d projects found' % len(projs))
 
-            np.random.seed()
-            np.random.shuffle(rows)
+        if nbad:
+            logger.warning('%d invalid B/F values' % nbad)
 
-            idxs = set()
+        logger.warning('%d rows deleted (bf_thresh: upper=%s,%s,%s lower=%s,%s,%s)'
+                       % ((nrows - nseen,) + tuple(bf_thresh_upper) + tuple(bf_thresh_lower)))
 
-            while True:
-                idx = np.random.randint(1, len(rows))
-                if idx not in idxs:
-                    idxs.add(idx)
-                    samples.append(rows[idx])
-                    if len(idxs) == nsamples:
-                        break
+        logger.info('%d rows' % nseen)
+        logger.info('%d projects' % len(projs_selected))
 
-        else:
-            samples = rows
+        #
 
-        samples.sort(key=lambda x: x[15])
+        samples.sort(key=lambda x: x[:4])
 
         logger.info('%d samples extracted' % len(samples))
 
@@ -279,15 +448,7 @@ def sample(fname, nsamples,
         rtbl = {}  # proj -> ver -> root_file set
         dtbl = {}  # digest -> (proj * ver * path * lnum) set
 
-        for row in samples:
-            proj = row[proj_i]
-            ver = row[ver_i]
-            path = row[path_i]
-            lnum = row[lnum_i]
-            nid = row[nid_i]
-            digest = row[digest_i]
-            root_file = row[root_file_i]
-
+        for (proj, ver, path, lnum, digest, nid, root_file) in samples:
             add_root_file(rtbl, proj, ver, root_file)
 
             try:
@@ -306,7 +467,8 @@ def sample(fname, nsamples,
                 for pvpl in pvpls:
                     logger.warning('- %s:%s:%s:%s' % pvpl)
 
-        dump(ptbl, rtbl, filename_suffix=filename_suffix)
+        dump(ptbl, rtbl, filename_suffix=filename_suffix,
+             target_dir=target_dir)
 
     except Exception as e:
         logger.error(str(e))
@@ -348,6 +510,9 @@ if __name__ == '__main__':
                         metavar='R', type=float, default=-0.1,
                         help='exclusive lower B/F threshold (lv=2)')
 
+    parser.add_argument('--seed', dest='seed', metavar='N', type=int,
+                        default=None, help='random seed for sampling')
+
     parser.add_argument('--delim', dest='delim', metavar='DELIMITER', type=str,
                         default=',', help='specify delimiter of CSV')
 
@@ -366,28 +531,44 @@ if __name__ == '__main__':
                         type=str, default=TARGET_DIR,
                         help='specify output directory')
 
-    parser.add_argument('metrics_file', default='metrics.csv', nargs='?',
-                        metavar='FILE', type=str, help='metrics file')
+    parser.add_argument('-j', '--jobs', dest='nprocs', metavar='N',
+                        type=int, default=1,
+                        help='number of metrics files classified in parallel')
+
+    parser.add_argument('-r', '--report', dest='report', metavar='PATH',
+                        type=str, default=None,
+                        help='dump prediction report (JSON) into PATH')
+
+    parser.add_argument('metrics_files', default=['metrics.csv'], nargs='*',
+                        metavar='FILE', type=str,
+                        help='metrics CSV files of the outline or directories'
+                        ' of them')
 
     args = parser.parse_args()
 
     if args.clf:
         filt = {
-            'bf0': lambda x: x > args.bf0_thresh_lower and x < args.bf0_thresh_upper,
-            'bf1': lambda x: x > args.bf1_thresh_lower and x < args.bf1_thresh_upper,
-            'bf2': lambda x: x > args.bf2_thresh_lower and x < args.bf2_thresh_upper,
+            'bf0': (args.bf0_thresh_lower, args.bf0_thresh_upper),
+            'bf1': (args.bf1_thresh_lower, args.bf1_thresh_upper),
+            'bf2': (args.bf2_thresh_lower, args.bf2_thresh_upper),
         }
         logger.info('predicting kernels...')
-        predict_kernels(args.metrics_file,
-                        args.clf,
-                        model=args.model,
-                        filt=filt,
-                        filename_suffix=args.suffix,
-                        target_dir=args.outdir)
+        report = predict_kernels_batch(args.metrics_files,
+                                       args.clf,
+                                       model=args.model,
+                                       filt=filt,
+                                       filename_suffix=args.suffix,
+                                       target_dir=args.outdir,
+                                       nprocs=args.nprocs)
+        if args.report:
+            write_json(args.report, report)
+        else:
+            for (proj, c) in report['projects'].items():
+                print('%s: %d' % (proj, c))
 
     else:
         logger.info('sampling target loops...')
-        sample(args.metrics_file,
+        sample(args.metrics_files,
                args.nsamples,
                bf0_thresh_upper=args.bf0_thresh_upper,
                bf1_thresh_upper=args.bf1_thresh_upper,
@@ -396,4 +577,6 @@ if __name__ == '__main__':
                bf1_thresh_lower=args.bf1_thresh_lower,
                bf2_thresh_lower=args.bf2_thresh_lower,
                delim=args.delim,
-               filename_suffix=args.suffix)
+               filename_suffix=args.suffix,
+               seed=args.seed,
+               target_dir=args.outdir)
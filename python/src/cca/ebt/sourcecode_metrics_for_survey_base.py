@@ -22,12 +22,17 @@
 __author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
 
 import pprint
+from time import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import logging
 
+from . import metrics_store
+
 from cca.ccautil.sparql import get_localname
 from cca.ccautil import sparql
 from cca.ccautil.ns import FB_NS, NS_TBL
 from cca.ccautil.virtuoso import VIRTUOSO_PW, VIRTUOSO_PORT
+from cca.factutil.entity import SourceCodeEntity
 
 logger = logging.getLogger()
 
@@ -121,44 +126,87 @@ def get_proj_list(method='odbc'):
     return proj_list
 
 
-def ftbl_list_to_orange(ftbl_list, outfile, META_KEYS):
-
-    if not ftbl_list:
-        return
-
-    import Orange
+def calc_ftbl_list(metrics_class, proj_id, method='odbc', key=None,
+                   opts=None):
+    opts = opts or {}
 
-    ks = ftbl_list[0].keys()
-    ks.remove('meta')
+    st = time()
 
-    items = list(ks)
+    m = metrics_class(proj_id, method=method, **opts)
+    m.calc()
 
-    features = [Orange.feature.Continuous(k) for k in items]
-    domain = Orange.data.Domain(features, False)
+    if key:
+        ftbl_list = m.search(key)
+    else:
+        ftbl_list = m.get_ftbl_list()
 
-    def add_meta(m):
-        domain.add_meta(Orange.feature.Descriptor.new_meta_id(), Orange.feature.String(m))
+    return (proj_id, ftbl_list, time() - st)
 
-    keys = META_KEYS
 
-    for k in keys:
-        add_meta(k)
+def iter_ftbl_lists(metrics_class, proj_list, method='odbc', key=None,
+                    nprocs=1, opts=None):
+    '''Yields (proj_id, ftbl_list, elapsed_time) in order of completion.
+    Each project is computed in its own worker with its own connection.
+    '''
+    opts = opts or {}
 
-    data = Orange.data.Table(domain)
+    if nprocs == 1:
+        for proj_id in proj_list:
+            try:
+                yield calc_ftbl_list(metrics_class, proj_id, method=method,
+                                     key=key, opts=opts)
+            except Exception as e:
+                logger.error(f'{proj_id}: {e}')
+        return
 
-    for ftbl in ftbl_list:
-        vs = [ftbl[item] for item in items]
-        inst = Orange.data.Instance(domain, vs)
-        m = ftbl['meta']
-        for k in keys:
-            inst[k] = m[k]
+    with ProcessPoolExecutor(max_workers=nprocs) as executor:
+        futures = {}
+        for proj_id in proj_list:
+            fut = executor.submit(calc_ftbl_list, metrics_class, proj_id,
+                                  method=method, key=key, opts=opts)
+            futures[fut] = proj_id
+
+        for fut in as_completed(futures):
+            try:
+                yield fut.result()
+            except Exception as e:
+                logger.error(f'{futures[fut]}: {e}')
+
+
+def run_metrics(metrics_class, proj_list, META_KEYS, method='odbc', key=None,
+                outfile=None, nprocs=1, chunk_size=metrics_store.CHUNK_SIZE,
+                opts=None):
+    '''Computes metrics for the projects and streams them into outfile
+    (.csv, .npz or .parquet). Returns the list of feature tables when outfile
+    is not given.
+    '''
+    opts = opts or {}
+
+    ftbl_list = []
+    writer = None
+    if outfile:
+        writer = metrics_store.open_writer(outfile, META_KEYS,
+                                           chunk_size=chunk_size)
+
+    st = time()
+    nprojs = 0
+    try:
+        for (proj_id, ftbls, t) in iter_ftbl_lists(metrics_class, proj_list,
+                                                   method=method, key=key,
+                                                   nprocs=nprocs, opts=opts):
+            nprojs += 1
+            logger.info(f'{proj_id}: {len(ftbls)} loops ({t:.2f}s)')
+            if writer:
+                writer.write(ftbls)
+            else:
+                ftbl_list += ftbls
+    finally:
+        if writer:
+            writer.close()
 
-        data.append(inst)
+    logger.info(f'{nprojs}/{len(proj_list)} projects done ({time()-st:.2f}s)')
 
-    try:
-        data.save(outfile)
-    except Exception as e:
-        logger.error(str(e))
+    return ftbl_list
 
 
 class Ent:
@@ -174,6 +222,9 @@ class Ent:
 
 
 class MetricsBase(object):
+
+    SUB_KEY = 'sub'
+
     def __init__(self, proj_id, method='odbc',
                  pw=VIRTUOSO_PW, port=VIRTUOSO_PORT):
 
@@ -183,35 +234,82 @@ class MetricsBase(object):
 
         self._tree = None
 
-        self._result_tbl = {}  # item name -> (ver * loc * lnum) -> value
+        self._result_tbl = {}  # item name -> mid -> value
+
+        self._kid_tbl = {}  # (ver * loc * sub * loop * vname) -> kid
+        self._key_list = []  # kid -> (ver * loc * sub * loop * vname)
 
-        self._metadata_tbl = {}  # (ver * loc * lnum) -> {'sub','digest'}
+        self._mid_tbl = {}  # (ver * loc * lnum) -> mid
+        self._mkey_list = []  # mid -> (ver * loc * lnum)
+        self._metadata_list = []  # mid -> (sub * digest)
+
+        self._kinfo_tbl = {}  # kid -> (mid * sub * digest)
 
         self._ipp_tbl = {}  # uri -> uri (inter-procedural parent tbl)
 
         self._ent_tbl = {}  # uri -> is_loop
 
-        self._loop_digest_tbl = {}  # (ver * loc * sub * loop) -> digest set
+        self._loop_digest_tbl = {}  # kid -> digest set
 
         self._max_loop_level_tbl = {}  # uri -> lv
 
-    def get_loop_digest(self, key):
+    def intern_key(self, key):
+        try:
+            kid = self._kid_tbl[key]
+        except KeyError:
+            kid = len(self._key_list)
+            self._kid_tbl[key] = kid
+            self._key_list.append(key)
+        return kid
+
+    def get_key_tuple(self, kid):
+        return self._key_list[kid]
+
+    def get_loop_digest(self, kid):
         digest = None
-        ds = self._loop_digest_tbl.get(key, None)
+        ds = self._loop_digest_tbl.get(kid, None)
         if ds:
-            digest = ':'.join(sorted(list(ds)))
+            digest = ':'.join(sorted(ds))
         return digest
 
-    def set_loop_digest(self, key, d):
+    def set_loop_digest(self, kid, d):
         try:
-            s = self._loop_digest_tbl[key]
+            s = self._loop_digest_tbl[kid]
         except KeyError:
             s = set()
-            self._loop_digest_tbl[key] = s
-        s.add(d)
+            self._loop_digest_tbl[kid] = s
+        if d not in s:
+            s.add(d)
+            self._kinfo_tbl.pop(kid, None)
+
+    def get_mid(self, mkey):
+        return self._mid_tbl[mkey]
+
+    def intern_mkey(self, mkey):
+        try:
+            mid = self._mid_tbl[mkey]
+        except KeyError:
+            mid = len(self._mkey_list)
+            self._mid_tbl[mkey] = mid
+            self._mkey_list.append(mkey)
+            self._metadata_list.append(None)
+        return mid
+
+    def get_kinfo(self, kid):
+        try:
+            kinfo = self._kinfo_tbl[kid]
+        except KeyError:
+            (ver, loc, sub, loop, vname) = self._key_list[kid]
+            ent = SourceCodeEntity(uri=loop)
+            lnum = ent.get_range().get_start_line()
+            mid = self.intern_mkey((ver, loc, str(lnum)))
+            kinfo = (mid, sub, self.get_loop_digest(kid))
+            self._kinfo_tbl[kid] = kinfo
+        return kinfo
 
     def get_metadata(self, key):
-        return self._metadata_tbl[key]
+        (sub, digest) = self._metadata_list[self.get_mid(key)]
+        return {self.SUB_KEY: sub, 'digest': digest}
 
     def get_tree(self):
         return self._tree
@@ -226,7 +324,7 @@ class MetricsBase(object):
         v = 0
 
         try:
-            v = self._result_tbl[name][key]
+            v = self._result_tbl[name][self.get_mid(key)]
         except KeyError:
             pass
 
@@ -256,16 +354,15 @@ class MetricsBase(object):
         raise KeyError
 
     def get_ftbl_list(self):
-        keys = set()
+        mids = set()
 
         for (item, tbl) in self._result_tbl.items():
-            for k in tbl.keys():
-                keys.add(k)
+            mids.update(tbl.keys())
 
         ftbl_list = []
 
-        for key in keys:
-            ftbl = self.find_ftbl(key)
+        for mid in mids:
+            ftbl = self.find_ftbl(self._mkey_list[mid])
             ftbl_list.append(ftbl)
 
         return ftbl_list
@@ -273,8 +370,26 @@ class MetricsBase(object):
     def key_to_string(self, key):
         return '<KEY>'
 
-    def set_metrics(self, name, _key, value, add=False):
-        pass
+    def set_metrics(self, name, kid, value, add=False):
+        (mid, sub, loop_d) = self.get_kinfo(kid)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            key_str = '%s:%s:%s' % self._mkey_list[mid]
+            logger.debug('%s(%s): %s -> %s' % (self.key_to_string(kid),
+                                               key_str, name, value))
+
+        self._metadata_list[mid] = (sub, loop_d)
+
+        try:
+            tbl = self._result_tbl[name]
+        except KeyError:
+            tbl = {}
+            self._result_tbl[name] = tbl
+
+        if add:
+            tbl[mid] = tbl.get(mid, 0) + value
+        else:
+            tbl[mid] = value
 
     def ipp_add(self, ent, parent, is_loop=False):
         try:
@@ -322,7 +437,8 @@ class MetricsBase(object):
                 fusible_tbl = {}
 
                 def find_fusible_loops(key):
-                    for (_, _, _, _, vn) in children_tbl.get(key, []):
+                    for c in children_tbl.get(key, []):
+                        vn = self._key_list[c][4]
                         try:
                             fusible_tbl[(key, vn)] += 1
                         except KeyError:
@@ -346,11 +462,10 @@ class MetricsBase(object):
         logger.info('done.')
 
     def get_key(self, row):
-        key = ('', '', '', '', '')
-        return key
+        return self.intern_key(('', '', '', '', ''))
 
-    def get_loop_of_key(self, key):
-        (lver, loc, sub, loop, vname) = key
+    def get_loop_of_key(self, kid):
+        (lver, loc, sub, loop, vname) = self._key_list[kid]
         return loop
 
     def calc_max_loop_level(self):
@@ -362,7 +477,7 @@ class MetricsBase(object):
             lv = self.get_max_loop_level(loop)
             if mx < lv:
                 mx = lv
-            logger.debug(f'{key}: {lv}')
+            logger.debug(f'{self.get_key_tuple(key)}: {lv}')
             self.set_metrics(MAX_LOOP_LEVEL, key, lv)
         logger.info(f'max loop level: {mx}')
 
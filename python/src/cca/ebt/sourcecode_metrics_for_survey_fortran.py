@@ -23,55 +23,17 @@ __author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
 
 import logging
 
-from .sourcecode_metrics_for_survey_base import get_proj_list, get_lver, ftbl_list_to_orange, MetricsBase
+from .sourcecode_metrics_for_survey_base import (get_proj_list, get_lver,
+                                                 run_metrics, MetricsBase)
 from .metrics_queries_fortran import QUERY_TBL
+from .fop_weight import get_arch, DEFAULT_ARCH
 
 from cca.ccautil.virtuoso import VIRTUOSO_PW, VIRTUOSO_PORT
+from cca.ccautil.common import setup_logger
 from cca.factutil.entity import SourceCodeEntity
 
 logger = logging.getLogger()
 
-FOP_TBL = {  # number of FP operations (for SPARC64 VIIIfx)
-    'nint':  2,
-    'jnint': 2,
-    'cos':   29,
-    'dcos':  31,
-    'exp':   19,
-    'dexp':  23,
-    'log':   19,
-    'alog':  19,
-    'dlog':  23,
-    'mod':   8,
-    'amod':  8,
-    'dmod':  8,
-    'sign':  2,
-    'dsign': 2,
-    'sin':   29,
-    'dsin':  31,
-    'sqrt':  11,
-    'dsqrt': 21,
-    'tan':   58,
-    'dtan':  64,
-}
-
-FOP_TBL_DBL_EXTRA = {
-    'cos':  2,
-    'exp':  4,
-    'log':  4,
-    'sin':  2,
-    'sqrt': 10,
-    'tan':  6,
-}
-
-FOP_TBL_VA = {
-    'max':   (lambda n: n-1),
-    'amax1': (lambda n: n-1),
-    'dmax1': (lambda n: n-1),
-    'min':   (lambda n: n-1),
-    'amin1': (lambda n: n-1),
-    'dmin1': (lambda n: n-1),
-}
-
 LINES_OF_CODE = 'lines_of_code'
 MAX_LOOP_DEPTH = 'max_loop_depth'
 MAX_FUSIBLE_LOOPS = 'max_fusible_loops'
@@ -137,19 +99,8 @@ def count_aas(aas):
     return c
 
 
-def get_nfops(name, nargs, double=False):
-    nfop = 1
-    try:
-        nfop = FOP_TBL_VA[name](nargs)
-    except KeyError:
-        nfop = FOP_TBL.get(name, 1)
-        if double:
-            nfop += FOP_TBL_DBL_EXTRA.get(name, 0)
-    prec = 's'
-    if double:
-        prec = 'd'
-    logger.debug('%s{%s}(%d) --> %d' % (name, prec, nargs, nfop))
-    return nfop
+def get_nfops(name, nargs, double=False, arch=DEFAULT_ARCH):
+    return get_arch(arch).get_nfops(name, nargs, double=double)
 
 
 def make_feature_tbl():
@@ -197,8 +148,7 @@ def ftbl_to_string(ftbl):
     cpy = ftbl.copy()
     cpy['meta'] = meta_str
 
-    ks = ftbl.keys()
-    ks.remove('meta')
+    ks = [k for k in ftbl.keys() if k != 'meta']
 
     fmt = '%(meta)s ('
 
@@ -213,14 +163,17 @@ def ftbl_to_string(ftbl):
 
 class Metrics(MetricsBase):
     def __init__(self, proj_id, method='odbc',
-                 pw=VIRTUOSO_PW, port=VIRTUOSO_PORT):
+                 pw=VIRTUOSO_PW, port=VIRTUOSO_PORT, arch=DEFAULT_ARCH):
 
         super().__init__(proj_id, method, pw, port)
 
+        self._fop_weight = get_arch(arch)
+
     def find_ftbl(self, key):
         md = self.get_metadata(key)
         sub = md['sub']
         digest = md['digest']
+        mid = self.get_mid(key)
 
         (ver, path, lnum) = key
 
@@ -248,48 +201,19 @@ class Metrics(MetricsBase):
 
         for item in ftbl.keys():
             try:
-                ftbl[item] = self._result_tbl[item][key]
+                ftbl[item] = self._result_tbl[item][mid]
             except KeyError:
                 pass
 
         return ftbl
 
-    def key_to_string(self, key):
-        (ver, loc, sub, loop, vname) = key
+    def key_to_string(self, kid):
+        (ver, loc, sub, loop, vname) = self.get_key_tuple(kid)
         e = SourceCodeEntity(uri=loop)
         lnum = e.get_range().get_start_line()
         s = '%s:%s:%s:%s' % (ver, loc, sub, lnum)
         return s
 
-    def set_metrics(self, name, _key, value, add=False):
-        # print('!!! set_metrics: name={} key={} value={} add={}'.format(name, _key, value, add))
-
-        (ver, loc, sub, loop, vname) = _key
-
-        ent = SourceCodeEntity(uri=loop)
-        lnum = ent.get_range().get_start_line()
-
-        key = (ver, loc, str(lnum))
-        key_str = '%s:%s:%s' % key
-
-        logger.debug('%s(%s): %s -> %s' % (self.key_to_string(_key), key_str, name, value))
-
-        loop_d = self.get_loop_digest(_key)
-
-        self._metadata_tbl[key] = {'sub': sub, 'digest': loop_d}
-
-        try:
-            tbl = self._result_tbl[name]
-        except KeyError:
-            tbl = {}
-            self._result_tbl[name] = tbl
-
-        if add:
-            v = tbl.get(key, 0)
-            tbl[key] = v + value
-        else:
-            tbl[key] = value
-
     def finalize_ipp(self):
         logger.info('finalizing call graph...')
 
@@ -327,7 +251,7 @@ class Metrics(MetricsBase):
 
             lver = get_lver(ver)
 
-            key = (lver, loc, sub, loop, vname)
+            key = self.intern_key((lver, loc, sub, loop, vname))
             self.set_loop_digest(key, loop_d)
 
             if f:
@@ -340,7 +264,8 @@ class Metrics(MetricsBase):
                 children_tbl[key] = child_loops
 
             if child_loop:
-                child_key = (lver, loc, sub, child_loop, child_vname)
+                child_key = self.intern_key((lver, loc, sub, child_loop,
+                                             child_vname))
                 self.set_loop_digest(child_key, child_loop_d)
 
                 if child_key not in child_loops:
@@ -372,7 +297,7 @@ class Metrics(MetricsBase):
         vname = row.get('vname', '')
 
         lver = get_lver(ver)
-        key = (lver, loc, sub, loop, vname)
+        key = self.intern_key((lver, loc, sub, loop, vname))
         return key
 
     def calc_array_metrics(self):
@@ -662,6 +587,14 @@ class Metrics(MetricsBase):
 
             #
 
+            refs = ((k, fn, na, dbl)
+                    for (k, fref_tbl) in tbl.items()
+                    for (fn, na, dbl) in fref_tbl.values())
+
+            nfop_tbl = self._fop_weight.calc_nfops(refs)  # key -> nfop
+
+            logger.debug(f'nfops of function references: {nfop_tbl}')
+
             tree = self.get_tree()
 
             def make_data():
@@ -674,10 +607,7 @@ class Metrics(MetricsBase):
                 data = make_data()
 
                 def f(k):
-                    fref_tbl = tbl.get(k, None)
-                    if fref_tbl:
-                        for (h, (fn, na, dbl)) in fref_tbl.items():
-                            data['nfop'] += get_nfops(fn, na, double=dbl)
+                    data['nfop'] += nfop_tbl.get(k, 0)
 
                 self.iter_tree(tree, key, f)
 
@@ -732,12 +662,22 @@ if __name__ == '__main__':
                         help='show metrics for KEY=VER:PATH:LNUM')
 
     parser.add_argument('-o', '--outfile', dest='outfile', default=None,
-                        metavar='FILE', type=str, help='dump feature vector into FILE')
+                        metavar='FILE', type=str,
+                        help='dump feature vector into FILE (.csv|.npz|.parquet)')
 
     parser.add_argument('-m', '--method', dest='method', default='odbc',
                         metavar='METHOD', type=str,
                         help='execute query via METHOD (odbc|http)')
 
+    parser.add_argument('-a', '--arch', dest='arch', default=DEFAULT_ARCH,
+                        metavar='ARCH', type=str,
+                        help='FP operation weights of intrinsics for ARCH'
+                        ' (name or JSON file)')
+
+    parser.add_argument('-j', '--jobs', dest='jobs', default=1,
+                        metavar='N', type=int,
+                        help='compute metrics of N projects in parallel')
+
     parser.add_argument('proj_list', nargs='*', default=[],
                         metavar='PROJ', type=str,
                         help='project id (default: all projects)')
@@ -763,26 +703,27 @@ if __name__ == '__main__':
     else:
         proj_list = get_proj_list()
 
-    ftbl_list = []
+    log_level = logging.INFO
+    if args.debug:
+        log_level = logging.DEBUG
+    setup_logger(logger, log_level)
 
-    for proj_id in proj_list:
-        m = Metrics(proj_id, method=args.method)
-        m.calc()
+    if args.outfile:
+        run_metrics(Metrics, proj_list, META_KEYS, method=args.method,
+                    key=args.key, outfile=args.outfile, nprocs=args.jobs,
+                    opts={'arch': args.arch})
+        exit(0)
 
-        if args.key:
-            ftbl_list += m.search(args.key)
-        else:
-            ftbl_list += m.get_ftbl_list()
+    ftbl_list = run_metrics(Metrics, proj_list, META_KEYS, method=args.method,
+                            key=args.key, nprocs=args.jobs,
+                            opts={'arch': args.arch})
 
     if ftbl_list:
-        if args.outfile:
-            ftbl_list_to_orange(ftbl_list, args.outfile, META_KEYS)
-        else:
-            for ftbl in sorted(ftbl_list,
-                               key=lambda x: (x['meta']['ver'],
-                                              x['meta']['sub'],
-                                              x['meta']['lnum'])):
-                print('%s' % ftbl_to_string(ftbl))
+        for ftbl in sorted(ftbl_list,
+                           key=lambda x: (x['meta']['ver'],
+                                          x['meta']['sub'],
+                                          x['meta']['lnum'])):
+            print('%s' % ftbl_to_string(ftbl))
 
     else:
         print('not found')
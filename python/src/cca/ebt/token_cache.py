@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+
+'''
+  A cache of word counts of documents
+
+  Copyright 2013-2018 RIKEN
+  Copyright 2018-2020 Chiba Institute of Technology
+
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+'''
+
+__author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
+
+import os
+import json
+import zlib
+import sqlite3
+import hashlib
+from time import time
+from collections import Counter
+import logging
+
+logger = logging.getLogger()
+
+TOKEN_CACHE_PATH = os.getenv('EBT_TOKEN_CACHE', None)
+
+MAX_ENTRIES = 200000
+
+COMMIT_INTERVAL = 1000  # writes
+
+TIMEOUT = 10.0  # seconds to wait for a lock held by another process
+
+SCHEMA_VERSION = 1
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tokens (
+  path   TEXT PRIMARY KEY,
+  size   INTEGER,
+  mtime  INTEGER,
+  digest TEXT,
+  counts BLOB,
+  atime  REAL
+)
+'''
+
+META_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+  key   TEXT PRIMARY KEY,
+  value TEXT
+)
+'''
+
+###
+
+
+def get_digest(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for b in iter(lambda: f.read(65536), b''):
+            h.update(b)
+    return h.hexdigest()
+
+
+def encode_counts(counts):
+    return zlib.compress(json.dumps(counts).encode('utf-8'))
+
+
+def decode_counts(blob):
+    return Counter(json.loads(zlib.decompress(blob).decode('utf-8')))
+
+
+class TokenCache(object):
+    '''Word counts of files keyed by absolute path, size and mtime. With
+    use_digest, a file whose size or mtime changed is looked up by its
+    content hash before it is tokenized again. Least recently used entries
+    beyond max_entries are evicted on close. All entries are dropped when
+    version (the tokenizer settings by default) differs from the one they
+    were made with. Writes are committed every COMMIT_INTERVAL writes and
+    on commit(), so that the database is not locked for long; a lookup or
+    write that fails on a locked database counts as a miss or is skipped.
+    '''
+    def __init__(self, path, max_entries=MAX_ENTRIES, use_digest=False,
+                 version=None):
+        if version is None:
+            from .analyze_topic import get_tokenizer_version
+            version = get_tokenizer_version()
+        d = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(d):
+            os.makedirs(d)
+        self._path = path
+        self._max_entries = max_entries
+        self._use_digest = use_digest
+        self._conn = sqlite3.connect(path, timeout=TIMEOUT)
+        self._conn.execute(SCHEMA)
+        self._conn.execute(META_SCHEMA)
+        self._conn.execute('CREATE INDEX IF NOT EXISTS atime_idx ON tokens (atime)')
+        self._check_version(f'{SCHEMA_VERSION}:{version}')
+        self._conn.commit()
+        self._nwrites = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _check_version(self, version):
+        row = self._conn.execute('SELECT value FROM meta WHERE key = ?',
+                                 ('version',)).fetchone()
+        if row is None or row[0] != version:
+            if row is not None:
+                logger.info('tokenizer changed, token cache cleared')
+            self._conn.execute('DELETE FROM tokens')
+            self._conn.execute('INSERT OR REPLACE INTO meta VALUES (?,?)',
+                               ('version', version))
+
+    def _write(self, sql, params):
+        self._conn.execute(sql, params)
+        self._nwrites += 1
+        if self._nwrites >= COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self):
+        try:
+            self._conn.commit()
+        except sqlite3.OperationalError as e:
+            logger.warning(f'token cache: {e}')
+        self._nwrites = 0
+
+    def get(self, path):
+        '''Returns cached counts of path or None.'''
+        path = os.path.abspath(path)
+        counts = None
+        try:
+            st = os.stat(path)
+            row = self._conn.execute('SELECT size, mtime, digest, counts FROM tokens'
+                                     ' WHERE path = ?', (path,)).fetchone()
+            if row:
+                (size, mtime, digest, blob) = row
+                if size == st.st_size and mtime == st.st_mtime_ns:
+                    counts = decode_counts(blob)
+                elif self._use_digest and digest == get_digest(path):
+                    counts = decode_counts(blob)
+                    self._write('UPDATE tokens SET size = ?, mtime = ?'
+                                ' WHERE path = ?',
+                                (st.st_size, st.st_mtime_ns, path))
+            if counts is not None:
+                self._write('UPDATE tokens SET atime = ? WHERE path = ?',
+                            (time(), path))
+        except (OSError, sqlite3.OperationalError) as e:
+            logger.debug(f'token cache: {path}: {e}')
+
+        if counts is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return counts
+
+    def put(self, path, counts):
+        path = os.path.abspath(path)
+        try:
+            st = os.stat(path)
+            digest = get_digest(path) if self._use_digest else None
+            self._write('INSERT OR REPLACE INTO tokens VALUES (?,?,?,?,?,?)',
+                        (path, st.st_size, st.st_mtime_ns, digest,
+                         encode_counts(counts), time()))
+        except (OSError, sqlite3.OperationalError) as e:
+            logger.debug(f'token cache: {path}: {e}')
+
+    def evict(self):
+        n = self._conn.execute('SELECT COUNT(*) FROM tokens').fetchone()[0]
+        excess = n - self._max_entries
+        if excess > 0:
+            self._conn.execute('DELETE FROM tokens WHERE path IN (SELECT path'
+                               ' FROM tokens ORDER BY atime LIMIT ?)',
+                               (excess,))
+            logger.info(f'{excess} entries evicted from token cache')
+
+    def close(self):
+        if self._conn:
+            try:
+                self.evict()
+            except sqlite3.OperationalError as e:
+                logger.warning(f'token cache: {e}')
+            self.commit()
+            self._conn.close()
+            self._conn = None
+            logger.info(f'token cache: {self.hits} hits, {self.misses} misses')
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+
+'''
+  A script for generating topic data of many projects at once
+
+  Copyright 2013-2018 RIKEN
+  Copyright 2018-2020 Chiba Institute of Technology
+
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+'''
+
+__author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
+
+import os
+import json
+import logging
+
+from .outline_for_survey_base import TOPIC_DIR, TOPIC_FILE_FMT
+from .search_topic_for_survey import search_batch, FNAME_PAT_TBL
+from .token_cache import TOKEN_CACHE_PATH
+
+logger = logging.getLogger()
+
+
+def get_proj_id(dpath, suffix=''):
+    return os.path.basename(os.path.normpath(dpath)) + suffix
+
+
+def read_dir_list(path):
+    with open(path) as f:
+        return [x.strip() for x in f if x.strip() and not x.startswith('#')]
+
+
+def gen_topics(index_path, mname, dpaths, outdir='.', nsims=5,
+               lang='fortran', suffix='', nprocs=1,
+               token_cache=TOKEN_CACHE_PATH):
+    '''Writes <outdir>/topic/<proj>.json for each of the project document
+    directories dpaths. Returns a report with the time of each stage.
+    '''
+    topic_dir = os.path.join(outdir, TOPIC_DIR)
+    outfiles = [os.path.join(topic_dir,
+                             TOPIC_FILE_FMT.format(get_proj_id(d, suffix)))
+                for d in dpaths]
+
+    report = search_batch(index_path, mname, dpaths, outfiles, nsims=nsims,
+                          lang=lang, nprocs=nprocs, token_cache=token_cache)
+
+    logger.info('%(written)d/%(projects)d topic files written' % report)
+
+    return report
+
+
+def main():
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+    from cca.ccautil.common import setup_logger
+
+    parser = ArgumentParser(description='generate topic data of projects',
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-d', '--debug', dest='debug', action='store_true',
+                        help='enable debug printing')
+
+    parser.add_argument('-m', '--model', dest='model', metavar='MODEL',
+                        type=str, default='lsi', choices=['lda', 'lsi', 'rp'],
+                        help='model')
+
+    parser.add_argument('-n', '--nsims', dest='nsims', metavar='N', type=int,
+                        default=5, help='number of topic-similarity pairs')
+
+    parser.add_argument('-l', '--lang', dest='lang', metavar='LANG',
+                        type=str, default='fortran',
+                        choices=list(FNAME_PAT_TBL.keys()),
+                        help='language')
+
+    parser.add_argument('-o', '--outdir', dest='outdir', default='.',
+                        metavar='DIR', type=str, help='dump data into DIR')
+
+    parser.add_argument('-s', '--suffix', dest='suffix', default='',
+                        metavar='SUFFIX', type=str,
+                        help='suffix of project ids (e.g. _git)')
+
+    parser.add_argument('-f', '--dir-list', dest='dir_list', default=None,
+                        metavar='FILE', type=str,
+                        help='read project directories from FILE')
+
+    parser.add_argument('-j', '--jobs', dest='nprocs', metavar='N', type=int,
+                        default=1, help='number of tokenizer processes')
+
+    parser.add_argument('-c', '--token-cache', dest='token_cache',
+                        metavar='PATH', type=str, default=TOKEN_CACHE_PATH,
+                        help='cache word counts of documents in PATH')
+
+    parser.add_argument('-r', '--report', dest='report', action='store_true',
+                        help='print timing report in JSON')
+
+    parser.add_argument('index_path', metavar='INDEX_FILE', type=str,
+                        help='index file')
+
+    parser.add_argument('dpaths', nargs='*', default=[], metavar='DIR',
+                        type=str, help='document directory of a project')
+
+    args = parser.parse_args()
+
+    log_level = logging.INFO
+    if args.debug:
+        log_level = logging.DEBUG
+    setup_logger(logger, log_level)
+
+    dpaths = args.dpaths
+    if args.dir_list:
+        dpaths = dpaths + read_dir_list(args.dir_list)
+
+    report = gen_topics(args.index_path, args.model, dpaths,
+                        outdir=args.outdir, nsims=args.nsims, lang=args.lang,
+                        suffix=args.suffix, nprocs=args.nprocs,
+                        token_cache=args.token_cache)
+
+    if args.report:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
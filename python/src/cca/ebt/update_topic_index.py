@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+
+'''
+  A script for folding documents of new projects into a topic index
+
+  Copyright 2013-2018 RIKEN
+  Copyright 2018-2020 Chiba Institute of Technology
+
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+'''
+
+__author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
+
+import os
+import _pickle as cPickle
+from itertools import chain
+import numpy as np
+from gensim import models, corpora, matutils
+from gensim.models.tfidfmodel import precompute_idfs
+import logging
+
+from .analyze_topic import iter_doc_paths, iter_extracted, _count_words
+from .search_topic_for_survey import (FNAME_PAT_TBL, get_tfidf_path,
+                                      load_index, build_index, convert_index,
+                                      iter_index_vectors, SHARDED_INDEX_EXT,
+                                      SHARD_SIZE)
+
+logger = logging.getLogger()
+
+VERSION_SEP = '-u'
+
+###
+
+
+def get_next_prefix(prefix):
+    '''Returns <prefix>-u<N> with the smallest N not in use.'''
+    a = prefix
+    m = prefix.rsplit(VERSION_SEP, 1)
+    if len(m) == 2 and m[1].isdigit():
+        a = m[0]
+    n = 1
+    while os.path.exists(f'{a}{VERSION_SEP}{n}.dict'):
+        n += 1
+    return f'{a}{VERSION_SEP}{n}'
+
+
+def extend_projection(model, num_terms):
+    '''Adds zero rows to the LSI basis for terms new to the model.'''
+    proj = model.projection
+    n = num_terms - proj.u.shape[0]
+    if n > 0:
+        u = np.zeros((num_terms, proj.u.shape[1]), dtype=proj.u.dtype)
+        u[:proj.u.shape[0]] = proj.u
+        proj.u = u
+        proj.m = num_terms
+        model.num_terms = num_terms
+
+
+def update_tfidf(tfidf, bows, dictionary):
+    '''Adds the document frequencies of bows to tfidf.'''
+    for bow in bows:
+        for (termid, _) in bow:
+            tfidf.dfs[termid] = tfidf.dfs.get(termid, 0) + 1
+        tfidf.num_nnz += len(bow)
+    tfidf.num_docs += len(bows)
+    tfidf.idfs = precompute_idfs(tfidf.wglobal, tfidf.dfs, tfidf.num_docs)
+    tfidf.id2word = dictionary
+
+
+def uses_tfidf(model, tfidf, index, corpus):
+    '''Tells whether the index vectors were computed from TF-IDF vectors by
+    comparing the first index vector with the recomputed ones.
+    '''
+    for (bow, v0) in zip(corpus, iter_index_vectors(index)):
+        def cos(vec):
+            v = matutils.unitvec(matutils.sparse2full(vec, model.num_topics))
+            return abs(float(np.dot(v, v0)))
+        return cos(model[tfidf[bow]]) >= cos(model[bow])
+    return True
+
+
+def get_documents(dpaths, pat, nprocs=1):
+    '''Returns the word counts of the documents under each of dpaths, with
+    the project id (the directory name) as class.
+    '''
+    paths = []
+    cls_tbl = {}
+    for dpath in dpaths:
+        cls = os.path.basename(os.path.normpath(dpath))
+        for path in iter_doc_paths(dpath, pat):
+            paths.append(path)
+            cls_tbl[path] = cls
+
+    docs = []
+    for (path, c) in iter_extracted(_count_words, paths, nprocs=nprocs):
+        if c:
+            docs.append((cls_tbl[path], c))
+
+    return docs
+
+
+def update(index_path, dpaths, out_prefix=None, lang='fortran', nprocs=1,
+           decay=None, sharded=None, shardsize=SHARD_SIZE):
+    '''Folds the documents under dpaths into the dictionary, TF-IDF model,
+    LSI model and similarity index of index_path, and saves them under
+    out_prefix (<prefix>-u<N> by default) next to the current version.
+    The BoW corpus (.mm) of the current version is required since the index
+    vectors are recomputed with the updated model. The new index is sharded
+    if sharded is True, or if sharded is None and index_path is. Returns
+    the new index path.
+    '''
+    (a, ext) = os.path.splitext(index_path)
+
+    if sharded is not None:
+        ext = SHARDED_INDEX_EXT if sharded else '.index'
+
+    if out_prefix is None:
+        out_prefix = get_next_prefix(a)
+
+    dictionary = corpora.Dictionary.load(a+'.dict')
+    model = models.LsiModel.load(a+'.model')
+    index = load_index(index_path)
+    tfidf = models.TfidfModel.load(get_tfidf_path(index_path))
+    corpus = corpora.MmCorpus(a+'.mm')
+
+    with open(a+'.classes', 'rb') as f:
+        classes = cPickle.load(f)
+
+    with_tfidf = uses_tfidf(model, tfidf, index, corpus)
+    logger.info(f'index vectors are computed from {"TF-IDF" if with_tfidf else "BoW"} vectors')
+
+    logger.info('collecting documents...')
+    docs = get_documents(dpaths, FNAME_PAT_TBL[lang], nprocs=nprocs)
+    if not docs:
+        logger.warning('no documents found')
+        return None
+
+    nterms = len(dictionary)
+    bows = [dictionary.doc2bow(list(c.elements()), allow_update=True)
+            for (_, c) in docs]
+    logger.info(f'{len(docs)} documents, {len(dictionary) - nterms} new words')
+
+    update_tfidf(tfidf, bows, dictionary)
+
+    extend_projection(model, len(dictionary))
+    model.id2word = dictionary
+
+    logger.info('updating model...')
+    model.add_documents(tfidf[bows] if with_tfidf else bows, decay=decay)
+
+    logger.info('serializing corpus...')
+    corpora.MmCorpus.serialize(out_prefix+'.mm', chain(corpus, bows))
+    corpus = corpora.MmCorpus(out_prefix+'.mm')
+
+    logger.info('rebuilding index...')
+    vecs = model[tfidf[corpus]] if with_tfidf else model[corpus]
+    build_index(out_prefix+ext, vecs, model.num_topics, shardsize=shardsize)
+
+    dictionary.save(out_prefix+'.dict')
+    model.save(out_prefix+'.model', sep_limit=0)  # to be memory-mapped
+    tfidf.save(out_prefix+'.tfidf')
+    with open(out_prefix+'.classes', 'wb') as f:
+        cPickle.dump(classes + [cls for (cls, _) in docs], f)
+
+    logger.info(f'saved as "{out_prefix}"')
+
+    return out_prefix+ext
+
+
+def main():
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+    from cca.ccautil.common import setup_logger
+
+    parser = ArgumentParser(description='fold documents of projects into a'
+                            ' topic index',
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-d', '--debug', dest='debug', action='store_true',
+                        help='enable debug printing')
+
+    parser.add_argument('-l', '--lang', dest='lang', metavar='LANG',
+                        type=str, default='fortran',
+                        choices=list(FNAME_PAT_TBL.keys()),
+                        help='language')
+
+    parser.add_argument('-o', '--output', dest='output', metavar='PREFIX',
+                        type=str, default=None,
+                        help='save the new version as PREFIX.{dict,model,...}'
+                        ' (default: INDEX_FILE prefix with -u<N>)')
+
+    parser.add_argument('--decay', dest='decay', metavar='R', type=float,
+                        default=None,
+                        help='weight of the current model (default: as trained)')
+
+    parser.add_argument('-j', '--jobs', dest='nprocs', metavar='N', type=int,
+                        default=1, help='number of tokenizer processes')
+
+    parser.add_argument('-s', '--sharded', dest='sharded', action='store_true',
+                        default=None,
+                        help='write a sharded index (%s)' % SHARDED_INDEX_EXT)
+
+    parser.add_argument('--shard-size', dest='shardsize', metavar='N',
+                        type=int, default=SHARD_SIZE,
+                        help='number of vectors per shard')
+
+    parser.add_argument('index_path', metavar='INDEX_FILE', type=str,
+                        help='index file')
+
+    parser.add_argument('dpaths', nargs='*', default=[], metavar='DIR',
+                        type=str,
+                        help='document directory of a project (with --sharded'
+                        ' and no DIR, the index is only converted)')
+
+    args = parser.parse_args()
+
+    log_level = logging.INFO
+    if args.debug:
+        log_level = logging.DEBUG
+    setup_logger(logger, log_level)
+
+    if args.dpaths:
+        update(args.index_path, args.dpaths, out_prefix=args.output,
+               lang=args.lang, nprocs=args.nprocs, decay=args.decay,
+               sharded=args.sharded, shardsize=args.shardsize)
+
+    elif args.sharded:
+        (a, _) = os.path.splitext(args.index_path)
+        convert_index(args.index_path, a+SHARDED_INDEX_EXT,
+                      shardsize=args.shardsize)
+
+    else:
+        parser.error('no document directories')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+import os
+
+import pytest
+
+pytest.importorskip('gensim')
+
+from cca.ebt import analyze_topic  # noqa: E402
+
+
+def test_list_files_link_cycle(tmp_path):
+    root = tmp_path / 'proj'
+    (root / 'doc').mkdir(parents=True)
+    (root / 'README').write_text('top')
+    (root / 'doc' / 'readme.txt').write_text('doc')
+    os.symlink(root, root / 'doc' / 'up')  # cycle
+    os.symlink(root / 'doc', root / 'doc2')  # same directory twice
+
+    other = tmp_path / 'other'
+    other.mkdir()
+    (other / 'README').write_text('other')
+    os.symlink(other, root / 'ext')
+
+    analyze_topic.clear_file_lists()
+    files = sorted(analyze_topic.list_files(str(root)))
+    assert len(files) == 3
+    assert ('.', 'README') in files
+    assert ('ext', 'README') in files
+    docs = [rd for (rd, n) in files if n == 'readme.txt']
+    assert docs in (['doc'], ['doc2'])  # whichever is walked first
+    analyze_topic.clear_file_lists()
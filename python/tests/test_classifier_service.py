@@ -0,0 +1,74 @@
+import os
+import threading
+
+import pytest
+
+pytest.importorskip('cca.ccautil.sparql')
+
+from cca.ebt import classifier_service, select_targets  # noqa: E402
+
+MINAMI = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir,
+                      'cca', 'models', 'minami', 'm.pkl')
+
+
+def write_metrics(path, n):
+    head = ['proj', 'ver', 'path', 'lnum', 'sub', 'root_file', 'nid',
+            'digest', 'max_loop_level', 'max_loop_depth',
+            'max_mergeable_arrays', 'indirect_array_refs0']
+    with open(path, 'w') as f:
+        f.write(','.join(head) + '\n')
+        for i in range(n):
+            f.write(f'p,v,a.f90,{i},main,a.f90,p{i},d{i},'
+                    f'{i % 3 + 1},{i % 4 + 1},{i % 5},{i % 2}\n')
+
+
+@pytest.fixture
+def server(tmp_path):
+    sock_path = str(tmp_path / 'classifier.sock')
+    clf_tbl = classifier_service.load_preloaded([MINAMI])
+    server = classifier_service.Server(sock_path, clf_tbl,
+                                       models_dir=str(tmp_path / 'models'))
+    th = threading.Thread(target=server.serve_forever, daemon=True)
+    th.start()
+    yield sock_path
+    server.shutdown()
+    server.server_close()
+
+
+def test_bare_model(tmp_path, server):
+    path = str(tmp_path / 'metrics.csv')
+    write_metrics(path, 20)
+
+    expected = select_targets.find_kernels(path, MINAMI)
+    assert expected[2] == 20
+
+    with classifier_service.Client(server) as client:
+        assert client.find_kernels(MINAMI, path) == expected
+        with pytest.raises(RuntimeError):
+            client.predict(MINAMI, [{'max_loop_level': 1}])
+        with pytest.raises(RuntimeError):
+            client.find_kernels('no-such-model', path)
+
+
+def test_served_fallback(tmp_path, server, monkeypatch):
+    path = str(tmp_path / 'metrics.csv')
+    write_metrics(path, 20)
+    expected = select_targets.find_kernels(path, MINAMI)
+
+    calls = []
+    find_kernels = classifier_service.Client.find_kernels
+
+    def counted(self, *args, **kwargs):
+        calls.append(args)
+        return find_kernels(self, *args, **kwargs)
+
+    monkeypatch.setattr(classifier_service.Client, 'find_kernels', counted)
+
+    assert select_targets.find_kernels_served(path, MINAMI,
+                                              sock_path=server) == expected
+    assert len(calls) == 1
+
+    no_sock = str(tmp_path / 'none.sock')
+    assert select_targets.find_kernels_served(path, MINAMI,
+                                              sock_path=no_sock) == expected
+    assert len(calls) == 1
@@ -0,0 +1,36 @@
+import os
+
+import pytest
+
+pytest.importorskip('cca.ccautil.siteconf')
+
+from cca.ebt import analyze_topic  # noqa: E402
+from cca.ebt import collect_readme_for_survey as crs  # noqa: E402
+
+
+def test_from_dir_stays_in_project(tmp_path, monkeypatch):
+    projs = tmp_path / 'projects'
+    root = projs / 'proj'
+    (root / 'doc').mkdir(parents=True)
+    (root / 'README').write_text('top')
+    (root / 'doc' / 'readme.txt').write_text('doc')
+    os.symlink(root / 'doc', root / 'doc2')  # inside the project
+
+    other = tmp_path / 'other'
+    other.mkdir()
+    (other / 'README').write_text('other')
+    os.symlink(other, root / 'ext')
+    os.symlink(other / 'README', root / 'doc' / 'README.ext')
+
+    monkeypatch.setattr(crs, 'PROJECTS_DIR', str(projs))
+    analyze_topic.clear_file_lists()
+    try:
+        li = crs.Collector('proj', conf=object()).from_dir()
+    finally:
+        analyze_topic.clear_file_lists()
+
+    paths = sorted(d['path'] for d in li)
+    assert paths[0] == 'README'
+    assert paths[1:] in (['doc/readme.txt'], ['doc2/readme.txt'])
+    for d in li:
+        assert '..' not in d['url']
@@ -0,0 +1,127 @@
+import csv
+import json
+
+import pytest
+
+from cca.ebt import fop_weight
+from cca.ebt.fop_weight import (FOP_TBL, FOP_TBL_DBL_EXTRA, FOP_TBL_VA,
+                                FopWeightTable)
+
+
+def ref_nfops(name, nargs, double=False):
+    # the lookup the table replaced
+    try:
+        (a, b) = FOP_TBL_VA[name]
+        return a * nargs + b
+    except KeyError:
+        nfop = FOP_TBL.get(name, 1)
+        if double:
+            nfop += FOP_TBL_DBL_EXTRA.get(name, 0)
+        return nfop
+
+
+NAMES = list(FOP_TBL) + list(FOP_TBL_VA) + ['unknown']
+
+
+@pytest.mark.parametrize('double', [False, True])
+def test_equivalence(double):
+    tbl = fop_weight.SPARC64_VIIIFX
+    for name in NAMES:
+        for nargs in (1, 2, 5):
+            v = tbl.get_nfops(name, nargs, double)
+            assert v == ref_nfops(name, nargs, double)
+            assert isinstance(v, int)
+
+
+def test_calc_nfops():
+    refs = [('a', 'sin', 1, True), ('a', 'max', 3, False),
+            ('b', 'unknown', 1, False), ('a', 'sqrt', 1, False)]
+    r = fop_weight.SPARC64_VIIIFX.calc_nfops(refs)
+    assert r == {'a': 31 + 2 + 11, 'b': 1}
+
+
+def test_defaults_not_shared():
+    t0 = FopWeightTable({'f': 3})
+    t0.get_id('f')
+    t1 = FopWeightTable({'g': 4})
+    assert t1.get_nfops('f', 1, False) == fop_weight.DEFAULT_NFOP
+
+
+def test_fractional_weight(tmp_path):
+    path = tmp_path / 'arch.json'
+    path.write_text(json.dumps({'fop': {'exp': 2.5},
+                                'fop_dbl_extra': {'exp': 0.25},
+                                'fop_va': {'max': [0.5, 0]}}))
+    tbl = fop_weight.get_arch(str(path))
+    assert tbl.get_nfops('exp', 1, False) == 2.5
+    assert tbl.get_nfops('exp', 1, True) == 2.75
+    assert tbl.get_nfops('max', 3, False) == 1.5
+    assert tbl.calc_nfops([('k', 'exp', 1, False),
+                           ('k', 'exp', 1, False)]) == {'k': 5}
+
+
+def test_unknown_arch():
+    with pytest.raises(ValueError):
+        fop_weight.get_arch('no-such-arch')
+
+
+class Range(object):
+    def __init__(self, lnum):
+        self.lnum = lnum
+
+    def get_start_line(self):
+        return self.lnum
+
+
+class Entity(object):
+    '''Loop URIs of the form "loop@LNUM".'''
+    def __init__(self, uri=None):
+        self.uri = uri
+
+    def get_range(self):
+        return Range(int(self.uri.split('@')[1]))
+
+
+@pytest.mark.parametrize('ext', ['.npz', '.parquet', '.csv'])
+def test_fractional_weight_written(tmp_path, monkeypatch, ext):
+    pytest.importorskip('cca.ccautil.sparql')
+    pytest.importorskip('cca.factutil.entity')
+    if ext == '.parquet':
+        pytest.importorskip('pyarrow')
+    from cca.ebt import metrics_store
+    from cca.ebt import sourcecode_metrics_for_survey_base as base
+    from cca.ebt import sourcecode_metrics_for_survey_fortran as fortran
+
+    monkeypatch.setattr(base.sparql, 'get_driver', lambda *a, **k: None)
+    monkeypatch.setattr(base, 'SourceCodeEntity', Entity)
+
+    arch = tmp_path / 'arch.json'
+    arch.write_text(json.dumps({'fop': {'exp': 2.5}}))
+
+    m = fortran.Metrics('proj', arch=str(arch))
+    k0 = m.intern_key(('v', 'a.f90', 'sub', 'loop@3', 'i'))
+    k1 = m.intern_key(('v', 'a.f90', 'sub', 'loop@7', 'j'))
+    nfop_tbl = m._fop_weight.calc_nfops([(k0, 'sqrtx', 1, False),
+                                         (k1, 'exp', 1, False)])
+    for k in (k0, k1):
+        m.set_metrics(fortran.N_FP_OPS, k, nfop_tbl[k], add=True)
+        m.set_metrics(fortran.N_A_REFS[0], k, 5)
+
+    ftbls = sorted(m.get_ftbl_list(), key=lambda t: int(t['meta']['lnum']))
+
+    path = str(tmp_path / f'metrics{ext}')
+    with metrics_store.open_writer(path, fortran.META_KEYS, chunk_size=1) as w:
+        w.write(ftbls)
+
+    if ext == '.csv':
+        with open(path, newline='') as f:
+            rows = list(csv.DictReader(f))
+        fp_ops = [float(r['fp_ops']) for r in rows]
+        bf0 = [float(r['bf0']) for r in rows]
+    else:
+        cols = metrics_store.load(path)
+        fp_ops = cols['fp_ops'].tolist()
+        bf0 = cols['bf0'].tolist()
+
+    assert fp_ops == [1, 2.5]
+    assert bf0 == [20 / 1, 20 / 2.5]
@@ -0,0 +1,16 @@
+import sys
+
+import pytest
+
+from cca.ebt import make_loop_classifier
+
+
+def test_approx_needs_minami(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['make_loop_classifier', '-a',
+                                      'nystroem', '-m', 'terai', '-r', 'm',
+                                      '--models-dir', str(tmp_path),
+                                      'judgments.csv'])
+    with pytest.raises(SystemExit):
+        make_loop_classifier.main()
+    assert 'minami' in capsys.readouterr().err
+    assert list(tmp_path.iterdir()) == []
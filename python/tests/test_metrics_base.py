@@ -0,0 +1,75 @@
+import pytest
+
+pytest.importorskip('cca.ccautil.sparql')
+pytest.importorskip('cca.factutil.entity')
+
+from cca.ebt import sourcecode_metrics_for_survey_base as base  # noqa: E402
+
+
+class Range(object):
+    def __init__(self, lnum):
+        self.lnum = lnum
+
+    def get_start_line(self):
+        return self.lnum
+
+
+class Entity(object):
+    '''Loop URIs of the form "loop@LNUM".'''
+    def __init__(self, uri=None):
+        self.uri = uri
+
+    def get_range(self):
+        return Range(int(self.uri.split('@')[1]))
+
+
+@pytest.fixture
+def metrics(monkeypatch):
+    monkeypatch.setattr(base.sparql, 'get_driver', lambda *a, **k: None)
+    monkeypatch.setattr(base, 'SourceCodeEntity', Entity)
+    return base.MetricsBase('proj')
+
+
+def test_intern_key(metrics):
+    k0 = metrics.intern_key(('v', 'a.f90', 'sub', 'loop@3', 'i'))
+    k1 = metrics.intern_key(('v', 'a.f90', 'sub', 'loop@5', 'j'))
+    assert (k0, k1) == (0, 1)
+    assert metrics.intern_key(('v', 'a.f90', 'sub', 'loop@3', 'i')) == k0
+    assert metrics.get_key_tuple(k1) == ('v', 'a.f90', 'sub', 'loop@5', 'j')
+    assert metrics.get_loop_of_key(k1) == 'loop@5'
+
+
+def test_loop_digest(metrics):
+    kid = metrics.intern_key(('v', 'a.f90', 'sub', 'loop@3', 'i'))
+    assert metrics.get_loop_digest(kid) is None
+    metrics.set_loop_digest(kid, 'b')
+    metrics.set_loop_digest(kid, 'a')
+    metrics.set_loop_digest(kid, 'b')
+    assert metrics.get_loop_digest(kid) == 'a:b'
+
+
+def test_kinfo_invalidated_by_new_digest(metrics):
+    kid = metrics.intern_key(('v', 'a.f90', 'sub', 'loop@3', 'i'))
+    metrics.set_loop_digest(kid, 'a')
+    assert metrics.get_kinfo(kid) == (0, 'sub', 'a')
+    metrics.set_loop_digest(kid, 'b')
+    assert metrics.get_kinfo(kid) == (0, 'sub', 'a:b')
+
+
+def test_set_metrics(metrics):
+    k0 = metrics.intern_key(('v', 'a.f90', 'sub', 'loop@3', 'i'))
+    k1 = metrics.intern_key(('v', 'a.f90', 'sub', 'loop@3', 'j'))
+    k2 = metrics.intern_key(('v', 'a.f90', 'sub', 'loop@7', 'k'))
+    metrics.set_loop_digest(k0, 'd')
+
+    metrics.set_metrics('nops', k0, 2, add=True)
+    metrics.set_metrics('nops', k1, 3, add=True)  # same loop line
+    metrics.set_metrics('nops', k2, 1)
+    metrics.set_metrics('nops', k2, 4)
+
+    assert metrics.get_value('nops', ('v', 'a.f90', '3')) == 5
+    assert metrics.get_value('nops', ('v', 'a.f90', '7')) == 4
+    assert metrics.get_value('nops', ('v', 'a.f90', '9')) == 0
+    assert metrics.get_value('other', ('v', 'a.f90', '3')) == 0
+    assert metrics.get_metadata(('v', 'a.f90', '7')) == {'sub': 'sub',
+                                                         'digest': None}
@@ -0,0 +1,97 @@
+import csv
+
+import numpy as np
+import pytest
+
+from cca.ebt import metrics_store
+
+META_KEYS = ['proj', 'ver', 'path', 'sub', 'lnum', 'digest']
+
+
+def make_ftbls(n):
+    ftbls = []
+    for i in range(n):
+        ftbls.append({
+            'meta': {'proj': 'p', 'ver': 'v', 'path': f'src/{i}.f90',
+                     'sub': 'main', 'lnum': str(i + 1),
+                     'digest': None if i % 2 else f'd{i}'},
+            'branches': i,
+            'stmts': i % 3,
+            'max_array_rank': 2,
+            'bf0': 0.5 * i,
+        })
+    return ftbls
+
+
+def test_rate():
+    r = metrics_store.rate([1, 2, 3], [2, 0, 3])
+    assert r.tolist() == [0.5, 0.0, 1.0]
+
+
+def test_get_derived_items():
+    items = ['branches', 'stmts', 'max_array_rank']
+    assert metrics_store.get_derived_items(items) == ['br_rate',
+                                                      'array_rank_rate']
+
+
+@pytest.mark.parametrize('ext', ['.npz', '.parquet'])
+def test_round_trip(tmp_path, ext):
+    if ext == '.parquet':
+        pytest.importorskip('pyarrow')
+    path = str(tmp_path / f'metrics{ext}')
+    with metrics_store.open_writer(path, META_KEYS, chunk_size=3) as w:
+        w.write(make_ftbls(7))
+    assert (w.count, w.nchunks) == (7, 3)
+
+    cols = metrics_store.load(path)
+    assert cols['path'].tolist() == [f'src/{i}.f90' for i in range(7)]
+    assert cols['lnum'].tolist() == [str(i + 1) for i in range(7)]
+    assert cols['branches'].dtype == np.float64
+    assert cols['branches'].tolist() == list(range(7))
+    assert cols['bf0'].tolist() == [0.5 * i for i in range(7)]
+    assert cols['digest'].tolist() == ['d0', '', 'd2', '', 'd4', '', 'd6']
+    expected = [i / (i % 3) if i % 3 else 0.0 for i in range(7)]
+    assert cols['br_rate'].tolist() == expected
+    assert cols['array_rank_rate'].tolist() == [2 / 7.] * 7
+
+
+@pytest.mark.parametrize('ext', ['.npz', '.parquet'])
+def test_int_then_float(tmp_path, ext):
+    if ext == '.parquet':
+        pytest.importorskip('pyarrow')
+    path = str(tmp_path / f'metrics{ext}')
+    ftbls = make_ftbls(4)
+    for (ftbl, v) in zip(ftbls, [0, 2.5, 1, 0.25]):
+        ftbl['fp_ops'] = v
+    with metrics_store.open_writer(path, META_KEYS, chunk_size=2) as w:
+        w.write(ftbls)
+    assert metrics_store.load(path)['fp_ops'].tolist() == [0, 2.5, 1, 0.25]
+
+
+def test_npz_rewrite_removes_old_chunks(tmp_path):
+    path = str(tmp_path / 'metrics.npz')
+    with metrics_store.open_writer(path, META_KEYS, chunk_size=2) as w:
+        w.write(make_ftbls(5))
+    with metrics_store.open_writer(path, META_KEYS, chunk_size=2) as w:
+        w.write(make_ftbls(2))
+    assert len(metrics_store.get_npz_chunk_paths(path)) == 1
+    assert len(metrics_store.load(path)['proj']) == 2
+
+
+def test_csv(tmp_path):
+    path = str(tmp_path / 'metrics.csv')
+    with metrics_store.open_writer(path, META_KEYS, chunk_size=3) as w:
+        w.write(make_ftbls(4))
+    with open(path, newline='') as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == 4
+    assert [r['digest'] for r in rows] == ['d0', '', 'd2', '']
+    assert rows[3]['br_rate'] == '0.0'
+    assert list(rows[0].keys())[:len(META_KEYS)] == META_KEYS
+
+
+def test_unsupported_format(tmp_path):
+    with pytest.raises(ValueError):
+        metrics_store.open_writer(str(tmp_path / 'metrics.tab'), META_KEYS)
+    with pytest.raises(ValueError):
+        list(metrics_store.iter_chunks(str(tmp_path / 'metrics.csv')))
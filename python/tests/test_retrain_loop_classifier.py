@@ -0,0 +1,108 @@
+import csv
+import json
+
+import numpy as np
+import pytest
+
+from cca.ebt import retrain_loop_classifier as rlc
+from cca.ebt.make_loop_classifier import META, METRICS
+
+
+def write_metrics(path, n, with_nid=True):
+    head = META + METRICS
+    with open(path, 'w', newline='') as f:
+        w = csv.writer(f)
+        w.writerow(head)
+        for i in range(n):
+            m = {'proj': 'p', 'ver': 'v', 'path': '0', 'lnum': str(10 + i),
+                 'sub': 'main', 'root_file': 'a.f90',
+                 'nid': f'n{i}' if with_nid else '', 'digest': f'd{i}'}
+            w.writerow([m.get(k, i % 4 + 1) for k in head])
+
+
+def write_log(path, records):
+    with open(path, 'w') as f:
+        for r in records:
+            f.write(json.dumps(r) + '\n')
+
+
+def judgment(nid, judgment, time):
+    # path is an index into path_list.json as logged by the outline viewer
+    return {'proj': 'p', 'ver': 'v', 'nid': nid, 'path': 0, 'lnum': 99,
+            'judgment': judgment, 'time': time}
+
+
+def test_join_metrics_by_nid(tmp_path):
+    mpath = str(tmp_path / 'metrics.csv')
+    write_metrics(mpath, 6)
+    lpath = str(tmp_path / 'log.json')
+    write_log(lpath, [judgment('n1', 'M1', '1'),
+                      judgment('n3', 'NonKernel', '2'),
+                      judgment('n4', 'NotYet', '3'),
+                      judgment('n9', 'M2', '4')])
+
+    source = rlc.LocalJudgmentSource(lpath)
+    (jtbl, last_time) = rlc.get_latest_judgments(source.find())
+    assert last_time == '4'
+
+    (X, y, keys) = rlc.join_metrics(mpath, jtbl, chunk_size=2)
+    assert keys.tolist() == ['p:v:n1', 'p:v:n3']
+    assert y.tolist() == ['Kernel', 'NonKernel']
+    assert X.shape == (2, 4)
+
+
+def test_join_metrics_without_nid(tmp_path):
+    mpath = str(tmp_path / 'metrics.csv')
+    write_metrics(mpath, 3, with_nid=False)
+    jtbl = {('p', 'v', 'n1'): judgment('n1', 'M1', '1')}
+    with pytest.raises(ValueError):
+        rlc.join_metrics(mpath, jtbl)
+
+
+def test_retrain(tmp_path):
+    mpath = str(tmp_path / 'metrics.csv')
+    write_metrics(mpath, 8)
+    lpath = str(tmp_path / 'log.json')
+    write_log(lpath, [judgment(f'n{i}', 'M1' if i % 2 else 'NonKernel',
+                               str(i)) for i in range(8)])
+    clf_path = str(tmp_path / 'clf.pkl')
+
+    source = rlc.LocalJudgmentSource(lpath)
+    assert rlc.retrain(source, mpath, clf_path) == 8
+
+    ts = rlc.TrainingSet.load(rlc.get_state_path(clf_path))
+    assert len(ts) == 8
+    assert ts.last_time == '7'
+    assert np.unique(ts.y).tolist() == ['Kernel', 'NonKernel']
+
+    assert rlc.retrain(source, mpath, clf_path) == 0
+
+
+def test_retrain_pending(tmp_path):
+    mpath = str(tmp_path / 'metrics.csv')
+    write_metrics(mpath, 4)
+    lpath = str(tmp_path / 'log.json')
+    write_log(lpath, [judgment('n0', 'NonKernel', '0'),
+                      judgment('n1', 'M1', '1'),
+                      judgment('n5', 'M2', '2')])
+    clf_path = str(tmp_path / 'clf.pkl')
+    state_path = rlc.get_state_path(clf_path)
+
+    source = rlc.LocalJudgmentSource(lpath)
+    assert rlc.retrain(source, mpath, clf_path) == 2
+
+    ts = rlc.TrainingSet.load(state_path)
+    assert ts.last_time == '2'
+    assert ts.pending == {('p', 'v', 'n5'): 'M2'}
+
+    # still missing
+    assert rlc.retrain(source, mpath, clf_path) == 0
+    assert rlc.TrainingSet.load(state_path).pending == ts.pending
+
+    write_metrics(mpath, 6)  # new snapshot
+    assert rlc.retrain(source, mpath, clf_path) == 1
+
+    ts = rlc.TrainingSet.load(state_path)
+    assert ts.pending == {}
+    assert sorted(ts.keys.tolist()) == ['p:v:n0', 'p:v:n1', 'p:v:n5']
+    assert ts.y[ts.keys == 'p:v:n5'].tolist() == ['Kernel']
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('gensim')
+
+from cca.ebt.search_topic_for_survey import top_k  # noqa: E402
+
+
+def ref_top_k(sims, k=None):
+    # full sort, ties broken by index
+    res = sorted(enumerate(sims), key=lambda x: (-x[1], x[0]))
+    return res if k is None else res[:max(k, 0)]
+
+
+def test_ties():
+    sims = np.array([0.5, 0.9, 0.5, 0.1, 0.9, 0.5], dtype=np.float32)
+    assert top_k(sims, 1) == [(1, sims[1])]
+    assert top_k(sims, 2) == [(1, sims[1]), (4, sims[4])]
+    assert top_k(sims, 3) == [(1, sims[1]), (4, sims[4]), (0, sims[0])]
+    assert top_k(sims, 4) == ref_top_k(sims, 4)
+
+
+def test_bounds():
+    sims = np.array([0.2, 0.3, 0.1])
+    assert top_k(sims) == ref_top_k(sims)
+    assert top_k(sims, 10) == ref_top_k(sims)
+    assert top_k(sims, 0) == []
+    assert top_k(np.array([]), 3) == []
+
+
+def test_random():
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+        sims = rng.integers(0, 5, size=30) / 4.0
+        k = int(rng.integers(1, 30))
+        assert top_k(sims, k) == ref_top_k(sims, k)
+
+
+def test_rows():
+    sims = np.array([[0.1, 0.2, 0.2], [0.3, 0.3, 0.1]])
+    assert top_k(sims, 2) == [ref_top_k(sims[0], 2), ref_top_k(sims[1], 2)]
+
+
+def test_missing_projection(tmp_path):
+    from gensim import corpora, models
+    from cca.ebt.search_topic_for_survey import TopicIndex
+
+    a = str(tmp_path / 'topic')
+    texts = [['foo', 'bar'], ['bar', 'baz'], ['foo', 'baz']]
+    dictionary = corpora.Dictionary(texts)
+    dictionary.save(a + '.dict')
+    lsi = models.LsiModel([dictionary.doc2bow(t) for t in texts],
+                          id2word=dictionary, num_topics=2)
+    lsi.save(a + '.model')
+    (tmp_path / 'topic.model.projection').unlink()
+
+    with pytest.raises(FileNotFoundError, match='topic.model.projection'):
+        TopicIndex(a + '.index')
@@ -0,0 +1,105 @@
+import json
+
+import numpy as np
+import pytest
+
+pytest.importorskip('cca.ccautil.sparql')
+
+from cca.ebt import select_targets  # noqa: E402
+
+
+def feed(rows, nsamples, chunk, seed):
+    rng = np.random.default_rng(seed)
+    reservoir = []
+    nseen = 0
+    for i in range(0, len(rows), chunk):
+        nseen = select_targets.reservoir_update(reservoir, rows[i:i+chunk],
+                                                nseen, nsamples, rng)
+    return (reservoir, nseen)
+
+
+def test_reservoir_fill():
+    (reservoir, nseen) = feed(list(range(5)), 10, 2, 0)
+    assert reservoir == [0, 1, 2, 3, 4]
+    assert nseen == 5
+
+
+def test_reservoir_size():
+    rows = list(range(100))
+    for chunk in (1, 7, 100):
+        (reservoir, nseen) = feed(rows, 10, chunk, 1)
+        assert nseen == 100
+        assert len(reservoir) == 10
+        assert len(set(reservoir)) == 10
+        assert set(reservoir) <= set(rows)
+
+
+def test_reservoir_uniform():
+    rows = list(range(20))
+    counts = np.zeros(len(rows))
+    ntrials = 2000
+    for seed in range(ntrials):
+        (reservoir, _) = feed(rows, 5, 3, seed)
+        counts[reservoir] += 1
+    # each row is kept with probability 5/20
+    assert np.allclose(counts / ntrials, 0.25, atol=0.05)
+
+
+def write_metrics(path, proj, n):
+    head = ['proj', 'ver', 'path', 'lnum', 'sub', 'root_file', 'nid',
+            'digest', 'bf0', 'bf1', 'bf2']
+    with open(path, 'w') as f:
+        f.write(','.join(head) + '\n')
+        for i in range(n):
+            f.write(f'{proj},v,a.f90,{i},main,a.f90,{proj}{i},d{proj}{i},'
+                    '1.0,1.0,1.0\n')
+
+
+def test_sample_all_files(tmp_path):
+    write_metrics(tmp_path / 'p.csv', 'p', 3)
+    write_metrics(tmp_path / 'q.csv', 'q', 2)
+    outdir = tmp_path / 'target'
+
+    select_targets.sample([str(tmp_path)], 0, seed=0,
+                          target_dir=str(outdir))
+
+    assert json.loads((outdir / 'p' / 'v.json').read_text()) == ['p0', 'p1',
+                                                                 'p2']
+    assert json.loads((outdir / 'q' / 'v.json').read_text()) == ['q0', 'q1']
+
+
+def test_find_kernels_without_nid(tmp_path, monkeypatch):
+    def iter_classified(*args, **kwargs):
+        meta = {'proj': np.array(['p']), 'ver': np.array(['v']),
+                'nid': np.array(['']), 'root_file': np.array([''])}
+        yield (np.array(['Kernel']), meta)
+
+    monkeypatch.setattr(select_targets, 'iter_classified', iter_classified)
+    with pytest.raises(ValueError):
+        select_targets.find_kernels('m.npz', 'clf.pkl')
+
+
+def test_get_metrics_files(tmp_path):
+    for name in ('a.csv', 'b.npz', 'c.parquet'):
+        (tmp_path / name).write_text('')
+    assert select_targets.get_metrics_files([str(tmp_path), 'x.npz']) == [
+        str(tmp_path / 'a.csv'), 'x.npz']
+
+
+def test_find_kernels_with_registered_model(tmp_path):
+    from sklearn.dummy import DummyClassifier
+    from cca.ebt.make_loop_classifier import make_pipeline
+    from cca.ebt.model_registry import get_registry
+
+    path = tmp_path / 'metrics.csv'
+    write_metrics(path, 'p', 3)
+
+    clf = make_pipeline(DummyClassifier(strategy='constant',
+                                        constant='Kernel'))
+    clf.fit(np.array([[0.], [1.]]), np.array(['Kernel', 'NonKernel']))
+    model = get_registry(str(tmp_path / 'models')).save('m', clf, ['bf0'])
+
+    (ptbl, rtbl, nrows) = select_targets.find_kernels(str(path), model)
+    assert nrows == 3
+    assert ptbl == {'p': {'v': ['p0', 'p1', 'p2']}}
+    assert rtbl == {'p': {'v': {'a.f90'}}}
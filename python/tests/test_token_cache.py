@@ -0,0 +1,110 @@
+import os
+import sqlite3
+from collections import Counter
+
+from cca.ebt import token_cache
+from cca.ebt.token_cache import TokenCache
+
+
+def write(path, text, mtime_ns=None):
+    path.write_text(text)
+    if mtime_ns is not None:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_hit_miss(tmp_path):
+    doc = tmp_path / 'a.txt'
+    write(doc, 'foo bar', 10**18)
+    db = str(tmp_path / 'cache' / 'tokens.db')
+
+    with TokenCache(db, version='1') as cache:
+        assert cache.get(str(doc)) is None
+        cache.put(str(doc), Counter(foo=1, bar=1))
+        assert cache.get(str(doc)) == Counter(foo=1, bar=1)
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    with TokenCache(db, version='1') as cache:
+        assert cache.get(str(doc)) == Counter(foo=1, bar=1)
+        write(doc, 'foo baz', 2 * 10**18)
+        assert cache.get(str(doc)) is None
+
+
+def test_digest(tmp_path):
+    doc = tmp_path / 'a.txt'
+    write(doc, 'foo', 10**18)
+    db = str(tmp_path / 'tokens.db')
+
+    with TokenCache(db, use_digest=True, version='1') as cache:
+        cache.put(str(doc), Counter(foo=1))
+        write(doc, 'foo', 2 * 10**18)
+        assert cache.get(str(doc)) == Counter(foo=1)
+
+
+def test_invalidate(tmp_path):
+    doc = tmp_path / 'a.txt'
+    write(doc, 'foo')
+    db = str(tmp_path / 'tokens.db')
+
+    with TokenCache(db, version='1') as cache:
+        cache.put(str(doc), Counter(foo=1))
+
+    with TokenCache(db, version='2') as cache:
+        assert cache.get(str(doc)) is None
+
+    with TokenCache(db) as cache:  # tokenizer settings
+        cache.put(str(doc), Counter(foo=1))
+
+    with TokenCache(db) as cache:
+        assert cache.get(str(doc)) == Counter(foo=1)
+
+
+def test_missing_file(tmp_path):
+    doc = tmp_path / 'a.txt'
+    write(doc, 'foo')
+    db = str(tmp_path / 'tokens.db')
+
+    with TokenCache(db, version='1') as cache:
+        cache.put(str(doc), Counter(foo=1))
+        doc.unlink()
+        assert cache.get(str(doc)) is None
+        cache.put(str(doc), Counter(foo=1))
+        assert cache.misses == 1
+
+
+def test_evict(tmp_path):
+    db = str(tmp_path / 'tokens.db')
+    docs = []
+    for i in range(5):
+        doc = tmp_path / f'{i}.txt'
+        write(doc, 'foo')
+        docs.append(str(doc))
+
+    with TokenCache(db, max_entries=3, version='1') as cache:
+        for doc in docs:
+            cache.put(doc, Counter(foo=1))
+
+    with TokenCache(db, version='1') as cache:
+        found = [cache.get(doc) is not None for doc in docs]
+        assert found == [False, False, True, True, True]
+
+
+def test_locked(tmp_path, monkeypatch):
+    monkeypatch.setattr(token_cache, 'TIMEOUT', 0.01)
+    doc = tmp_path / 'a.txt'
+    write(doc, 'foo')
+    db = str(tmp_path / 'tokens.db')
+
+    with TokenCache(db, version='1') as cache:
+        cache.put(str(doc), Counter(foo=1))
+
+    with TokenCache(db, version='1') as cache:
+        other = sqlite3.connect(db, timeout=0.01)
+        other.execute('BEGIN EXCLUSIVE')
+        try:
+            assert cache.get(str(doc)) is None
+            cache.put(str(doc), Counter(foo=2))
+            cache.commit()
+        finally:
+            other.rollback()
+            other.close()
+        assert cache.get(str(doc)) == Counter(foo=1)